@@ -187,6 +187,13 @@ main() {
     kubectl delete deployment product-service -n ${NAMESPACE} --force --grace-period=0 || true
     kubectl delete service product-service -n ${NAMESPACE} --force --grace-period=0 || true
     
+    # Shared service token (rate-limit exemption, RPC auth): generated once per cluster, never overwritten
+    if ! kubectl get secret service-auth -n ${NAMESPACE} &>/dev/null; then
+        log_info "Creating service-auth secret with a random token..."
+        kubectl create secret generic service-auth -n ${NAMESPACE} \
+            --from-literal=token="$(openssl rand -hex 32)"
+    fi
+
     # Deploy microservices with Helm
     log_info "Deploying microservices with Helm..."
     helm upgrade --install order-service ./helm-charts/order-service \
@@ -16,7 +16,5 @@ allow if {
     input.source == "order-service"
 }
 
-# Rate limiting: allow if fewer than 100 requests in the last minute
-allow if {
-    count(input.requests_last_minute) < 100
-}
\ No newline at end of file
+# Rate limiting is enforced by the service itself (app/ratelimit.py) before
+# the policy check; requests_last_minute was never part of the input.
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""Archival of closed orders.
+
+Delivered and cancelled orders older than ORDER_ARCHIVE_AFTER_DAYS (by
+created_at) are moved, with their items, from orders/order_items into
+orders_archive/order_items_archive. Each batch is copied and deleted in
+one transaction, so an order is always in exactly one of the two tables.
+Read endpoints only look at the archive when called with
+include_archived=true.
+
+Archival runs as one Kubernetes CronJob
+(kubernetes/microservices/order-service/archiver-cronjob.yaml), not in the
+API workers: two runs at once would pick the same batches and collide on
+the archive tables' primary keys. The job runs a single pass:
+
+    ORDER_ARCHIVE_AFTER_DAYS=90 python -m app.archiver
+"""
+import argparse
+import os
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.orm import Session
+
+from app.models import (
+    OrderModel, OrderItemModel, ArchivedOrderModel, ArchivedOrderItemModel, OrderStatus
+)
+
+logger = logging.getLogger(__name__)
+
+# Archive closed orders created more than this many days ago
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", "0"))
+# Orders moved per transaction
+ORDER_ARCHIVE_BATCH_SIZE = int(os.getenv("ORDER_ARCHIVE_BATCH_SIZE", "1000"))
+
+CLOSED_STATUSES = [OrderStatus.DELIVERED.value, OrderStatus.CANCELLED.value]
+
+ORDER_COLUMNS = ["id", "customer_id", "status", "total_amount", "shipping_address", "created_at", "updated_at"]
+ITEM_COLUMNS = ["id", "order_id", "product_id", "quantity", "unit_price"]
+
+
+def archive_closed_orders(db: Session, older_than: datetime, batch_size: int = ORDER_ARCHIVE_BATCH_SIZE) -> int:
+    """Move closed orders created before `older_than` to the archive tables.
+
+    Returns the number of orders archived.
+    """
+    archived = 0
+    while True:
+        order_ids = [row.id for row in db.execute(
+            select(OrderModel.id)
+            .where(OrderModel.status.in_(CLOSED_STATUSES), OrderModel.created_at < older_than)
+            .order_by(OrderModel.created_at)
+            .limit(batch_size)
+        )]
+        if not order_ids:
+            break
+
+        archived_at = datetime.utcnow()
+        db.execute(insert(ArchivedOrderModel).from_select(
+            ORDER_COLUMNS + ["archived_at"],
+            select(*[getattr(OrderModel, c) for c in ORDER_COLUMNS], literal(archived_at))
+            .where(OrderModel.id.in_(order_ids)),
+        ))
+        db.execute(insert(ArchivedOrderItemModel).from_select(
+            ITEM_COLUMNS,
+            select(*[getattr(OrderItemModel, c) for c in ITEM_COLUMNS])
+            .where(OrderItemModel.order_id.in_(order_ids)),
+        ))
+        db.execute(delete(OrderItemModel).where(OrderItemModel.order_id.in_(order_ids)))
+        db.execute(delete(OrderModel).where(OrderModel.id.in_(order_ids)))
+        db.commit()
+        archived += len(order_ids)
+
+        if len(order_ids) < batch_size:
+            break
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move closed orders to the archive tables")
+    parser.add_argument("--after-days", type=int, default=ORDER_ARCHIVE_AFTER_DAYS,
+                        help="archive closed orders created more than this many days ago")
+    args = parser.parse_args()
+    if args.after_days < 1:
+        parser.error("set --after-days or ORDER_ARCHIVE_AFTER_DAYS to at least 1")
+
+    from app.database import SessionLocal
+    from app.logging_config import configure_logging
+    configure_logging()
+    db = SessionLocal()
+    try:
+        count = archive_closed_orders(db, datetime.utcnow() - timedelta(days=args.after_days))
+    finally:
+        db.close()
+    logger.info("Archived %s closed orders older than %s days", count, args.after_days)
+
+
+if __name__ == "__main__":
+    main()
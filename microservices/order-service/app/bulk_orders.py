@@ -0,0 +1,399 @@
+"""Bulk order import (POST /orders/bulk).
+
+The body is NDJSON, one OrderCreate per line, read as it streams in. The
+import then runs in three steps:
+
+1. Stock is reserved once per product for the quantity summed over the
+   whole batch, instead of once per item. A product whose combined
+   reservation is refused for lack of stock is retried one record at a
+   time in file order, so records are accepted first come, first served
+   until its stock runs out.
+2. Records that got every product they need are inserted in chunks of
+   BULK_ORDER_CHUNK_SIZE, one transaction per chunk (see
+   routes.create_orders).
+3. Stock held for records that were rejected, or whose chunk failed to
+   insert, is released again right away, with one call per product. The
+   same happens when the client disconnects mid-import: whatever is still
+   held is released before the request ends.
+
+Stock calls answered with 429 or 5xx are retried, after the Retry-After
+the product service asked for or an exponential backoff. A release that
+still fails is written to the pending_stock_releases table and retried
+in the background by run_release_retrier until it goes through.
+
+Results stream back as NDJSON, one object per input line
+({"line", "status", ...} with status created, invalid, rejected or
+failed), then a final {"summary": {...}} object.
+"""
+import asyncio
+import json
+import os
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+import httpx
+from pydantic import ValidationError
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import clients, rpc_client, tracing
+from app.models import OrderCreate, PendingStockReleaseModel
+from app.routes import create_orders
+
+logger = logging.getLogger(__name__)
+
+# Records accepted in one bulk request
+BULK_ORDER_MAX_RECORDS = int(os.getenv("BULK_ORDER_MAX_RECORDS", "50000"))
+# Orders inserted per transaction
+BULK_ORDER_CHUNK_SIZE = int(os.getenv("BULK_ORDER_CHUNK_SIZE", "500"))
+# Concurrent reserve/release calls to the product service
+BULK_ORDER_RESERVE_CONCURRENCY = int(os.getenv("BULK_ORDER_RESERVE_CONCURRENCY", "16"))
+# Retries of a stock call answered with 429 or 5xx, and the longest wait between them
+BULK_ORDER_STOCK_RETRIES = int(os.getenv("BULK_ORDER_STOCK_RETRIES", "4"))
+BULK_ORDER_RETRY_BACKOFF_SECONDS = float(os.getenv("BULK_ORDER_RETRY_BACKOFF_SECONDS", "0.2"))
+BULK_ORDER_RETRY_MAX_SECONDS = float(os.getenv("BULK_ORDER_RETRY_MAX_SECONDS", "10"))
+# How often queued releases are retried, and after how long a claim by a dead worker lapses
+BULK_ORDER_RELEASE_RETRY_SECONDS = float(os.getenv("BULK_ORDER_RELEASE_RETRY_SECONDS", "60"))
+BULK_ORDER_RELEASE_CLAIM_SECONDS = float(os.getenv("BULK_ORDER_RELEASE_CLAIM_SECONDS", "300"))
+
+
+class TooManyRecords(Exception):
+    pass
+
+
+class BulkRecord:
+    """One input line and what has happened to it so far."""
+
+    __slots__ = ("line", "order", "held", "result")
+
+    def __init__(self, line: int, order: Optional[OrderCreate] = None, result: Optional[dict] = None):
+        self.line = line
+        self.order = order
+        # product_id -> quantity reserved for this record
+        self.held: Dict[int, int] = {}
+        self.result = result
+
+    def quantities(self) -> Dict[int, int]:
+        totals = defaultdict(int)
+        for item in self.order.items:
+            totals[item.product_id] += item.quantity
+        return totals
+
+    def reject(self, detail: str):
+        if self.result is None:
+            self.result = {"line": self.line, "status": "rejected", "detail": detail}
+
+
+async def read_records(chunks: AsyncIterator[bytes], max_records: int = BULK_ORDER_MAX_RECORDS) -> List[BulkRecord]:
+    """Parse an NDJSON body as it streams; blank lines are skipped, bad lines become invalid results."""
+    records = []
+    line_no = 0
+    buffer = b""
+
+    def parse(raw: bytes):
+        nonlocal line_no
+        line_no += 1
+        if not raw.strip():
+            return
+        if len(records) >= max_records:
+            raise TooManyRecords()
+        try:
+            records.append(BulkRecord(line_no, OrderCreate.parse_raw(raw)))
+        except ValidationError as e:
+            records.append(BulkRecord(line_no, result={
+                "line": line_no, "status": "invalid", "detail": json.loads(e.json())
+            }))
+        except ValueError as e:
+            records.append(BulkRecord(line_no, result={"line": line_no, "status": "invalid", "detail": str(e)}))
+
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            parse(raw)
+    if buffer:
+        parse(buffer)
+    return records
+
+
+async def _send_stock_call(client: httpx.AsyncClient, product_service_url: str, action: str,
+                           product_id: int, quantity: int):
+    rpc = rpc_client.get_rpc_client()
+    try:
+        with tracing.span(f"product_service.{action}", product_id=product_id, quantity=quantity):
+            if rpc is not None:
+                call = rpc.reserve if action == "reserve" else rpc.release
+                return await call(product_id, quantity)
+            return await client.post(
+                f"{product_service_url}/products/{product_id}/{action}",
+                params={"quantity": quantity},
+                headers=tracing.inject_headers(clients.service_headers()),
+            )
+    except (httpx.RequestError, rpc_client.RpcUnavailable) as e:
+        logger.error("Error connecting to product service: %s", e)
+        return None
+
+
+def _retryable(response) -> bool:
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+
+def _retry_delay(response, attempt: int) -> float:
+    """The wait the product service asked for in Retry-After, else exponential backoff."""
+    retry_after = getattr(response, "headers", {}).get("retry-after")
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = BULK_ORDER_RETRY_BACKOFF_SECONDS * 2 ** attempt
+    return min(max(delay, 0.0), BULK_ORDER_RETRY_MAX_SECONDS)
+
+
+async def _stock_call(client: httpx.AsyncClient, product_service_url: str, action: str,
+                      product_id: int, quantity: int, limiter: asyncio.Semaphore,
+                      retries: int = BULK_ORDER_STOCK_RETRIES):
+    """Reserve or release stock over RPC (if configured) or POST /products/{id}/{action}.
+
+    Answers of 429 and 5xx are retried up to `retries` times. Returns the
+    last response, or None if the product service is unreachable.
+    """
+    for attempt in range(retries + 1):
+        async with limiter:
+            response = await _send_stock_call(client, product_service_url, action, product_id, quantity)
+        if attempt == retries or not _retryable(response):
+            return response
+        delay = _retry_delay(response, attempt)
+        logger.warning("Product service answered %s to %s of product ID: %s, retrying in %.1fs",
+                       response.status_code, action, product_id, delay)
+        # Wait outside the limiter so other products' calls can go ahead
+        await asyncio.sleep(delay)
+
+
+async def reserve_stock(client: httpx.AsyncClient, product_service_url: str, records: List[BulkRecord],
+                        concurrency: int = BULK_ORDER_RESERVE_CONCURRENCY):
+    """Reserve stock for valid records, rejecting those that cannot get all of their products."""
+    limiter = asyncio.Semaphore(concurrency)
+    pending = [r for r in records if r.result is None]
+    by_product = defaultdict(list)
+    for record in pending:
+        for product_id, quantity in record.quantities().items():
+            by_product[product_id].append((record, quantity))
+
+    short = set()
+
+    async def reserve_combined(product_id: int):
+        entries = by_product[product_id]
+        response = await _stock_call(
+            client, product_service_url, "reserve", product_id, sum(q for _, q in entries), limiter
+        )
+        # Recorded as soon as it is known, so a cancelled import still releases it
+        if response is not None and response.status_code == 200:
+            for record, quantity in entries:
+                record.held[product_id] = quantity
+        elif response is not None and response.status_code == 400:
+            short.add(product_id)
+        else:
+            detail = "Product service unavailable" if response is None else response.text
+            for record, _ in entries:
+                record.reject(f"Failed to reserve product {product_id}: {detail}")
+
+    await asyncio.gather(*[reserve_combined(product_id) for product_id in by_product])
+
+    # Not enough stock for the whole batch: hand out what there is, record by record
+    for product_id in by_product:
+        if product_id not in short:
+            continue
+        for record, quantity in by_product[product_id]:
+            if record.result is not None:
+                continue
+            response = await _stock_call(client, product_service_url, "reserve", product_id, quantity, limiter)
+            if response is not None and response.status_code == 200:
+                record.held[product_id] = quantity
+            else:
+                detail = "Product service unavailable" if response is None else response.text
+                record.reject(f"Failed to reserve product {product_id}: {detail}")
+
+
+async def release_stock(client: httpx.AsyncClient, product_service_url: str, records: List[BulkRecord],
+                        db: Session, concurrency: int = BULK_ORDER_RESERVE_CONCURRENCY):
+    """Give back stock held by records that did not become orders.
+
+    Releases that keep failing are queued in pending_stock_releases.
+    """
+    limiter = asyncio.Semaphore(concurrency)
+    totals = defaultdict(int)
+    for record in records:
+        for product_id, quantity in record.held.items():
+            totals[product_id] += quantity
+        record.held = {}
+    responses = await asyncio.gather(*[
+        _stock_call(client, product_service_url, "release", pid, quantity, limiter)
+        for pid, quantity in totals.items()
+    ])
+    failed = []
+    for (product_id, quantity), response in zip(totals.items(), responses):
+        if response is None or _retryable(response):
+            failed.append((product_id, quantity))
+        elif response.status_code != 200:
+            # Refused outright (e.g. the product is gone); retrying would not help
+            logger.error("Product service refused release of %s units of product ID: %s: %s",
+                         quantity, product_id, response.text)
+    if failed:
+        try:
+            await run_in_threadpool(queue_releases, db, failed)
+        except Exception as e:
+            logger.error("Could not queue %s failed stock releases, reconcile by hand: %s %s", len(failed), failed, e)
+
+
+def queue_releases(db: Session, releases: List[Tuple[int, int]]):
+    """Store (product_id, quantity) releases for run_release_retrier."""
+    db.add_all([PendingStockReleaseModel(product_id=pid, quantity=quantity) for pid, quantity in releases])
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.warning("Queued %s stock releases for retry", len(releases))
+
+
+def claim_pending_releases(db: Session, limit: int = 100,
+                           claim_seconds: float = BULK_ORDER_RELEASE_CLAIM_SECONDS) -> List[PendingStockReleaseModel]:
+    """Claim up to `limit` queued releases that no other worker is retrying."""
+    now = datetime.utcnow()
+    claimable = or_(
+        PendingStockReleaseModel.claimed_at.is_(None),
+        PendingStockReleaseModel.claimed_at < now - timedelta(seconds=claim_seconds),
+    )
+    candidates = db.execute(
+        select(PendingStockReleaseModel.id).where(claimable).order_by(PendingStockReleaseModel.id).limit(limit)
+    ).scalars().all()
+    claimed = []
+    try:
+        for release_id in candidates:
+            # Only one worker's UPDATE matches while the row is still unclaimed
+            result = db.execute(update(PendingStockReleaseModel).where(
+                PendingStockReleaseModel.id == release_id, claimable
+            ).values(claimed_at=now))
+            if result.rowcount == 1:
+                claimed.append(release_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if not claimed:
+        return []
+    return db.execute(
+        select(PendingStockReleaseModel).where(PendingStockReleaseModel.id.in_(claimed))
+    ).scalars().all()
+
+
+def settle_releases(db: Session, done: List[int], failed: List[int]):
+    """Drop released rows and put failed ones back in the queue."""
+    try:
+        if done:
+            db.execute(delete(PendingStockReleaseModel).where(PendingStockReleaseModel.id.in_(done)))
+        if failed:
+            db.execute(update(PendingStockReleaseModel).where(PendingStockReleaseModel.id.in_(failed)).values(
+                claimed_at=None, attempts=PendingStockReleaseModel.attempts + 1
+            ))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+async def retry_pending_releases(db: Session, client: httpx.AsyncClient, product_service_url: str,
+                                 limit: int = 100, concurrency: int = BULK_ORDER_RESERVE_CONCURRENCY) -> int:
+    """Send one batch of queued releases; returns how many went through."""
+    pending = await run_in_threadpool(claim_pending_releases, db, limit)
+    if not pending:
+        return 0
+    limiter = asyncio.Semaphore(concurrency)
+    responses = await asyncio.gather(*[
+        _stock_call(client, product_service_url, "release", release.product_id, release.quantity, limiter)
+        for release in pending
+    ])
+    done, failed, released = [], [], 0
+    for release, response in zip(pending, responses):
+        if response is None or _retryable(response):
+            failed.append(release.id)
+            continue
+        if response.status_code == 200:
+            released += 1
+        else:
+            logger.error("Product service refused queued release of %s units of product ID: %s: %s",
+                         release.quantity, release.product_id, response.text)
+        done.append(release.id)
+    await run_in_threadpool(settle_releases, db, done, failed)
+    return released
+
+
+async def run_release_retrier(session_factory, product_service_url: str,
+                              interval: float = BULK_ORDER_RELEASE_RETRY_SECONDS):
+    """Retry queued stock releases every `interval` seconds until cancelled."""
+    while True:
+        db = session_factory()
+        try:
+            released = await retry_pending_releases(db, clients.get_client(), product_service_url)
+            if released:
+                logger.info("Released %s queued stock reservations", released)
+        except Exception as e:
+            logger.error("Retrying queued stock releases failed: %s", e)
+        finally:
+            db.close()
+        await asyncio.sleep(interval)
+
+
+async def import_orders(db: Session, client: httpx.AsyncClient, product_service_url: str,
+                        records: List[BulkRecord], chunk_size: int = BULK_ORDER_CHUNK_SIZE):
+    """Run a parsed import, yielding NDJSON result lines as they are known."""
+    counts = defaultdict(int)
+
+    def emit(record: BulkRecord) -> bytes:
+        counts[record.result["status"]] += 1
+        return (json.dumps(record.result) + "\n").encode()
+
+    for record in records:
+        if record.result is not None:
+            yield emit(record)
+
+    try:
+        await reserve_stock(client, product_service_url, records)
+        await release_stock(client, product_service_url, [r for r in records if r.result is not None], db)
+        for record in records:
+            if record.result is not None and record.result["status"] == "rejected":
+                yield emit(record)
+
+        accepted = [r for r in records if r.result is None]
+        for start in range(0, len(accepted), chunk_size):
+            chunk = accepted[start:start + chunk_size]
+            try:
+                with tracing.span("orders.bulk_insert", orders=len(chunk)):
+                    # Let the insert finish even if the client leaves, so we know which stock to release
+                    with anyio.CancelScope(shield=True):
+                        order_ids = await run_in_threadpool(create_orders, db, [r.order for r in chunk])
+            except Exception as e:
+                logger.error("Bulk order chunk of %s failed: %s", len(chunk), e)
+                for record in chunk:
+                    record.result = {"line": record.line, "status": "failed", "detail": "Could not save order"}
+                await release_stock(client, product_service_url, chunk, db)
+            else:
+                for record, order_id in zip(chunk, order_ids):
+                    record.result = {"line": record.line, "status": "created", "order_id": order_id}
+                    record.held = {}
+            for record in chunk:
+                yield emit(record)
+
+        yield (json.dumps({"summary": {
+            status: counts[status] for status in ("created", "invalid", "rejected", "failed")
+        }}) + "\n").encode()
+    finally:
+        # Records still holding stock were never saved: the client went away or the import failed
+        unsaved = [r for r in records if r.held]
+        if unsaved:
+            logger.warning("Bulk import stopped early, releasing stock held for %s records", len(unsaved))
+            with anyio.CancelScope(shield=True):
+                await release_stock(client, product_service_url, unsaved, db)
@@ -0,0 +1,51 @@
+"""Shared outbound HTTP client.
+
+One httpx.AsyncClient per worker process, so calls to OPA (and other
+services) reuse pooled keep-alive connections instead of paying for a new
+connection each time. It is created on first use (or by warm-up) and
+closed on shutdown.
+
+Calls to other services carry service_headers(), which identify this
+service to their rate limiter (see app/ratelimit.py).
+"""
+import os
+from typing import Dict, Optional
+
+import httpx
+
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+# Name this service gives itself in X-Service-Id
+SERVICE_ID = os.getenv("SERVICE_ID", "order-service")
+# Shared secret proving the X-Service-Id to other services
+SERVICE_AUTH_TOKEN = os.getenv("SERVICE_AUTH_TOKEN", "")
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+    return _client
+
+
+def service_headers() -> Dict[str, str]:
+    """Identity headers for calls to other services (none without a shared token)."""
+    if not SERVICE_AUTH_TOKEN:
+        return {}
+    return {"X-Service-Id": SERVICE_ID, "X-Service-Token": SERVICE_AUTH_TOKEN}
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,90 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, Optional, Tuple
+import hashlib
+
+from fastapi import Request, Response
+
+# Headers that make a GET conditional; without them there is nothing to validate
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since")
+
+
+def is_conditional(request: Request) -> bool:
+    """Return True if the client sent a validator we can answer with a 304."""
+    return any(header in request.headers for header in CONDITIONAL_HEADERS)
+
+
+def make_etag(*parts) -> str:
+    """Build a strong ETag from the given parts."""
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def resource_validators(resource_id: int, updated_at: Optional[datetime], *salt) -> Tuple[str, Optional[datetime]]:
+    """ETag and Last-Modified for a single resource, derived from id and updated_at.
+
+    `salt` distinguishes different representations of the same resource.
+    """
+    return make_etag(resource_id, _timestamp(updated_at), *salt), updated_at
+
+
+def page_validators(keys: Iterable[Tuple[int, Optional[datetime]]], *salt) -> Tuple[str, Optional[datetime]]:
+    """ETag and Last-Modified for a page of resources.
+
+    `keys` are (id, updated_at) pairs; `salt` distinguishes otherwise identical
+    pages requested with different parameters.
+    """
+    digest = hashlib.sha1("|".join(str(part) for part in salt).encode())
+    last_modified = None
+    for resource_id, updated_at in keys:
+        digest.update(f";{resource_id}@{_timestamp(updated_at)}".encode())
+        if updated_at is not None and (last_modified is None or updated_at > last_modified):
+            last_modified = updated_at
+    return f'"{digest.hexdigest()[:20]}"', last_modified
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since as described in RFC 7232."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence; If-Modified-Since is ignored when present
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in candidates or any(_strip_weak(tag) == etag for tag in candidates)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return _as_utc(last_modified).replace(microsecond=0) <= since
+    return False
+
+
+def set_validators(response: Response, etag: str, last_modified: Optional[datetime]):
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+
+
+def not_modified_response(etag: str, last_modified: Optional[datetime]) -> Response:
+    response = Response(status_code=304)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def _strip_weak(tag: str) -> str:
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Timestamps are stored as naive UTC (datetime.utcnow)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _timestamp(value: Optional[datetime]) -> str:
+    return value.isoformat() if value is not None else ""
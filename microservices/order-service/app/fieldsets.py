@@ -0,0 +1,66 @@
+"""Sparse fieldsets: ?fields=id,name,price on read endpoints.
+
+The requested fields are pushed down to the query with load_only, so
+other columns are never SELECTed, and relationships such as order items
+are only loaded when they are asked for. The response is built from
+those fields alone and returned as JSON directly, skipping response_model
+validation of full objects.
+
+`id` and `updated_at` are always loaded because the conditional-request
+validators are derived from them; they are only returned if requested.
+"""
+from typing import List, Optional, Sequence
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import load_only, selectinload
+
+# Columns every query loads, whatever the fieldset
+ALWAYS_LOADED = ("id", "updated_at")
+
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str]) -> Optional[List[str]]:
+    """Parse a comma-separated fieldset; None means every field."""
+    if fields is None:
+        return None
+    requested = list(dict.fromkeys(part.strip() for part in fields.split(",") if part.strip()))
+    unknown = [name for name in requested if name not in allowed]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown) or '(none given)'}. Allowed: {', '.join(allowed)}"
+        )
+    return requested
+
+
+def query_options(model, fields: Optional[List[str]], relationships: Sequence[str] = ()) -> list:
+    """Loader options that SELECT only the columns and relationships in `fields`."""
+    if fields is None:
+        return [selectinload(getattr(model, name)) for name in relationships]
+    columns = [name for name in dict.fromkeys((*ALWAYS_LOADED, *fields)) if name not in relationships]
+    options = [load_only(*[getattr(model, name) for name in columns])]
+    options.extend(selectinload(getattr(model, name)) for name in relationships if name in fields)
+    return options
+
+
+def fields_salt(fields: Optional[List[str]]) -> tuple:
+    """ETag salt telling representations with different fieldsets apart (empty for full ones)."""
+    return () if fields is None else ("fields", ",".join(fields))
+
+
+def sparse(obj, fields: List[str], nested: Optional[dict] = None) -> dict:
+    """The requested fields of `obj`; `nested` maps relationships to the schema their rows are read with."""
+    nested = nested or {}
+    content = {}
+    for name in fields:
+        value = getattr(obj, name)
+        if name in nested:
+            value = [nested[name].from_orm(row) for row in value]
+        content[name] = value
+    return content
+
+
+def sparse_response(content, response: Response) -> JSONResponse:
+    """JSON response for already-sparse content, keeping headers set on `response`."""
+    return JSONResponse(jsonable_encoder(content), headers=dict(response.headers))
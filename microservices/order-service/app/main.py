@@ -1,24 +1,30 @@
+import asyncio
 import os
 from app.routes import internal_router
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx
 import logging
 from typing import List, Optional
 import uvicorn
-from app.models import Order, OrderCreate, OrderUpdate, OrderItem
-from app.database import init_db, get_db, SessionLocal
+from app.models import Order, OrderCreate, OrderUpdate, OrderItem, OrderStatusBulkUpdate, OrderStatusBulkResult
+from app.database import init_db, get_db, get_read_db, SessionLocal, router
+from app import conditional, fieldsets
+from app.logging_config import configure_logging
+from app import tracing
+from app.ratelimit import rate_limit
+from app import clients, debug, pool, rpc_client, sqlstats, warmup
+from app import bulk_orders
 from sqlalchemy.orm import Session
 import time
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# Configure logging (JSON lines written by a background thread, see app/logging_config.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Order Service API", version="0.1.0")
+# Rate limiting runs before any route dependency, so shed requests skip OPA and the DB
+app = FastAPI(title="Order Service API", version="0.1.0", dependencies=[Depends(rate_limit)])
 
 # CORS Middleware
 app.add_middleware(
@@ -29,10 +35,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in per-request profiling; must sit inside the timing middleware below
+# so the endpoint runs in the task it samples
+app.add_middleware(debug.RequestProfilingMiddleware)
+
 # OPA endpoint
 OPA_URL = os.getenv("OPA_URL", "http://opa.default.svc.cluster.local:8181/v1/data/orderservice/allow")
 # Product service endpoint
 PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://product-service.default.svc.cluster.local:8000")
+# Maximum number of orders in one bulk status update
+BULK_STATUS_MAX_ORDERS = int(os.getenv("BULK_STATUS_MAX_ORDERS", "10000"))
+# Fields that can be requested with ?fields= (items are only loaded when listed)
+ORDER_FIELDS = list(Order.__fields__)
 
 # Middleware for request timing (useful for monitoring)
 @app.middleware("http")
@@ -43,6 +57,10 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
+# Root span per request; registered after the timing middleware so it wraps it
+app.add_middleware(tracing.TracingMiddleware)
+tracing.instrument_serialization()
+
 # Dependency to check OPA policies
 async def check_policy(request: Request):
     # Skip OPA check during healthcheck
@@ -63,18 +81,20 @@ async def check_policy(request: Request):
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(OPA_URL, json=input_data)
-            if response.status_code != 200:
-                logger.error(f"OPA service error: {response.text}")
-                raise HTTPException(status_code=403, detail="Policy check failed")
+        # Shared client: keeps the connection to OPA open between requests
+        client = clients.get_client()
+        with tracing.span("opa.check", path=path):
+            response = await client.post(OPA_URL, json=input_data, headers=tracing.inject_headers())
+        if response.status_code != 200:
+            logger.error("OPA service error: %s", response.text)
+            raise HTTPException(status_code=403, detail="Policy check failed")
+        
+        result = response.json()
+        if not result.get("result", False):
+            raise HTTPException(status_code=403, detail="Request denied by policy")
             
-            result = response.json()
-            if not result.get("result", False):
-                raise HTTPException(status_code=403, detail="Request denied by policy")
-                
     except httpx.RequestError as e:
-        logger.error(f"Error connecting to OPA: {e}")
+        logger.error("Error connecting to OPA: %s", e)
         # In case OPA is unreachable, we could define a fallback policy
         # For now, we'll allow the request to proceed to avoid blocking legitimate traffic
         logger.warning("OPA unreachable, applying fallback policy (allow request)")
@@ -87,30 +107,123 @@ async def check_policy(request: Request):
 async def startup_event():
     await init_db()
     logger.info("Database initialized")
+    # Retries stock releases that bulk imports could not complete (app/bulk_orders.py)
+    app.state.release_retrier = asyncio.create_task(
+        bulk_orders.run_release_retrier(SessionLocal, PRODUCT_SERVICE_URL)
+    )
+    debug.start_continuous_profiler()
+    # Health-checks idle DB connections and logs sizing advice under pressure (app/pool.py)
+    app.state.pool_manager = asyncio.create_task(pool.run_pool_manager())
+    if warmup.WARMUP_ENABLED:
+        # Awaited: the worker only accepts connections after startup, so none reach it cold
+        await start_warmup()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for name in ("release_retrier", "pool_manager"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+    debug.stop_continuous_profiler()
+    await clients.close_client()
+    await rpc_client.close_rpc_client()
+
+async def start_warmup():
+    from app import routes
+    await warmup.warm_up(
+        engines=[router.primary, *router.readers],
+        session_factory=SessionLocal,
+        queries={
+            "orders": lambda db: routes.get_orders(db),
+            "order_page_keys": lambda db: routes.get_order_page_keys(db),
+            "customer_orders": lambda db: routes.get_customer_orders(db, "warmup"),
+        },
+        response_types={"orders": List[Order], "customer_orders": List[Order]},
+        urls=[warmup.health_url(OPA_URL), f"{PRODUCT_SERVICE_URL}/health"],
+    )
+
+def sparse_orders(orders, field_list: Optional[List[str]], response: Response):
+    """Orders as returned by list endpoints: full models, or only the fields asked for"""
+    if field_list is None:
+        return orders
+    return fieldsets.sparse_response(
+        [fieldsets.sparse(order, field_list, {"items": OrderItem}) for order in orders], response
+    )
 
 # Routes
 @app.get("/health")
 def health_check():
     return {"status": "healthy", "service": "order-service"}
 
+# Readiness probe: workers only serve once warmed up (app/warmup.py); 503 if this one is not
+@app.get("/ready")
+def readiness_check():
+    if not warmup.state.ready:
+        return JSONResponse(status_code=503, content={"status": "warming up", "service": "order-service"})
+    return {
+        "status": "ready",
+        "service": "order-service",
+        "warmup_seconds": warmup.state.seconds,
+        "warmup_failures": warmup.state.failures,
+    }
+
+# Prometheus scrape target (see kubernetes/monitoring/service-monitors.yaml); per worker process
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(sqlstats.stats.prometheus() + pool.prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/orders", response_model=List[Order])
 async def get_orders(
+    request: Request,
+    response: Response,
     skip: int = 0, 
     limit: int = 100,
-    db: Session = Depends(get_db),
+    include_archived: bool = False,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     _: bool = Depends(check_policy)
 ):
-    from app.routes import get_orders as get_orders_route
-    return get_orders_route(db, skip, limit)
+    from app.routes import get_orders as get_orders_route, get_order_page_keys
+    field_list = fieldsets.parse_fields(fields, ORDER_FIELDS)
+    salt = ("page", skip, limit, include_archived) + fieldsets.fields_salt(field_list)
+    if conditional.is_conditional(request):
+        etag, last_modified = conditional.page_validators(
+            get_order_page_keys(db, skip, limit, include_archived), *salt
+        )
+        if conditional.is_not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+    orders = get_orders_route(db, skip, limit, include_archived, field_list)
+    etag, last_modified = conditional.page_validators(((o.id, o.updated_at) for o in orders), *salt)
+    conditional.set_validators(response, etag, last_modified)
+    return sparse_orders(orders, field_list, response)
 
 @app.get("/orders/{order_id}", response_model=Order)
 async def get_order(
     order_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    include_archived: bool = False,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     _: bool = Depends(check_policy)
 ):
-    from app.routes import get_order as get_order_route
-    return get_order_route(db, order_id)
+    from app.routes import get_order as get_order_route, get_order_key
+    field_list = fieldsets.parse_fields(fields, ORDER_FIELDS)
+    salt = fieldsets.fields_salt(field_list)
+    if conditional.is_conditional(request):
+        etag, last_modified = conditional.resource_validators(
+            *get_order_key(db, order_id, include_archived), *salt
+        )
+        if conditional.is_not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+    order = get_order_route(db, order_id, include_archived, field_list)
+    etag, last_modified = conditional.resource_validators(order.id, order.updated_at, *salt)
+    conditional.set_validators(response, etag, last_modified)
+    if field_list is not None:
+        return fieldsets.sparse_response(fieldsets.sparse(order, field_list, {"items": OrderItem}), response)
+    return order
 
 @app.post("/orders", response_model=Order, status_code=201)
 async def create_order(
@@ -118,21 +231,27 @@ async def create_order(
     db: Session = Depends(get_db),
     _: bool = Depends(check_policy)
 ):
-    # Check and reserve product stock with the product service
+    # Check and reserve product stock with the product service (over RPC if PRODUCT_RPC_URL is set)
+    client = clients.get_client()
+    rpc = rpc_client.get_rpc_client()
     for item in order.items:
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{PRODUCT_SERVICE_URL}/products/{item.product_id}/reserve",
-                    params={"quantity": item.quantity}
-                )
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Failed to reserve product {item.product_id}: {response.text}"
+            with tracing.span("product_service.reserve", product_id=item.product_id, quantity=item.quantity):
+                if rpc is not None:
+                    response = await rpc.reserve(item.product_id, item.quantity)
+                else:
+                    response = await client.post(
+                        f"{PRODUCT_SERVICE_URL}/products/{item.product_id}/reserve",
+                        params={"quantity": item.quantity},
+                        headers=tracing.inject_headers(clients.service_headers())
                     )
-        except httpx.RequestError as e:
-            logger.error(f"Error connecting to product service: {e}")
+            if response.status_code != 200:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Failed to reserve product {item.product_id}: {response.text}"
+                )
+        except (httpx.RequestError, rpc_client.RpcUnavailable) as e:
+            logger.error("Error connecting to product service: %s", e)
             raise HTTPException(
                 status_code=503,
                 detail="Product service unavailable, cannot complete order"
@@ -141,6 +260,44 @@ async def create_order(
     from app.routes import create_order as create_order_route
     return create_order_route(db, order)
 
+@app.post("/orders/bulk")
+async def create_orders_bulk(
+    request: Request,
+    db: Session = Depends(get_db),
+    _: bool = Depends(check_policy)
+):
+    """Create many orders from an NDJSON body (one OrderCreate per line).
+
+    Stock is reserved per product for the whole batch and orders are
+    inserted in chunked transactions; results stream back as NDJSON, one
+    line per input record plus a final summary (see app/bulk_orders.py).
+    """
+    try:
+        records = await bulk_orders.read_records(request.stream())
+    except bulk_orders.TooManyRecords:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many orders in one request. Maximum: {bulk_orders.BULK_ORDER_MAX_RECORDS}"
+        )
+
+    results = bulk_orders.import_orders(db, clients.get_client(), PRODUCT_SERVICE_URL, records)
+    return StreamingResponse(results, media_type="application/x-ndjson")
+
+@app.post("/orders/status/bulk", response_model=OrderStatusBulkResult)
+async def bulk_update_order_status(
+    bulk_update: OrderStatusBulkUpdate,
+    db: Session = Depends(get_db),
+    _: bool = Depends(check_policy)
+):
+    """Move many orders to one status, reporting the outcome per order ID"""
+    if len(bulk_update.order_ids) > BULK_STATUS_MAX_ORDERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many orders in one request. Requested: {len(bulk_update.order_ids)}, Maximum: {BULK_STATUS_MAX_ORDERS}"
+        )
+    from app.routes import bulk_update_order_status as bulk_update_order_status_route
+    return bulk_update_order_status_route(db, bulk_update.order_ids, bulk_update.status)
+
 @app.put("/orders/{order_id}", response_model=Order)
 async def update_order(
     order_id: int,
@@ -163,13 +320,33 @@ async def cancel_order(
 @app.get("/orders/customer/{customer_id}", response_model=List[Order])
 async def get_customer_orders(
     customer_id: str,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    include_archived: bool = False,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     _: bool = Depends(check_policy)
 ):
-    from app.routes import get_customer_orders as get_customer_orders_route
-    return get_customer_orders_route(db, customer_id)
+    from app.routes import get_customer_orders as get_customer_orders_route, get_customer_order_keys
+    field_list = fieldsets.parse_fields(fields, ORDER_FIELDS)
+    salt = ("customer", customer_id, skip, limit, include_archived) + fieldsets.fields_salt(field_list)
+    if conditional.is_conditional(request):
+        etag, last_modified = conditional.page_validators(
+            get_customer_order_keys(db, customer_id, skip, limit, include_archived), *salt
+        )
+        if conditional.is_not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+    orders = get_customer_orders_route(db, customer_id, skip, limit, include_archived, field_list)
+    etag, last_modified = conditional.page_validators(((o.id, o.updated_at) for o in orders), *salt)
+    conditional.set_validators(response, etag, last_modified)
+    return sparse_orders(orders, field_list, response)
 
 app.include_router(internal_router, prefix="/internal", tags=["internal"])
+app.include_router(debug.debug_router, prefix="/debug", tags=["debug"])
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Development server only; production runs `python -m app.server`
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, Field, validator
 from datetime import datetime
 from typing import List, Optional
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import enum
@@ -21,7 +21,7 @@ class OrderItemModel(Base):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"))
+    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), index=True)
     product_id = Column(Integer, index=True)
     quantity = Column(Integer)
     unit_price = Column(Float)
@@ -43,6 +43,57 @@ class OrderModel(Base):
     # Relationship to order items
     items = relationship("OrderItemModel", back_populates="order", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # A customer's orders, most recent first
+        Index("ix_orders_customer_id_created_at", "customer_id", "created_at"),
+        # Closed orders by age, for the archiver
+        Index("ix_orders_status_created_at", "status", "created_at"),
+    )
+
+# Archive tables: closed orders moved out of the hot tables by app.archiver.
+# Rows keep their original IDs, so an order is found in exactly one place.
+class ArchivedOrderItemModel(Base):
+    __tablename__ = "order_items_archive"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders_archive.id", ondelete="CASCADE"), index=True)
+    product_id = Column(Integer)
+    quantity = Column(Integer)
+    unit_price = Column(Float)
+
+    order = relationship("ArchivedOrderModel", back_populates="items")
+
+class ArchivedOrderModel(Base):
+    __tablename__ = "orders_archive"
+
+    id = Column(Integer, primary_key=True)
+    customer_id = Column(String, index=True)
+    status = Column(String)
+    total_amount = Column(Float)
+    shipping_address = Column(String)
+    created_at = Column(DateTime, index=True)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    items = relationship("ArchivedOrderItemModel", back_populates="order", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_orders_archive_customer_id_created_at", "customer_id", "created_at"),
+    )
+
+# Stock that a bulk import reserved but could not give back (see app.bulk_orders);
+# retried in the background until product-service accepts the release.
+class PendingStockReleaseModel(Base):
+    __tablename__ = "pending_stock_releases"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer)
+    quantity = Column(Integer)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set while a worker is retrying the release, so two workers never send it twice
+    claimed_at = Column(DateTime, nullable=True)
+
 # Pydantic models for API
 class OrderItemBase(BaseModel):
     product_id: int
@@ -85,4 +136,18 @@ class Order(OrderBase):
     updated_at: datetime
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class OrderStatusBulkUpdate(BaseModel):
+    order_ids: List[int] = Field(..., min_items=1)
+    status: OrderStatus
+
+class OrderStatusResult(BaseModel):
+    order_id: int
+    result: str  # "updated", "unchanged", "rejected" or "not_found"
+    detail: Optional[str] = None
+
+class OrderStatusBulkResult(BaseModel):
+    status: OrderStatus
+    updated: int
+    results: List[OrderStatusResult]
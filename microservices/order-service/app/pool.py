@@ -0,0 +1,379 @@
+"""Database connection pools: sizing, health checking and metrics.
+
+Sizing. A pod may hold DB_CONNECTION_BUDGET connections to a database
+host, shared by its workers and, with follower reads, by the primary and
+read pools each worker opens to the same host (app.server splits it and
+runs no more workers than the budget can give a connection each). With
+DB_CLUSTER_CONNECTION_BUDGET set, the per-pod budget is also capped at
+that cluster budget divided by DB_MAX_REPLICAS (the KEDA maxReplicaCount),
+so a full scale-out still fits within what the host allows.
+
+Health checking. Connections are not pinged on every checkout. Instead a
+connection that has sat idle for DB_POOL_CHECK_SECONDS is pinged before
+use, and a background task (run_pool_manager) walks the idle connections
+every DB_POOL_CHECK_SECONDS so the ping rarely happens on a request. A
+dead connection is replaced transparently. The walk's own checkouts are
+not counted in the metrics. DB_POOL_PRE_PING=true restores
+SQLAlchemy's ping on every checkout.
+
+Metrics. Every checkout records how long it waited for a connection
+(including opening a new one) and whether it needed overflow; every
+checkin records how long the connection was held. They are served at
+/debug/pool and /metrics (per worker process, with a `worker` label as in
+app/sqlstats.py, and a `pool` label: "primary", or "read" for the read
+engines of app.database, which may share the primary's host). When checkouts keep waiting longer than
+DB_POOL_WAIT_WARN_MS, or time out, for DB_POOL_PRESSURE_CHECKS checks in a
+row, a sizing recommendation is logged.
+"""
+import asyncio
+import math
+import os
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Connections one pod may hold open to a database host, shared by all of its workers
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "15"))
+# Connections all replicas together may hold open to a database host (0: no cluster-wide limit)
+DB_CLUSTER_CONNECTION_BUDGET = int(os.getenv("DB_CLUSTER_CONNECTION_BUDGET", "0"))
+# Most replicas the autoscaler may run (keep in sync with maxReplicaCount in kubernetes/keda)
+DB_MAX_REPLICAS = int(os.getenv("DB_MAX_REPLICAS", "5"))
+# Ping on every checkout instead of relying on the background health check
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+# Idle connections are health-checked this often, and pinged before use once idle this long
+DB_POOL_CHECK_SECONDS = float(os.getenv("DB_POOL_CHECK_SECONDS", "30"))
+# Checkout wait (p95 per check interval) that counts as pool pressure
+DB_POOL_WAIT_WARN_MS = float(os.getenv("DB_POOL_WAIT_WARN_MS", "50"))
+# Consecutive intervals under pressure before a sizing recommendation is logged
+DB_POOL_PRESSURE_CHECKS = int(os.getenv("DB_POOL_PRESSURE_CHECKS", "3"))
+# Recent waits and hold times kept for percentiles
+DB_POOL_SAMPLES = int(os.getenv("DB_POOL_SAMPLES", "1024"))
+
+# Engines created by create_pooled_engine, for the health check and metrics
+engines: List[Engine] = []
+
+
+def replica_budget(per_replica: int = DB_CONNECTION_BUDGET, cluster: int = DB_CLUSTER_CONNECTION_BUDGET,
+                   max_replicas: int = DB_MAX_REPLICAS) -> int:
+    """Connections one pod may hold to a host, within both the per-pod and the cluster budget."""
+    if cluster > 0 and max_replicas > 0:
+        return max(1, min(per_replica, cluster // max_replicas))
+    return per_replica
+
+
+def max_workers(budget: Optional[int] = None, pools: int = 1) -> int:
+    """Most workers the budget can hold when each opens `pools` pools of at least one connection to a host."""
+    budget = replica_budget() if budget is None else budget
+    return max(1, budget // pools)
+
+
+def pool_sizes(workers: int, budget: Optional[int] = None, pools: int = 1) -> Tuple[int, int]:
+    """Split the pod's connection budget into a per-pool (pool_size, max_overflow).
+
+    Each of `workers` workers opens `pools` pools to the same host. Keeps
+    the 1:2 ratio between steady and overflow connections that the
+    single-process defaults (5 + 10) use. Every pool holds at least one
+    connection, so more pools than the budget would exceed it: that raises
+    ValueError (app.server caps the worker count with max_workers first).
+    """
+    budget = replica_budget() if budget is None else budget
+    if workers * pools > budget:
+        raise ValueError(f"{workers} workers with {pools} pools each need more than the {budget} "
+                         f"connections DB_CONNECTION_BUDGET allows per pod")
+    per_pool = budget // (workers * pools)
+    pool_size = max(1, math.ceil(per_pool / 3))
+    return pool_size, per_pool - pool_size
+
+
+def _host(engine: Engine) -> str:
+    return engine.url.host or engine.url.database or ""
+
+
+def _p95(samples) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class PoolMetrics:
+    """Checkout and hold timings of one pool, since start and for the current check interval."""
+
+    def __init__(self, samples: int = DB_POOL_SAMPLES):
+        self._lock = threading.Lock()
+        # Set per thread while the health check walks the pool
+        self._local = threading.local()
+        # "primary" or "read", set by create_pooled_engine
+        self.role = "primary"
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.held_seconds = 0.0
+        self.invalidated = 0
+        self.peak_checked_out = 0
+        self._waits = deque(maxlen=samples)
+        self._held = deque(maxlen=samples)
+        self._window = self._new_window(samples)
+        self.pressure_streak = 0
+        self.last_recommendation: Optional[str] = None
+
+    @property
+    def tracking(self) -> bool:
+        """Whether checkouts on the calling thread are being recorded."""
+        return not getattr(self._local, "untracked", False)
+
+    @contextmanager
+    def untracked(self):
+        """Leave checkouts made by this thread inside the block out of the metrics."""
+        self._local.untracked = True
+        try:
+            yield
+        finally:
+            self._local.untracked = False
+
+    @staticmethod
+    def _new_window(samples: int) -> dict:
+        return {"checkouts": 0, "timeouts": 0, "overflow_checkouts": 0, "peak_checked_out": 0,
+                "waits": deque(maxlen=samples)}
+
+    def record_checkout(self, wait: float, checked_out: int, overflow: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            self._waits.append(wait)
+            self._window["checkouts"] += 1
+            self._window["waits"].append(wait)
+            self._window["peak_checked_out"] = max(self._window["peak_checked_out"], checked_out)
+            if overflow:
+                self.overflow_checkouts += 1
+                self._window["overflow_checkouts"] += 1
+
+    def record_timeout(self, checked_out: int):
+        with self._lock:
+            self.timeouts += 1
+            self._window["timeouts"] += 1
+            self._window["peak_checked_out"] = max(self._window["peak_checked_out"], checked_out)
+
+    def record_held(self, held: float):
+        with self._lock:
+            self.held_seconds += held
+            self._held.append(held)
+
+    def record_invalidated(self):
+        with self._lock:
+            self.invalidated += 1
+
+    def take_window(self) -> dict:
+        """Counters of the interval since the last call, which starts a new interval."""
+        with self._lock:
+            window, self._window = self._window, self._new_window(self._waits.maxlen)
+        waits = window.pop("waits")
+        window["wait_p95_ms"] = _p95(waits) * 1000
+        return window
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits, held = list(self._waits), list(self._held)
+            return {
+                "checkouts": self.checkouts,
+                "overflow_checkouts": self.overflow_checkouts,
+                "timeouts": self.timeouts,
+                "invalidated": self.invalidated,
+                "peak_checked_out": self.peak_checked_out,
+                "wait_seconds_total": self.wait_seconds,
+                "wait_max_ms": self.max_wait_seconds * 1000,
+                "wait_p95_ms": _p95(waits) * 1000,
+                "held_seconds_total": self.held_seconds,
+                "held_mean_ms": sum(held) / len(held) * 1000 if held else 0.0,
+                "held_p95_ms": _p95(held) * 1000,
+                "last_recommendation": self.last_recommendation,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times how long each checkout waits for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        if not self.metrics.tracking:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout(self.checkedout())
+            raise
+        checked_out = self.checkedout()
+        self.metrics.record_checkout(time.perf_counter() - started, checked_out, checked_out > self.size())
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep counting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def track_connections(engine: Engine, stale_seconds: float = DB_POOL_CHECK_SECONDS):
+    """Ping connections idle longer than `stale_seconds` on checkout, and time how long each is held."""
+    metrics = engine.pool.metrics
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        now = time.monotonic()
+        idle_since = connection_record.info.get("pool_idle_since", now)
+        if not DB_POOL_PRE_PING and now - idle_since >= stale_seconds:
+            try:
+                engine.dialect.do_ping(dbapi_connection)
+            except Exception as e:
+                metrics.record_invalidated()
+                # The pool discards the connection and retries with a new one
+                raise exc.DisconnectionError(f"Idle connection failed health check: {e}") from e
+        if metrics.tracking:
+            connection_record.info["pool_checked_out_at"] = now
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        now = time.monotonic()
+        checked_out_at = connection_record.info.pop("pool_checked_out_at", None)
+        if checked_out_at is not None:
+            metrics.record_held(now - checked_out_at)
+        connection_record.info["pool_idle_since"] = now
+
+
+def create_pooled_engine(url: str, pool_size: int, max_overflow: int, role: str = "primary", **kwargs) -> Engine:
+    """create_engine with an instrumented, health-checked pool; `role` labels its metrics."""
+    engine = create_engine(
+        url,
+        poolclass=InstrumentedQueuePool,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        **kwargs,
+    )
+    engine.pool.metrics.role = role
+    track_connections(engine)
+    engines.append(engine)
+    return engine
+
+
+def check_idle_connections(engine: Engine) -> int:
+    """Check out each idle connection once so stale ones are pinged (and replaced) off the request path."""
+    pool = engine.pool
+    checked = 0
+    # The queue is FIFO, so each returned connection goes behind the ones not yet checked
+    with pool.metrics.untracked():
+        for _ in range(pool.checkedin()):
+            if pool.checkedin() == 0:
+                break
+            pool.connect().close()
+            checked += 1
+    return checked
+
+
+def recommendation(engine: Engine, window: dict, budget: Optional[int] = None) -> Optional[str]:
+    """Advice for a pool whose checkouts waited or timed out during `window`, or None."""
+    pool = engine.pool
+    status = pool.metrics.snapshot()
+    capacity = pool.size() + pool._max_overflow
+    host = _host(engine)
+    budget = replica_budget() if budget is None else budget
+    pressure = (f"p95 checkout wait {window['wait_p95_ms']:.1f}ms, {window['timeouts']} timeouts, "
+                f"peak {window['peak_checked_out']}/{capacity} connections")
+    if window["peak_checked_out"] >= capacity:
+        limit = (f"; the cluster budget allows {DB_CLUSTER_CONNECTION_BUDGET // DB_MAX_REPLICAS} per pod"
+                 if DB_CLUSTER_CONNECTION_BUDGET > 0 else "")
+        return (f"Pool for {host} is exhausted ({pressure}, mean hold {status['held_mean_ms']:.1f}ms): "
+                f"raise DB_CONNECTION_BUDGET (now {budget} per pod{limit}), run fewer workers per pod, "
+                f"or hold connections for less time")
+    if window["overflow_checkouts"]:
+        return (f"Pool for {host} keeps opening overflow connections ({pressure}): "
+                f"raise DB_POOL_SIZE from {pool.size()} to {window['peak_checked_out']} "
+                f"so they stay open between requests")
+    return (f"Pool for {host} waits without being exhausted ({pressure}): "
+            f"connections are slow to open or the database is slow to accept them")
+
+
+def evaluate_pressure(engine: Engine) -> Optional[str]:
+    """Close the current metrics interval and log a recommendation after sustained pressure."""
+    metrics = engine.pool.metrics
+    window = metrics.take_window()
+    pressured = window["timeouts"] > 0 or (window["checkouts"] and window["wait_p95_ms"] > DB_POOL_WAIT_WARN_MS)
+    metrics.pressure_streak = metrics.pressure_streak + 1 if pressured else 0
+    if metrics.pressure_streak < DB_POOL_PRESSURE_CHECKS:
+        return None
+    metrics.pressure_streak = 0
+    metrics.last_recommendation = recommendation(engine, window)
+    logger.warning("%s", metrics.last_recommendation)
+    return metrics.last_recommendation
+
+
+async def run_pool_manager(interval: float = DB_POOL_CHECK_SECONDS):
+    """Health-check idle connections and watch for pool pressure every `interval` seconds until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        for engine in engines:
+            try:
+                # Checkouts block; keep them off the event loop
+                await loop.run_in_executor(None, check_idle_connections, engine)
+            except Exception as e:
+                logger.warning("Health check of pool for %s failed: %s", _host(engine), e)
+            evaluate_pressure(engine)
+
+
+def pool_status() -> List[Dict]:
+    """Configuration, state and metrics of every pool, for /debug/pool."""
+    return [
+        {
+            "host": _host(engine),
+            "pool": engine.pool.metrics.role,
+            "pool_size": engine.pool.size(),
+            "max_overflow": engine.pool._max_overflow,
+            "checked_in": engine.pool.checkedin(),
+            "checked_out": engine.pool.checkedout(),
+            "overflow": max(0, engine.pool.overflow()),
+            **engine.pool.metrics.snapshot(),
+        }
+        for engine in engines
+    ]
+
+
+def prometheus() -> str:
+    """Pool gauges and counters in Prometheus text exposition format."""
+    metrics = [
+        ("db_pool_checked_out_connections", "gauge", "Connections in use", "checked_out"),
+        ("db_pool_idle_connections", "gauge", "Connections idle in the pool", "checked_in"),
+        ("db_pool_overflow_connections", "gauge", "Connections open beyond pool_size", "overflow"),
+        ("db_pool_checkouts_total", "counter", "Connection checkouts", "checkouts"),
+        ("db_pool_overflow_checkouts_total", "counter", "Checkouts that needed overflow", "overflow_checkouts"),
+        ("db_pool_timeouts_total", "counter", "Checkouts that timed out waiting", "timeouts"),
+        ("db_pool_invalidated_total", "counter", "Connections that failed a health check", "invalidated"),
+        ("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection", "wait_seconds_total"),
+        ("db_pool_held_seconds_total", "counter", "Time connections were held", "held_seconds_total"),
+    ]
+    pools = pool_status()
+    worker = os.getpid()
+    lines = []
+    for name, kind, help_text, key in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for status in pools:
+            lines.append(f'{name}{{worker="{worker}",pool="{status["pool"]}",host="{status["host"]}"}} {status[key]}')
+    return "\n".join(lines) + "\n"
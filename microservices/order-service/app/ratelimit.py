@@ -0,0 +1,183 @@
+"""Token-bucket rate limiting per caller and route.
+
+Each (caller, route template) pair gets a bucket holding up to
+RATE_LIMIT_BURST tokens, refilled at RATE_LIMIT_RATE tokens per second.
+A request takes one token, or is rejected with 429 and a Retry-After
+telling the caller when the next token is due. The check runs as an
+application-wide dependency, so rejected requests never reach OPA or the
+database.
+
+Callers are told apart by client address (X-Real-IP when the request
+comes through a proxy in RATE_LIMIT_TRUSTED_PROXIES, such as the Nginx
+sidecar, which overwrites that header). The X-Service-Id header is only
+believed together with an X-Service-Token matching SERVICE_AUTH_TOKEN (the
+shared secret of the services in the cluster); such service-to-service
+calls are not limited at all, since every replica of a caller would
+otherwise share one bucket. An X-Service-Id without a valid token is
+ignored, so it cannot be used to pick a fresh bucket or drain another
+service's.
+
+Buckets live in process memory by default. Setting RATE_LIMIT_REDIS_URL
+moves them to Redis so the limit applies across all replicas; this needs
+the optional `redis` package.
+"""
+import hmac
+import math
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "20"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "40"))
+# Upper bound on in-process buckets; the least recently used are evicted first
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Shared secret that internal callers send as X-Service-Token (empty: no caller is trusted)
+SERVICE_AUTH_TOKEN = os.getenv("SERVICE_AUTH_TOKEN", "")
+# Proxies whose X-Real-IP header names the real client
+RATE_LIMIT_TRUSTED_PROXIES = set(filter(None, os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "127.0.0.1,::1").split(",")))
+# Paths that are never limited (probes and metrics scrapes)
+EXEMPT_PATHS = {"/health", "/ready", "/metrics"}
+
+
+class InProcessBackend:
+    """Buckets stored in an LRU dict, local to this process."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, rate: float, burst: float) -> float:
+        """Take a token; return 0 on success or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Same algorithm as InProcessBackend, run atomically inside Redis using its clock
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """Buckets shared by every replica through Redis.
+
+    If Redis cannot be reached the request is checked against a local
+    bucket instead, so an outage degrades to per-replica limits rather
+    than failing requests.
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the 'redis' package is not installed")
+        self.prefix = prefix
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(_REDIS_TOKEN_BUCKET)
+        self.fallback = InProcessBackend()
+
+    async def acquire(self, key: str, rate: float, burst: float) -> float:
+        try:
+            return float(await self.script(keys=[self.prefix + key], args=[rate, burst]))
+        except Exception as e:
+            logger.warning("Rate limit backend unavailable, using local bucket: %s", e)
+            return await self.fallback.acquire(key, rate, burst)
+
+
+class RateLimiter:
+    def __init__(self, backend, rate: float = RATE_LIMIT_RATE, burst: float = RATE_LIMIT_BURST):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+
+    async def check(self, caller: str, route: str):
+        wait = await self.backend.acquire(f"{caller}|{route}", self.rate, self.burst)
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+
+
+def authenticated_service(request: Request, token: Optional[str] = None) -> Optional[str]:
+    """The caller's X-Service-Id if it also sent the shared service token, else None."""
+    token = SERVICE_AUTH_TOKEN if token is None else token
+    service_id = request.headers.get("x-service-id")
+    presented = request.headers.get("x-service-token", "")
+    if not token or not service_id or not hmac.compare_digest(presented.encode(), token.encode()):
+        return None
+    return service_id
+
+
+def caller_identity(request: Request) -> str:
+    """Identify the caller by client address; unverified identity headers are ignored."""
+    if request.client is None:
+        return "ip:unknown"
+    host = request.client.host
+    if host in RATE_LIMIT_TRUSTED_PROXIES:
+        host = request.headers.get("x-real-ip", host)
+    return f"ip:{host}"
+
+
+def route_template(request: Request) -> str:
+    route = request.scope.get("route")
+    path = route.path if route is not None and hasattr(route, "path") else request.url.path
+    return f"{request.method} {path}"
+
+
+def _build_limiter() -> Optional[RateLimiter]:
+    if not RATE_LIMIT_ENABLED:
+        return None
+    backend = RedisBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else InProcessBackend()
+    return RateLimiter(backend)
+
+
+limiter = _build_limiter()
+
+
+async def rate_limit(request: Request):
+    """Application-wide dependency enforcing the configured limiter."""
+    if limiter is None or request.url.path in EXEMPT_PATHS:
+        return
+    # Internal calls are bounded by the caller's own concurrency limits instead
+    if authenticated_service(request) is not None:
+        return
+    await limiter.check(caller_identity(request), route_template(request))
@@ -1,15 +1,25 @@
+from datetime import datetime
+from sqlalchemy import literal, select, union_all, update
 from sqlalchemy.orm import Session
-from fastapi import HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from typing import List, Optional
 import logging
 import httpx
 import os
-from app.models import OrderModel, OrderItemModel, OrderCreate, OrderUpdate, OrderStatus
+from app.models import (
+    OrderModel, OrderItemModel, ArchivedOrderModel, OrderCreate, OrderUpdate, OrderStatus
+)
+from app.fieldsets import query_options
 
 logger = logging.getLogger(__name__)
 
 # Product service URL for verifying products
 PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://product-service.default.svc.cluster.local:8000")
+# Order IDs per UPDATE ... WHERE id IN (...) statement in bulk status updates
+BULK_STATUS_CHUNK_SIZE = int(os.getenv("BULK_STATUS_CHUNK_SIZE", "5000"))
+
+# Orders in these states can no longer change status
+CLOSED_STATUSES = [OrderStatus.DELIVERED.value, OrderStatus.CANCELLED.value]
 
 # Create a router for internal endpoints
 internal_router = APIRouter()
@@ -20,12 +30,12 @@ TRUSTED_SERVICES = ["product-service", "inventory-service"]
 # Dependency to check service identity
 async def verify_service_identity(x_service_id: str = Header(None)):
     if not x_service_id or x_service_id not in TRUSTED_SERVICES:
-        logger.warning(f"Unauthorized access attempt with service ID: {x_service_id}")
+        logger.warning("Unauthorized access attempt with service ID: %s", x_service_id)
         raise HTTPException(
             status_code=403, 
             detail="Access forbidden: Service identity verification failed"
         )
-    logger.info(f"Authorized access from service: {x_service_id}")
+    logger.info("Authorized access from service: %s", x_service_id)
     return x_service_id
 
 # Internal endpoint that only trusted services can access
@@ -41,25 +51,105 @@ async def internal_endpoint():
         }
     }
 
-def get_orders(db: Session, skip: int = 0, limit: int = 100):
-    """Get all orders with pagination"""
-    return db.query(OrderModel).offset(skip).limit(limit).all()
+def get_orders(db: Session, skip: int = 0, limit: int = 100, include_archived: bool = False,
+               fields: Optional[List[str]] = None):
+    """Get all orders with pagination, loading only `fields` (and items only if listed) if given"""
+    if include_archived:
+        return _load_order_page(db, _order_page_keys_with_archive(db, skip, limit), fields)
+    return db.query(OrderModel).options(*_order_options(OrderModel, fields)).order_by(
+        OrderModel.id
+    ).offset(skip).limit(limit).all()
+
+def get_order_page_keys(db: Session, skip: int = 0, limit: int = 100, include_archived: bool = False):
+    """Get (id, updated_at) for a page of orders without loading full rows"""
+    if include_archived:
+        return [(key.id, key.updated_at) for key in _order_page_keys_with_archive(db, skip, limit)]
+    return db.query(OrderModel.id, OrderModel.updated_at).order_by(
+        OrderModel.id
+    ).offset(skip).limit(limit).all()
+
+def get_order_key(db: Session, order_id: int, include_archived: bool = False):
+    """Get (id, updated_at) for an order without loading the row or its items"""
+    key = db.query(OrderModel.id, OrderModel.updated_at).filter(
+        OrderModel.id == order_id
+    ).first()
+    if key is None and include_archived:
+        key = db.query(ArchivedOrderModel.id, ArchivedOrderModel.updated_at).filter(
+            ArchivedOrderModel.id == order_id
+        ).first()
+    if key is None:
+        raise HTTPException(status_code=404, detail=f"Order with ID {order_id} not found")
+    return key
 
-def get_order(db: Session, order_id: int):
+def get_order(db: Session, order_id: int, include_archived: bool = False, fields: Optional[List[str]] = None):
     """Get a specific order by ID"""
-    order = db.query(OrderModel).filter(OrderModel.id == order_id).first()
+    order = db.query(OrderModel).options(*_order_options(OrderModel, fields)).filter(
+        OrderModel.id == order_id
+    ).first()
+    if order is None and include_archived:
+        order = db.query(ArchivedOrderModel).options(*_order_options(ArchivedOrderModel, fields)).filter(
+            ArchivedOrderModel.id == order_id
+        ).first()
     if order is None:
         raise HTTPException(status_code=404, detail=f"Order with ID {order_id} not found")
     return order
 
-def get_customer_orders(db: Session, customer_id: str, skip: int = 0, limit: int = 100):
-    """Get all orders for a specific customer"""
-    return db.query(OrderModel).filter(
+def get_customer_orders(db: Session, customer_id: str, skip: int = 0, limit: int = 100,
+                        include_archived: bool = False, fields: Optional[List[str]] = None):
+    """Get all orders for a specific customer, most recent first"""
+    if include_archived:
+        return _load_order_page(db, _order_page_keys_with_archive(db, skip, limit, customer_id), fields)
+    return db.query(OrderModel).options(*_order_options(OrderModel, fields)).filter(
         OrderModel.customer_id == customer_id
-    ).offset(skip).limit(limit).all()
+    ).order_by(OrderModel.created_at.desc(), OrderModel.id.desc()).offset(skip).limit(limit).all()
 
-def create_order(db: Session, order: OrderCreate):
-    """Create a new order"""
+def get_customer_order_keys(db: Session, customer_id: str, skip: int = 0, limit: int = 100,
+                            include_archived: bool = False):
+    """Get (id, updated_at) for a page of a customer's orders"""
+    if include_archived:
+        return [(key.id, key.updated_at) for key in _order_page_keys_with_archive(db, skip, limit, customer_id)]
+    return db.query(OrderModel.id, OrderModel.updated_at).filter(
+        OrderModel.customer_id == customer_id
+    ).order_by(OrderModel.created_at.desc(), OrderModel.id.desc()).offset(skip).limit(limit).all()
+
+def _order_page_keys_with_archive(db: Session, skip: int, limit: int, customer_id: Optional[str] = None):
+    """Get (id, updated_at, created_at, archived) for a page spanning live and archived orders"""
+    live = select(OrderModel.id, OrderModel.updated_at, OrderModel.created_at, literal(False).label("archived"))
+    archived = select(ArchivedOrderModel.id, ArchivedOrderModel.updated_at, ArchivedOrderModel.created_at,
+                      literal(True).label("archived"))
+    if customer_id is not None:
+        live = live.where(OrderModel.customer_id == customer_id)
+        archived = archived.where(ArchivedOrderModel.customer_id == customer_id)
+
+    # Same ordering as the live-only queries: by id, or a customer's most recent first
+    def ordering(model):
+        return (model.id,) if customer_id is None else (model.created_at.desc(), model.id.desc())
+
+    # The page is among the first skip + limit rows of each table, read in index order,
+    # so neither table is sorted in full
+    live = live.order_by(*ordering(OrderModel)).limit(skip + limit).subquery()
+    archived = archived.order_by(*ordering(ArchivedOrderModel)).limit(skip + limit).subquery()
+    page = union_all(select(live), select(archived)).subquery()
+    return db.execute(select(page).order_by(*ordering(page.c)).offset(skip).limit(limit)).all()
+
+def _order_options(model, fields: Optional[List[str]]):
+    """Column and items loading for a live or archived order query"""
+    return query_options(model, fields, relationships=("items",))
+
+def _load_order_page(db: Session, keys, fields: Optional[List[str]] = None):
+    """Load the orders named by _order_page_keys_with_archive, keeping page order"""
+    live_ids = [key.id for key in keys if not key.archived]
+    archived_ids = [key.id for key in keys if key.archived]
+    live = {o.id: o for o in db.query(OrderModel).options(*_order_options(OrderModel, fields)).filter(
+        OrderModel.id.in_(live_ids)
+    )} if live_ids else {}
+    archived = {o.id: o for o in db.query(ArchivedOrderModel).options(
+        *_order_options(ArchivedOrderModel, fields)
+    ).filter(ArchivedOrderModel.id.in_(archived_ids))} if archived_ids else {}
+    return [(archived if key.archived else live)[key.id] for key in keys]
+
+def build_order(order: OrderCreate) -> OrderModel:
+    """Build the (unsaved) order and item rows for an OrderCreate"""
     # Calculate total amount
     total_amount = 0
     order_items = []
@@ -74,20 +164,41 @@ def create_order(db: Session, order: OrderCreate):
         total_amount += item.quantity * (item.unit_price or 0)
     
     # Create the order record
-    db_order = OrderModel(
+    return OrderModel(
         customer_id=order.customer_id,
         shipping_address=order.shipping_address,
         status=OrderStatus.PENDING.value,
         total_amount=total_amount,
         items=order_items
     )
-    
+
+def create_order(db: Session, order: OrderCreate):
+    """Create a new order"""
+    db_order = build_order(order)
     db.add(db_order)
     db.commit()
     db.refresh(db_order)
-    logger.info(f"Created new order ID: {db_order.id} for customer: {db_order.customer_id}")
+    logger.info("Created new order ID: %s for customer: %s", db_order.id, db_order.customer_id)
     return db_order
 
+def create_orders(db: Session, orders: List[OrderCreate]) -> List[int]:
+    """Create many orders in one transaction, returning their IDs in input order.
+
+    The flush sends the orders, then their items, as multi-row INSERTs.
+    """
+    db_orders = [build_order(order) for order in orders]
+    db.add_all(db_orders)
+    try:
+        db.flush()
+        # Read IDs before commit expires the objects
+        order_ids = [db_order.id for db_order in db_orders]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.info("Created %s orders in bulk", len(order_ids))
+    return order_ids
+
 def update_order(db: Session, order_id: int, order_update: OrderUpdate):
     """Update an existing order"""
     db_order = get_order(db, order_id)
@@ -110,7 +221,7 @@ def update_order(db: Session, order_id: int, order_update: OrderUpdate):
         
     db.commit()
     db.refresh(db_order)
-    logger.info(f"Updated order ID: {db_order.id}, new status: {db_order.status}")
+    logger.info("Updated order ID: %s, new status: %s", db_order.id, db_order.status)
     return db_order
 
 def cancel_order(db: Session, order_id: int):
@@ -127,10 +238,56 @@ def cancel_order(db: Session, order_id: int):
     # Update status to cancelled
     db_order.status = OrderStatus.CANCELLED.value
     db.commit()
-    logger.info(f"Cancelled order ID: {order_id}")
+    logger.info("Cancelled order ID: %s", order_id)
     
     return {"success": True, "message": f"Order {order_id} cancelled"}
 
+def bulk_update_order_status(db: Session, order_ids: List[int], status: OrderStatus):
+    """Move many orders to `status` with set-based updates.
+
+    Applies the same rule as update_order: delivered and cancelled orders
+    cannot change status. Orders already in the target status are left
+    untouched. Returns one result per distinct order ID, in request order.
+    """
+    ordered_ids = list(dict.fromkeys(order_ids))
+    updated = set()
+    for start in range(0, len(ordered_ids), BULK_STATUS_CHUNK_SIZE):
+        chunk = ordered_ids[start:start + BULK_STATUS_CHUNK_SIZE]
+        result = db.execute(
+            update(OrderModel)
+            .where(
+                OrderModel.id.in_(chunk),
+                OrderModel.status.notin_(CLOSED_STATUSES),
+                OrderModel.status != status.value,
+            )
+            .values(status=status.value, updated_at=datetime.utcnow())
+            .returning(OrderModel.id)
+        )
+        updated.update(result.scalars())
+
+    # Only orders that were not updated need a second look to explain why
+    leftover = [order_id for order_id in ordered_ids if order_id not in updated]
+    current = {}
+    for start in range(0, len(leftover), BULK_STATUS_CHUNK_SIZE):
+        chunk = leftover[start:start + BULK_STATUS_CHUNK_SIZE]
+        current.update(db.query(OrderModel.id, OrderModel.status).filter(OrderModel.id.in_(chunk)).all())
+    db.commit()
+
+    results = []
+    for order_id in ordered_ids:
+        if order_id in updated:
+            results.append({"order_id": order_id, "result": "updated"})
+        elif order_id not in current:
+            results.append({"order_id": order_id, "result": "not_found",
+                            "detail": f"Order with ID {order_id} not found"})
+        elif current[order_id] == status.value:
+            results.append({"order_id": order_id, "result": "unchanged"})
+        else:
+            results.append({"order_id": order_id, "result": "rejected",
+                            "detail": f"Cannot update order in {current[order_id]} status"})
+    logger.info("Bulk status update to %s: %s of %s orders updated", status.value, len(updated), len(ordered_ids))
+    return {"status": status, "updated": len(updated), "results": results}
+
 # Export the internal_router so it can be imported in main.py
 __all__ = [
     "get_orders", 
@@ -139,5 +296,9 @@ __all__ = [
     "update_order", 
     "cancel_order", 
     "get_customer_orders",
+    "get_order_key",
+    "get_order_page_keys",
+    "get_customer_order_keys",
+    "bulk_update_order_status",
     "internal_router"
 ]
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""Client for product-service's binary RPC interface.
+
+Used instead of the REST calls when PRODUCT_RPC_URL is set (for example
+tcp://product-service.microservices.svc.cluster.local:9000). One TCP
+connection per worker carries every call; each request has an ID and
+waits for its own answer, so concurrent calls share the connection
+instead of queueing behind each other. The framing and payloads are
+described in product-service's app/rpc.py. Each new connection first
+authenticates with SERVICE_AUTH_TOKEN.
+
+Calls return an RpcResponse with the status_code and text that the REST
+endpoint would have answered, so callers can handle both paths alike.
+Transport failures (connection refused or lost, timeout) raise
+RpcUnavailable, the counterpart of httpx.RequestError.
+"""
+import asyncio
+import itertools
+import os
+import logging
+import struct
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from app import clients
+
+logger = logging.getLogger(__name__)
+
+# tcp://host:port of product-service's RPC listener; unset means use REST
+PRODUCT_RPC_URL = os.getenv("PRODUCT_RPC_URL", "")
+RPC_TIMEOUT_SECONDS = float(os.getenv("RPC_TIMEOUT_SECONDS", "5"))
+
+AUTH, RESERVE, RELEASE, STOCK, MULTI_GET = 0, 1, 2, 3, 4
+
+REQUEST_HEADER = struct.Struct("<IIB")
+RESPONSE_HEADER = struct.Struct("<IIH")
+STOCK_CHANGE = struct.Struct("<Qi")
+PRODUCT_ID = struct.Struct("<Q")
+STOCK_LEVEL = struct.Struct("<q")
+COUNT = struct.Struct("<H")
+# id, price, stock, is_active, created_at, updated_at
+PRODUCT = struct.Struct("<Qdq?qq")
+STRING_LENGTH = struct.Struct("<H")
+NULL_STRING = 0xFFFF
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class RpcUnavailable(Exception):
+    pass
+
+
+class RpcResponse:
+    """Outcome of one call, shaped like the REST endpoint's response."""
+
+    def __init__(self, status_code: int, text: str = "", data: Any = None):
+        self.status_code = status_code
+        self.text = text
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def _timestamp(micros: int) -> str:
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat()
+
+
+def _read_string(payload: bytes, offset: int) -> Tuple[Optional[str], int]:
+    length, = STRING_LENGTH.unpack_from(payload, offset)
+    offset += STRING_LENGTH.size
+    if length == NULL_STRING:
+        return None, offset
+    return payload[offset:offset + length].decode(), offset + length
+
+
+def decode_products(payload: bytes) -> Dict[str, List]:
+    """MULTI_GET answer as the REST batch body: {"products": [...], "missing": [...]}."""
+    count, = COUNT.unpack_from(payload)
+    offset = COUNT.size
+    products = []
+    for _ in range(count):
+        product_id, price, stock, is_active, created_at, updated_at = PRODUCT.unpack_from(payload, offset)
+        offset += PRODUCT.size
+        name, offset = _read_string(payload, offset)
+        description, offset = _read_string(payload, offset)
+        category, offset = _read_string(payload, offset)
+        products.append({
+            "name": name, "description": description, "price": price, "category": category,
+            "id": product_id, "stock": stock, "is_active": is_active,
+            "created_at": _timestamp(created_at), "updated_at": _timestamp(updated_at),
+        })
+    missing_count, = COUNT.unpack_from(payload, offset)
+    missing = list(struct.unpack_from(f"<{missing_count}Q", payload, offset + COUNT.size))
+    return {"products": products, "missing": missing}
+
+
+class RpcClient:
+    def __init__(self, host: str, port: int, timeout: float = RPC_TIMEOUT_SECONDS, token: str = ""):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.token = token
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        self._drain_lock = asyncio.Lock()
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                try:
+                    reader, self._writer = await asyncio.wait_for(self._open(), self.timeout)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    raise RpcUnavailable(f"Cannot connect to {self.host}:{self.port}: {e!r}") from e
+                self._reader_task = asyncio.create_task(self._read_responses(reader, self._writer))
+            return self._writer
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Connect and authenticate; the AUTH answer comes before any other response."""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        token = self.token.encode()
+        writer.write(REQUEST_HEADER.pack(len(token) + REQUEST_HEADER.size - 4, 0, AUTH) + token)
+        await writer.drain()
+        length, _, status = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+        detail = await reader.readexactly(length - (RESPONSE_HEADER.size - 4))
+        if status != 200:
+            writer.close()
+            raise RpcUnavailable(f"{self.host}:{self.port} refused the service token: {detail.decode(errors='replace')}")
+        return reader, writer
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        error = "connection closed"
+        try:
+            while True:
+                length, request_id, status = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+                payload = await reader.readexactly(length - (RESPONSE_HEADER.size - 4))
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((status, payload))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = repr(e)
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            # Calls still waiting on this connection will never get an answer
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(RpcUnavailable(f"Lost connection to {self.host}:{self.port}: {error}"))
+            self._pending.clear()
+
+    async def call(self, method: int, payload: bytes) -> Tuple[int, bytes]:
+        """Send one request and wait for its (status, payload)."""
+        writer = await self._connection()
+        request_id = next(self._ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write(REQUEST_HEADER.pack(len(payload) + REQUEST_HEADER.size - 4, request_id, method) + payload)
+            async with self._drain_lock:
+                await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise RpcUnavailable(f"No answer from {self.host}:{self.port} within {self.timeout}s")
+        except OSError as e:
+            raise RpcUnavailable(f"Lost connection to {self.host}:{self.port}: {e!r}") from e
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _call(self, method: int, pack: Callable[[], bytes], decode) -> RpcResponse:
+        try:
+            payload = pack()
+        except struct.error as e:
+            # Out of range for the wire format (negative ID, quantity over 2**31 - 1, ...);
+            # answered like the REST endpoint's validation error instead of raising
+            return RpcResponse(400, f"Invalid product ID or quantity: {e}")
+        status, body = await self.call(method, payload)
+        if status != 200:
+            return RpcResponse(status, body.decode(errors="replace"))
+        return RpcResponse(status, data=decode(body))
+
+    async def reserve(self, product_id: int, quantity: int) -> RpcResponse:
+        def decode(body):
+            remaining, = STOCK_LEVEL.unpack(body)
+            return {"success": True, "product_id": product_id, "reserved_quantity": quantity,
+                    "remaining_stock": remaining}
+        return await self._call(RESERVE, lambda: STOCK_CHANGE.pack(product_id, quantity), decode)
+
+    async def release(self, product_id: int, quantity: int) -> RpcResponse:
+        def decode(body):
+            stock, = STOCK_LEVEL.unpack(body)
+            return {"success": True, "product_id": product_id, "released_quantity": quantity, "stock": stock}
+        return await self._call(RELEASE, lambda: STOCK_CHANGE.pack(product_id, quantity), decode)
+
+    async def stock(self, product_id: int) -> RpcResponse:
+        def decode(body):
+            stock, = STOCK_LEVEL.unpack(body)
+            return {"product_id": product_id, "in_stock": stock > 0, "stock": stock}
+        return await self._call(STOCK, lambda: PRODUCT_ID.pack(product_id), decode)
+
+    async def get_products(self, product_ids: List[int]) -> RpcResponse:
+        def pack():
+            return COUNT.pack(len(product_ids)) + struct.pack(f"<{len(product_ids)}Q", *product_ids)
+        return await self._call(MULTI_GET, pack, decode_products)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+
+_client: Optional[RpcClient] = None
+
+
+def get_rpc_client() -> Optional[RpcClient]:
+    """The shared RPC client, or None when PRODUCT_RPC_URL is not set."""
+    global _client
+    if _client is None and PRODUCT_RPC_URL:
+        parts = urlsplit(PRODUCT_RPC_URL)
+        _client = RpcClient(parts.hostname, parts.port or 9000, token=clients.SERVICE_AUTH_TOKEN)
+    return _client
+
+
+async def close_rpc_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,150 @@
+"""Production entry point: `python -m app.server`.
+
+Runs the API under gunicorn with uvicorn workers. The worker count follows
+the CPU quota of the container, and the database connection budget of the
+pod is split across workers so the total stays within what YugabyteDB
+allows; a budget too small for one connection per worker caps the count.
+Use `uvicorn app.main:app --reload` for local development instead.
+"""
+import math
+import os
+import logging
+from importlib.util import find_spec
+from typing import Optional, Tuple
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+from app.pool import max_workers, pool_sizes, replica_budget
+
+logger = logging.getLogger(__name__)
+
+# cgroup v2 exposes "<quota> <period>", cgroup v1 splits them across two files
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# Recycle a worker after this many requests (0 disables recycling)
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "10000"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# Seconds a worker may go without a heartbeat; workers send none while warming up
+# in their startup handler, so this must exceed WARMUP_TIMEOUT_SECONDS
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "90"))
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+# With follower reads each worker opens a second, read-only pool, to DB_HOST unless
+# DB_READ_HOSTS names other tservers (app/database.py); the budget is split across both
+DB_FOLLOWER_READS = os.getenv("DB_FOLLOWER_READS", "false").lower() == "true"
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """Return the CPU quota of the container in cores, or None if unlimited."""
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota == "max" or not period:
+            return None
+        return int(quota) / int(period)
+
+    quota, period = _read(CGROUP_V1_CPU_QUOTA), _read(CGROUP_V1_CPU_PERIOD)
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def worker_count() -> int:
+    """Number of worker processes: WEB_CONCURRENCY, else one per quota core."""
+    if os.getenv("WEB_CONCURRENCY"):
+        return max(1, int(os.environ["WEB_CONCURRENCY"]))
+    cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is None:
+        return cpus
+    return max(1, min(cpus, math.ceil(limit)))
+
+
+def configured_pool_sizes(workers: int, budget: int, pools: int = 1) -> Tuple[int, int]:
+    """Per-pool (pool_size, max_overflow): the budget split, unless DB_POOL_SIZE/DB_MAX_OVERFLOW are set.
+
+    Explicit values that would let the pod open more than `budget`
+    connections to a host raise ValueError instead of silently exceeding it.
+    """
+    pool_size, max_overflow = pool_sizes(workers, budget, pools)
+    pool_size = int(os.getenv("DB_POOL_SIZE", str(pool_size)))
+    max_overflow = int(os.getenv("DB_MAX_OVERFLOW", str(max_overflow)))
+    if workers * pools * (pool_size + max_overflow) > budget:
+        raise ValueError(f"DB_POOL_SIZE={pool_size} and DB_MAX_OVERFLOW={max_overflow} for {workers} workers "
+                         f"with {pools} pools each exceed the {budget} connections DB_CONNECTION_BUDGET "
+                         f"allows per pod; unset them to use the computed split")
+    return pool_size, max_overflow
+
+
+class ServiceWorker(UvicornWorker):
+    """Uvicorn worker that uses uvloop and httptools when they are installed."""
+    CONFIG_KWARGS = {
+        "loop": "uvloop" if find_spec("uvloop") else "asyncio",
+        "http": "httptools" if find_spec("httptools") else "h11",
+    }
+
+
+class ServiceApplication(BaseApplication):
+    def __init__(self, app_uri: str, options: dict):
+        self.app_uri = app_uri
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from gunicorn.util import import_app
+        return import_app(self.app_uri)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    budget = replica_budget()
+    pools = 2 if DB_FOLLOWER_READS else 1
+    workers = worker_count()
+    if workers > max_workers(budget, pools):
+        logger.warning(
+            "Running %d workers instead of %d: a budget of %d connections per pod gives each of %d pools "
+            "per worker at least one", max_workers(budget, pools), workers, budget, pools,
+        )
+        workers = max_workers(budget, pools)
+    pool_size, max_overflow = configured_pool_sizes(workers, budget, pools)
+
+    # Workers import app.database after fork and read these when building the engine
+    os.environ["DB_POOL_SIZE"] = str(pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(max_overflow)
+    logger.info(
+        "Starting %d workers (loop=%s, http=%s, db pool=%d+%d per worker, %d per pod)",
+        workers, ServiceWorker.CONFIG_KWARGS["loop"], ServiceWorker.CONFIG_KWARGS["http"],
+        pool_size, max_overflow, budget,
+    )
+
+    ServiceApplication("app.main:app", {
+        "bind": f"{HOST}:{PORT}",
+        "workers": workers,
+        "worker_class": "app.server.ServiceWorker",
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER if MAX_REQUESTS else 0,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": WORKER_TIMEOUT,
+        "keepalive": KEEPALIVE,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Warm-up before readiness.
+
+A new replica pays several first-use costs on its first requests: the DB
+pool opens connections lazily, the first run of each query compiles and
+caches its SQL, Pydantic and FastAPI build their validators, and the
+first call to OPA opens a connection. Warm-up does all of that in the
+startup handler of every worker process:
+
+1. open WARMUP_CONNECTIONS connections (default: the pool size) on every
+   engine, so they sit idle in the pool;
+2. run each hot query once;
+3. serialize their results with the response models;
+4. send one request per dependency through the shared HTTP client.
+
+The handler awaits warm-up, and a worker only starts accepting connections
+once startup has finished. Gunicorn workers share the listening socket,
+so while one worker warms up (at pod start, or after a max_requests
+restart) its connections go to workers that are already warm, and a
+readiness probe can never reach a cold worker. The ready flag is per
+process and /ready reports the worker that answered it. A failing step
+is logged and listed in /ready but does not keep the worker out of
+service; /health still only reports that the process is up.
+"""
+import asyncio
+import os
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+from app import clients
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# Connections opened per engine (0 means the engine's pool_size)
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "0"))
+# Give up and report ready after this long
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "30"))
+
+
+class WarmupState:
+    def __init__(self, enabled: bool = WARMUP_ENABLED):
+        self.ready = not enabled
+        self.seconds: Optional[float] = None
+        self.failures: List[str] = []
+
+
+state = WarmupState()
+
+
+def health_url(url: str) -> str:
+    """The /health URL on the same host as `url` (OPA and our services all serve one)."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}/health"
+
+
+def open_pool_connections(engine: Engine, count: int = WARMUP_CONNECTIONS) -> int:
+    """Open up to `count` connections at once and return them to the pool idle."""
+    size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    count = min(count or size, size)
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        connections = list(executor.map(lambda _: engine.connect(), range(count)))
+    for connection in connections:
+        connection.close()
+    return count
+
+
+def run_hot_queries(session_factory, queries: Dict[str, Callable]) -> Dict[str, object]:
+    """Run each query once in one session and return the results by name."""
+    results = {}
+    db = session_factory()
+    try:
+        for name, query in queries.items():
+            results[name] = query(db)
+    finally:
+        db.close()
+    return results
+
+
+def prime_serializers(results: Dict[str, object], response_types: Dict[str, object]):
+    """Validate and encode query results with the response types the routes use."""
+    for name, response_type in response_types.items():
+        if name in results:
+            jsonable_encoder(parse_obj_as(response_type, results[name]))
+
+
+async def warm_clients(urls: Iterable[str]):
+    client = clients.get_client()
+    for url in urls:
+        try:
+            await client.get(url)
+        except httpx.RequestError as e:
+            # Still counts as warm: the failure is the dependency's, not ours
+            logger.warning("Warm-up request to %s failed: %s", url, e)
+
+
+async def _step(name: str, work):
+    started = time.monotonic()
+    try:
+        result = await work
+    except Exception as e:
+        logger.warning("Warm-up step %s failed: %s", name, e)
+        state.failures.append(f"{name}: {e}")
+        return None
+    logger.info("Warm-up step %s took %.3fs", name, time.monotonic() - started)
+    return result
+
+
+async def warm_up(engines: Iterable[Engine], session_factory, queries: Dict[str, Callable],
+                  response_types: Dict[str, object], urls: Iterable[str]):
+    """Run every warm-up step, then mark the process ready."""
+    started = time.monotonic()
+
+    async def steps():
+        for engine in dict.fromkeys(engines):
+            await _step(f"pool {engine.url.host}", run_in_threadpool(open_pool_connections, engine))
+        results = await _step("hot queries", run_in_threadpool(run_hot_queries, session_factory, queries))
+        if results:
+            await _step("serializers", run_in_threadpool(prime_serializers, results, response_types))
+        await _step("clients", warm_clients(urls))
+
+    try:
+        await asyncio.wait_for(steps(), WARMUP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        state.failures.append(f"timed out after {WARMUP_TIMEOUT_SECONDS}s")
+    state.seconds = time.monotonic() - started
+    state.ready = True
+    logger.info("Warm-up finished in %.3fs", state.seconds)
@@ -0,0 +1,123 @@
+"""Per-call latency and CPU of product-service calls: REST over httpx vs binary RPC.
+
+Runs the same operation against a running product-service through both
+paths, at each concurrency level, and prints latency percentiles and the
+CPU time spent per call by this process (the caller) and, with
+--server-pid, by the product-service process.
+
+    WEB_CONCURRENCY=1 RPC_PORT=9000 SERVICE_AUTH_TOKEN=dev python -m app.server   # in product-service
+    SERVICE_AUTH_TOKEN=dev python -m benchmarks.product_calls --http http://localhost:8000 \\
+        --rpc tcp://localhost:9000 --server-pid $(pgrep -f "gunicorn: worker")
+
+--operation stock only reads. --operation reserve reserves one unit and
+releases it again, so stock is unchanged afterwards. REST calls also pay
+for product-service's OPA check; point its OPA_URL at a local OPA for a
+comparison of the transports alone.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from app.clients import SERVICE_AUTH_TOKEN, service_headers
+from app.rpc_client import RpcClient
+
+
+def process_cpu_seconds(pid: Optional[int]) -> float:
+    """utime + stime of `pid` (this process if None)."""
+    if pid is None:
+        return time.process_time()
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def http_operation(client: httpx.AsyncClient, operation: str, product_id: int):
+    async def stock():
+        (await client.get(f"/products/{product_id}/stock")).raise_for_status()
+
+    async def reserve():
+        (await client.post(f"/products/{product_id}/reserve", params={"quantity": 1})).raise_for_status()
+        (await client.post(f"/products/{product_id}/release", params={"quantity": 1})).raise_for_status()
+
+    return stock if operation == "stock" else reserve
+
+
+def rpc_operation(client: RpcClient, operation: str, product_id: int):
+    async def stock():
+        assert (await client.stock(product_id)).status_code == 200
+
+    async def reserve():
+        assert (await client.reserve(product_id, 1)).status_code == 200
+        assert (await client.release(product_id, 1)).status_code == 200
+
+    return stock if operation == "stock" else reserve
+
+
+async def measure(call, calls: int, concurrency: int, server_pid: Optional[int]) -> dict:
+    for _ in range(min(calls, 200)):
+        await call()
+    timings = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            await call()
+            timings.append(time.perf_counter() - start)
+
+    client_cpu, server_cpu = process_cpu_seconds(None), process_cpu_seconds(server_pid) if server_pid else 0.0
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(calls // concurrency) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    done = len(timings)
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[int(done * 0.99) - 1] * 1000,
+        "calls_per_s": done / elapsed,
+        "client_cpu_us": (process_cpu_seconds(None) - client_cpu) / done * 1e6,
+        "server_cpu_us": (process_cpu_seconds(server_pid) - server_cpu) / done * 1e6 if server_pid else None,
+    }
+
+
+async def main_async(args):
+    rpc_url = urlsplit(args.rpc)
+    # Identified as order-service, so product-service's rate limiter does not throttle the REST path
+    async with httpx.AsyncClient(base_url=args.http, headers=service_headers()) as http_client:
+        rpc_client = RpcClient(rpc_url.hostname, rpc_url.port, token=SERVICE_AUTH_TOKEN)
+        paths = {
+            "http": http_operation(http_client, args.operation, args.product_id),
+            "rpc": rpc_operation(rpc_client, args.operation, args.product_id),
+        }
+        try:
+            for concurrency in args.concurrency:
+                for name, call in paths.items():
+                    result = await measure(call, args.calls, concurrency, args.server_pid)
+                    server = f"  server cpu {result['server_cpu_us']:7.1f}us" if args.server_pid else ""
+                    print(
+                        f"{name:4} x{concurrency:<3} p50 {result['p50_ms']:6.2f}ms  p99 {result['p99_ms']:6.2f}ms  "
+                        f"{result['calls_per_s']:8.0f} calls/s  client cpu {result['client_cpu_us']:7.1f}us{server}"
+                    )
+        finally:
+            await rpc_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Product-service call cost: REST over httpx vs binary RPC")
+    parser.add_argument("--http", default="http://localhost:8000")
+    parser.add_argument("--rpc", default="tcp://localhost:9000")
+    parser.add_argument("--operation", choices=["stock", "reserve"], default="stock")
+    parser.add_argument("--product-id", type=int, default=1)
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--server-pid", type=int, help="product-service worker to measure CPU of")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,594 @@
+import asyncio
+import io
+import json
+import logging
+import socket
+import socketserver
+import threading
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.main import app, check_policy
+from app.database import get_db, get_read_db
+from app.models import Base, OrderCreate, OrderModel, OrderItemModel, OrderStatus, PendingStockReleaseModel
+from app import bulk_orders, clients, debug, logging_config, pool, ratelimit, rpc_client, sqlstats, tracing, warmup
+
+engine = create_engine(
+    "sqlite://",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+tracing.instrument_engine(engine)
+sqlstats.record_statements(engine)
+
+
+def override_get_db():
+    db = TestingSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Fresh buckets per test so request counts do not carry over
+    monkeypatch.setattr(ratelimit, "limiter", ratelimit.RateLimiter(ratelimit.InProcessBackend()))
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add_all([
+        OrderModel(
+            customer_id="customer-1" if i % 2 else "customer-2",
+            shipping_address="1 Test Street",
+            status=OrderStatus.PENDING.value,
+            total_amount=20.0,
+            items=[OrderItemModel(product_id=i, quantity=2, unit_price=10.0)],
+        )
+        for i in range(1, 6)
+    ])
+    db.commit()
+    db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[check_policy] = lambda: True
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    Base.metadata.drop_all(bind=engine)
+
+
+def test_get_order_honors_if_none_match(client):
+    response = client.get("/orders/1")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    assert client.get("/orders/1", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/orders/2", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_order_etag_changes_after_update(client):
+    etag = client.get("/orders/1").headers["ETag"]
+    assert client.put("/orders/1", json={"status": "processing"}).status_code == 200
+    assert client.get("/orders/1", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_customer_orders_page_validators(client):
+    response = client.get("/orders/customer/customer-1")
+    assert [o["id"] for o in response.json()] == [5, 3, 1]
+    etag = response.headers["ETag"]
+    assert client.get("/orders/customer/customer-1", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/orders/customer/customer-2", headers={"If-None-Match": etag}).status_code == 200
+
+
+@pytest.fixture
+def product_service(monkeypatch):
+    """Route outbound httpx calls to a fake product-service, recording the requests."""
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request)
+        return httpx.Response(200, json={"success": True})
+
+    monkeypatch.setattr(clients, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return requests
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = tracing.InMemoryExporter()
+    monkeypatch.setattr(tracing, "_exporter", exporter)
+    return exporter
+
+
+def test_create_order_trace_covers_downstream_calls_and_sql(client, product_service, exporter, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(clients, "SERVICE_AUTH_TOKEN", "s3cret")
+    response = client.post("/orders", json={
+        "customer_id": "customer-3",
+        "shipping_address": "2 Test Street",
+        "items": [{"product_id": 1, "quantity": 1}, {"product_id": 2, "quantity": 3}],
+    })
+    assert response.status_code == 201
+
+    [root] = exporter.find("POST /orders")
+    assert root.parent_id is None
+    assert root.attributes["http.status_code"] == 201
+    reserves = exporter.find("product_service.reserve")
+    assert [s.attributes["product_id"] for s in reserves] == [1, 2]
+    assert exporter.find("db.query")
+    assert exporter.find("serialize_response")
+    assert all(s.trace_id == root.trace_id for s in exporter.spans)
+
+    # Each downstream call carries the trace and its own span as the parent
+    for request, reserve in zip(product_service, reserves):
+        assert request.headers["traceparent"] == f"00-{root.trace_id}-{reserve.span_id}-01"
+        # ...and identifies order-service, so product-service's rate limiter lets it through
+        assert request.headers["x-service-id"] == "order-service"
+        assert request.headers["x-service-token"] == "s3cret"
+
+
+def test_unsampled_request_exports_nothing_unless_slow(client, exporter, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+    client.get("/orders/1")
+    assert exporter.spans == []
+
+    monkeypatch.setattr(tracing, "TRACE_SLOW_THRESHOLD_MS", 0.0)
+    client.get("/orders/1")
+    [root] = exporter.spans
+    assert root.name == "GET /orders/{order_id}"
+    assert root.attributes["sampled_by"] == "latency"
+
+
+def test_incoming_traceparent_is_continued(client, exporter):
+    trace_id, parent_id = "ab" * 16, "cd" * 8
+    client.get("/orders/1", headers={"traceparent": f"00-{trace_id}-{parent_id}-01"})
+    [root] = exporter.find("GET /orders/{order_id}")
+    assert root.trace_id == trace_id
+    assert root.parent_id == parent_id
+
+
+def test_logged_spans_are_never_sampled_out(client, monkeypatch):
+    memory = tracing.InMemoryExporter()
+
+    class RecordingLoggingExporter(tracing.LoggingExporter):
+        def export(self, spans):
+            memory.export(spans)
+            super().export(spans)
+
+    monkeypatch.setattr(tracing, "_exporter", RecordingLoggingExporter())
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    # A logging pipeline of its own, writing to a buffer
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    monkeypatch.setattr(logging_config, "_listener", None)
+    logging_config.configure_logging("INFO")
+    output = io.StringIO()
+    logging_config._listener.handlers[0].setStream(output)
+    try:
+        for _ in range(logging_config.LOG_SAMPLE_BURST + 10):
+            assert client.get("/orders/1").status_code == 200
+    finally:
+        logging_config.shutdown_logging()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+    logged = [entry["span"] for entry in map(json.loads, output.getvalue().splitlines()) if entry["message"] == "span"]
+    assert len(memory.spans) > logging_config.LOG_SAMPLE_BURST
+    assert sorted(s["span_id"] for s in logged) == sorted(s.span_id for s in memory.spans)
+
+
+def test_bulk_status_update_reports_per_order(client):
+    assert client.put("/orders/2", json={"status": "delivered"}).status_code == 200
+    assert client.put("/orders/3", json={"status": "shipped"}).status_code == 200
+
+    response = client.post("/orders/status/bulk", json={"order_ids": [1, 2, 3, 99, 4, 1], "status": "shipped"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["updated"] == 2
+    assert [(r["order_id"], r["result"]) for r in body["results"]] == [
+        (1, "updated"), (2, "rejected"), (3, "unchanged"), (99, "not_found"), (4, "updated"),
+    ]
+    assert client.get("/orders/1").json()["status"] == "shipped"
+    assert client.get("/orders/2").json()["status"] == "delivered"
+
+
+def test_bulk_status_update_uses_few_statements(client):
+    from sqlalchemy import event
+    db = TestingSessionLocal()
+    db.add_all([
+        OrderModel(customer_id="bulk", shipping_address="x", status=OrderStatus.PENDING.value, total_amount=0)
+        for _ in range(9995)
+    ])
+    db.commit()
+    db.close()
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.post("/orders/status/bulk", json={"order_ids": list(range(1, 10001)), "status": "shipped"})
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert response.json()["updated"] == 10000
+    assert len(statements) <= 5
+
+
+def test_bulk_status_update_is_capped(client, monkeypatch):
+    monkeypatch.setattr("app.main.BULK_STATUS_MAX_ORDERS", 2)
+    response = client.post("/orders/status/bulk", json={"order_ids": [1, 2, 3], "status": "shipped"})
+    assert response.status_code == 400
+
+
+def test_archived_orders_are_read_only_when_asked(client):
+    from datetime import datetime, timedelta
+    from app.archiver import archive_closed_orders
+
+    db = TestingSessionLocal()
+    old = datetime.utcnow() - timedelta(days=400)
+    db.query(OrderModel).filter(OrderModel.id.in_([1, 2])).update(
+        {"status": OrderStatus.DELIVERED.value, "created_at": old}, synchronize_session=False
+    )
+    db.query(OrderModel).filter(OrderModel.id == 3).update({"created_at": old}, synchronize_session=False)
+    db.commit()
+    # Order 3 is old but still pending, so it stays in the live table
+    assert archive_closed_orders(db, datetime.utcnow() - timedelta(days=90), batch_size=1) == 2
+    db.close()
+
+    assert client.get("/orders/1").status_code == 404
+    archived = client.get("/orders/1", params={"include_archived": True})
+    assert archived.status_code == 200
+    assert archived.json()["items"][0]["product_id"] == 1
+
+    assert [o["id"] for o in client.get("/orders").json()] == [3, 4, 5]
+    assert [o["id"] for o in client.get("/orders", params={"include_archived": True}).json()] == [1, 2, 3, 4, 5]
+    page = client.get("/orders/customer/customer-1", params={"include_archived": True, "limit": 2})
+    assert [o["id"] for o in page.json()] == [5, 3]
+
+
+def test_archiver_job_runs_one_pass(client, monkeypatch):
+    import sys
+    from datetime import datetime, timedelta
+    from app import archiver, database
+
+    db = TestingSessionLocal()
+    db.query(OrderModel).filter(OrderModel.id == 4).update(
+        {"status": OrderStatus.CANCELLED.value, "created_at": datetime.utcnow() - timedelta(days=100)},
+        synchronize_session=False,
+    )
+    db.commit()
+    db.close()
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(sys, "argv", ["app.archiver", "--after-days", "90"])
+    archiver.main()
+    assert client.get("/orders/4").status_code == 404
+    assert client.get("/orders/4", params={"include_archived": True}).status_code == 200
+
+
+def test_per_request_profile_needs_debug_token(client, monkeypatch):
+    assert client.get("/debug/profile/requests/missing").status_code == 404
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    response = client.get("/orders/1", headers={"X-Profile": "1", "X-Debug-Token": "secret"})
+    assert response.status_code == 200
+    profile = client.get(f"/debug/profile/requests/{response.headers['X-Profile-Id']}",
+                         headers={"X-Debug-Token": "secret"})
+    assert profile.status_code == 200
+
+
+def test_metrics_expose_sql_aggregates(client):
+    sqlstats.stats.reset()
+    client.get("/orders")
+    client.get("/orders/customer/customer-1")
+    metrics = client.get("/metrics").text
+    assert "# TYPE sql_statement_p95_seconds gauge" in metrics
+    assert metrics.count("sql_statements_total{") >= 2
+
+
+def test_pool_stats_cover_every_engine(client, monkeypatch):
+    assert "# TYPE db_pool_wait_seconds_total counter" in client.get("/metrics").text
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    body = client.get("/debug/pool", headers={"X-Debug-Token": "secret"}).json()
+    assert body["connection_budget"] == pool.replica_budget()
+    assert [p["host"] for p in body["pools"]] == [e.url.host for e in pool.engines]
+    assert body["pools"][0]["pool_size"] == pool.engines[0].pool.size()
+
+
+def test_sparse_fieldsets_skip_items_unless_requested(client):
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        response = client.get("/orders", params={"fields": "id,status", "limit": 2})
+        assert response.json() == [{"id": 1, "status": "pending"}, {"id": 2, "status": "pending"}]
+        assert len(statements) == 1 and "shipping_address" not in statements[0]
+
+        statements.clear()
+        response = client.get("/orders/customer/customer-1", params={"fields": "id,items"})
+        assert [o["id"] for o in response.json()] == [5, 3, 1]
+        assert response.json()[0]["items"][0]["product_id"] == 5
+        # One query for the orders and one for all of their items
+        assert len(statements) == 2
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    detail = client.get("/orders/2", params={"fields": "total_amount"})
+    assert detail.json() == {"total_amount": 20.0}
+    assert detail.headers["ETag"] != client.get("/orders/2").headers["ETag"]
+    assert client.get("/orders", params={"fields": "id,password"}).status_code == 400
+
+
+@pytest.fixture
+def stocked_product_service(monkeypatch):
+    """A fake product-service that tracks stock for reserve and release calls."""
+    stock = {1: 5, 2: 100}
+    calls = []
+
+    def handler(request: httpx.Request):
+        _, _, product_id, action = request.url.path.split("/")
+        product_id, quantity = int(product_id), int(request.url.params["quantity"])
+        calls.append((action, product_id, quantity))
+        if product_id not in stock:
+            return httpx.Response(404, json={"detail": "Product not found"})
+        if action == "reserve":
+            if stock[product_id] < quantity:
+                return httpx.Response(400, json={"detail": "Not enough stock available"})
+            quantity = -quantity
+        stock[product_id] += quantity
+        return httpx.Response(200, json={"success": True})
+
+    monkeypatch.setattr(clients, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return stock, calls
+
+
+def bulk_line(*items):
+    return json.dumps({
+        "customer_id": "b2b-1",
+        "shipping_address": "Warehouse 4",
+        "items": [{"product_id": p, "quantity": q, "unit_price": 5.0} for p, q in items],
+    })
+
+
+def test_bulk_create_reserves_per_product_and_streams_results(client, stocked_product_service):
+    stock, calls = stocked_product_service
+    body = "\n".join([
+        bulk_line((1, 2), (2, 1)),
+        "{not json",
+        bulk_line((1, 2)),
+        bulk_line((1, 2), (2, 1)),
+        "",
+        bulk_line((99, 1)),
+    ]) + "\n"
+    response = client.post("/orders/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    results = {r["line"]: r for r in lines[:-1]}
+
+    assert results[1] == {"line": 1, "status": "created", "order_id": 6}
+    assert results[2]["status"] == "invalid"
+    assert results[3] == {"line": 3, "status": "created", "order_id": 7}
+    # Product 1 only had stock for the first two records
+    assert results[4]["status"] == "rejected" and "product 1" in results[4]["detail"]
+    assert results[6]["status"] == "rejected" and "product 99" in results[6]["detail"]
+    assert lines[-1] == {"summary": {"created": 2, "invalid": 1, "rejected": 2, "failed": 0}}
+
+    # One combined reservation per product, per-record retries for the short one,
+    # and the unit of product 2 held for line 4 is given back
+    assert calls[:3] == [("reserve", 1, 6), ("reserve", 2, 2), ("reserve", 99, 1)]
+    assert calls[3:] == [("reserve", 1, 2), ("reserve", 1, 2), ("reserve", 1, 2), ("release", 2, 1)]
+    assert stock == {1: 1, 2: 99}
+    assert client.get("/orders/7").json()["items"][0]["quantity"] == 2
+
+
+def test_bulk_create_inserts_in_multi_row_chunks(client, stocked_product_service):
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        if statement.startswith("INSERT"):
+            statements.append(statement)
+
+    body = "\n".join(bulk_line((2, 1)) for _ in range(60))
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        response = client.post("/orders/bulk", content=body)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert json.loads(response.text.splitlines()[-1])["summary"]["created"] == 60
+    # One INSERT for the orders and one for their items
+    assert len(statements) == 2
+
+
+@pytest.fixture
+def flaky_product_service(monkeypatch):
+    """A fake product-service whose next answers per (action, product_id) can be scripted."""
+    stock = {1: 5, 2: 100}
+    calls = []
+    scripted = {}
+
+    def handler(request: httpx.Request):
+        _, _, product_id, action = request.url.path.split("/")
+        product_id, quantity = int(product_id), int(request.url.params["quantity"])
+        calls.append((action, product_id, quantity))
+        answers = scripted.get((action, product_id))
+        if answers:
+            return answers.pop(0)
+        stock[product_id] += -quantity if action == "reserve" else quantity
+        return httpx.Response(200, json={"success": True})
+
+    monkeypatch.setattr(bulk_orders, "BULK_ORDER_RETRY_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(clients, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return stock, calls, scripted
+
+
+def test_bulk_create_retries_rate_limited_and_failed_stock_calls(client, flaky_product_service):
+    stock, calls, scripted = flaky_product_service
+    scripted[("reserve", 1)] = [httpx.Response(429, headers={"Retry-After": "0"}), httpx.Response(503)]
+    response = client.post("/orders/bulk", content=bulk_line((1, 2)))
+    assert json.loads(response.text.splitlines()[-1])["summary"]["created"] == 1
+    assert calls == [("reserve", 1, 2)] * 3
+    assert stock[1] == 3
+
+
+def test_failed_release_is_queued_and_retried(client, flaky_product_service):
+    stock, calls, scripted = flaky_product_service
+    # Product 2 is short, so the unit of product 1 held for the record is given back, but that keeps failing
+    scripted[("reserve", 2)] = [httpx.Response(400, json={"detail": "Not enough stock available"}) for _ in range(2)]
+    scripted[("release", 1)] = [httpx.Response(500) for _ in range(bulk_orders.BULK_ORDER_STOCK_RETRIES + 1)]
+    response = client.post("/orders/bulk", content=bulk_line((1, 1), (2, 1)))
+    assert json.loads(response.text.splitlines()[-1])["summary"]["rejected"] == 1
+    assert stock[1] == 4
+
+    db = TestingSessionLocal()
+    try:
+        [queued] = db.query(PendingStockReleaseModel).all()
+        assert (queued.product_id, queued.quantity) == (1, 1)
+        released = asyncio.run(bulk_orders.retry_pending_releases(db, clients.get_client(), "http://product"))
+        assert released == 1
+        assert db.query(PendingStockReleaseModel).count() == 0
+    finally:
+        db.close()
+    assert stock[1] == 5
+
+
+def test_bulk_import_releases_held_stock_when_client_disconnects(client, flaky_product_service):
+    stock, calls, _ = flaky_product_service
+    records = [bulk_orders.BulkRecord(line, OrderCreate.parse_raw(bulk_line((1, 2), (2, 1)))) for line in (1, 2)]
+    db = TestingSessionLocal()
+
+    async def disconnect_after_first_result():
+        results = bulk_orders.import_orders(db, clients.get_client(), "http://product", records, chunk_size=1)
+        first = json.loads(await results.__anext__())
+        # The client goes away: the response stops iterating and closes the generator
+        await results.aclose()
+        return first
+
+    try:
+        assert asyncio.run(disconnect_after_first_result())["status"] == "created"
+    finally:
+        db.close()
+    # Only the first record became an order; stock held for the second is back
+    assert sorted(calls[-2:]) == [("release", 1, 2), ("release", 2, 1)]
+    assert stock == {1: 3, 2: 99}
+
+
+def test_ready_waits_for_warm_up(client, monkeypatch):
+    monkeypatch.setattr(warmup, "state", warmup.WarmupState(enabled=True))
+    assert client.get("/ready").status_code == 503
+    warmup.state.ready = True
+    assert client.get("/ready").json()["status"] == "ready"
+
+
+@pytest.fixture
+def rpc_product_service(monkeypatch):
+    """A fake product-service RPC listener with the same stock rules as stocked_product_service."""
+    stock = {1: 5, 2: 100}
+    calls = []
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            while True:
+                header = self.request.recv(rpc_client.REQUEST_HEADER.size, socket.MSG_WAITALL)
+                if len(header) < rpc_client.REQUEST_HEADER.size:
+                    return
+                length, request_id, method = rpc_client.REQUEST_HEADER.unpack(header)
+                payload = self.request.recv(length - 5, socket.MSG_WAITALL)
+                if method == rpc_client.AUTH:
+                    self.request.sendall(rpc_client.RESPONSE_HEADER.pack(6, request_id, 200 if payload == b"s3cret" else 401))
+                    continue
+                product_id, quantity = rpc_client.STOCK_CHANGE.unpack(payload)
+                action = "reserve" if method == rpc_client.RESERVE else "release"
+                calls.append((action, product_id, quantity))
+                if product_id not in stock:
+                    status, body = 404, b"Product not found"
+                elif action == "reserve" and stock[product_id] < quantity:
+                    status, body = 400, b"Not enough stock available"
+                else:
+                    stock[product_id] += -quantity if action == "reserve" else quantity
+                    status, body = 200, rpc_client.STOCK_LEVEL.pack(stock[product_id])
+                self.request.sendall(rpc_client.RESPONSE_HEADER.pack(len(body) + 6, request_id, status) + body)
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(rpc_client, "PRODUCT_RPC_URL", f"tcp://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(clients, "SERVICE_AUTH_TOKEN", "s3cret")
+    monkeypatch.setattr(rpc_client, "_client", None)
+    rest_calls = []
+    monkeypatch.setattr(clients, "_client", httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: rest_calls.append(request) or httpx.Response(500))
+    ))
+    yield stock, calls, rest_calls
+    server.shutdown()
+    server.server_close()
+
+
+def test_bulk_create_reserves_over_rpc_when_configured(client, rpc_product_service):
+    stock, calls, rest_calls = rpc_product_service
+    body = "\n".join([bulk_line((1, 2), (2, 1)), bulk_line((1, 2)), bulk_line((1, 2), (2, 1)), bulk_line((99, 1))])
+    response = client.post("/orders/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[-1] == {"summary": {"created": 2, "invalid": 0, "rejected": 2, "failed": 0}}
+    assert sorted(calls[:3]) == [("reserve", 1, 6), ("reserve", 2, 2), ("reserve", 99, 1)]
+    assert stock == {1: 1, 2: 99}
+    assert rest_calls == []
+
+
+def test_create_order_over_rpc_maps_errors_like_rest(client, rpc_product_service, monkeypatch):
+    stock, _, rest_calls = rpc_product_service
+    order = {"customer_id": "customer-3", "shipping_address": "2 Test Street",
+             "items": [{"product_id": 1, "quantity": 2}]}
+    assert client.post("/orders", json=order).status_code == 201
+    assert stock[1] == 3
+
+    # TestClient runs each request on a new event loop; the RPC connection belongs to one loop
+    monkeypatch.setattr(rpc_client, "_client", None)
+    order["items"] = [{"product_id": 1, "quantity": 9}]
+    response = client.post("/orders", json=order)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Failed to reserve product 1: Not enough stock available"
+    assert rest_calls == []
+
+    # Values the wire format cannot carry are rejected like REST does, not with a 500
+    order["items"] = [{"product_id": 1, "quantity": 2 ** 31}]
+    response = client.post("/orders", json=order)
+    assert response.status_code == 400 and "Invalid product ID or quantity" in response.json()["detail"]
+    order["items"] = [{"product_id": 1, "quantity": 9}]
+
+    # A connection without the service token is refused
+    port = int(rpc_client.PRODUCT_RPC_URL.rsplit(":", 1)[1])
+    monkeypatch.setattr(rpc_client, "_client", rpc_client.RpcClient("127.0.0.1", port, token="wrong"))
+    assert client.post("/orders", json=order).status_code == 503
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+    monkeypatch.setattr(rpc_client, "_client", rpc_client.RpcClient("127.0.0.1", closed_port, timeout=1))
+    assert client.post("/orders", json=order).status_code == 503
+
+
+def test_rpc_client_decodes_products():
+    payload = b"".join([
+        rpc_client.COUNT.pack(1),
+        rpc_client.PRODUCT.pack(7, 9.5, 3, True, 1_700_000_000_123_456, 1_700_000_000_123_456),
+        rpc_client.STRING_LENGTH.pack(4), b"Lamp",
+        rpc_client.STRING_LENGTH.pack(rpc_client.NULL_STRING),
+        rpc_client.STRING_LENGTH.pack(4), b"Home",
+        rpc_client.COUNT.pack(2), rpc_client.PRODUCT_ID.pack(8), rpc_client.PRODUCT_ID.pack(9),
+    ])
+    assert rpc_client.decode_products(payload) == {
+        "products": [{
+            "name": "Lamp", "description": None, "price": 9.5, "category": "Home", "id": 7, "stock": 3,
+            "is_active": True, "created_at": "2023-11-14T22:13:20.123456", "updated_at": "2023-11-14T22:13:20.123456",
+        }],
+        "missing": [8, 9],
+    }
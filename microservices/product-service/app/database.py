@@ -1,9 +1,17 @@
 import os
-from sqlalchemy import create_engine
+import threading
+import time
+from typing import List, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 import logging
 from app.models import Base
+from app.pool import create_pooled_engine
+from app.tracing import instrument_engine
+from app.sqlstats import record_statements
 
 logger = logging.getLogger(__name__)
 
@@ -13,18 +21,103 @@ DB_PORT = os.getenv("DB_PORT", "5433")
 DB_USER = os.getenv("DB_USER", "yugabyte")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "yugabyte")
 DB_NAME = os.getenv("DB_NAME", "productdb")
+# Size of each pool (primary and read); app.server sets these from the pod's connection budget
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Comma-separated YugabyteDB tservers that serve reads (defaults to DB_HOST)
+DB_READ_HOSTS = [h.strip() for h in os.getenv("DB_READ_HOSTS", DB_HOST).split(",") if h.strip()]
+# Let reads be served by tablet followers, at most DB_FOLLOWER_READ_STALENESS_MS stale
+DB_FOLLOWER_READS = os.getenv("DB_FOLLOWER_READS", "false").lower() == "true"
+DB_FOLLOWER_READ_STALENESS_MS = int(os.getenv("DB_FOLLOWER_READ_STALENESS_MS", "30000"))
+# How long a read host that failed to connect is skipped
+DB_HOST_RETRY_SECONDS = float(os.getenv("DB_HOST_RETRY_SECONDS", "30"))
 
 # Construct the database URL
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # Create the SQLAlchemy engine
-engine = create_engine(
+# Idle connections are health-checked in the background instead of pinged on every checkout (see app/pool.py)
+engine = create_pooled_engine(
     SQLALCHEMY_DATABASE_URL,
-    pool_pre_ping=True,  # This helps with connection validation
-    pool_size=5,         # Keep connection pool size limited for resource efficiency
-    max_overflow=10,     # Allow up to 10 connections beyond pool_size
+    pool_size=DB_POOL_SIZE,        # Keep connection pool size limited for resource efficiency
+    max_overflow=DB_MAX_OVERFLOW,  # Connections allowed beyond pool_size
     pool_recycle=3600,   # Recycle connections after one hour
 )
+instrument_engine(engine)
+record_statements(engine)
+
+
+def enable_follower_reads(read_engine: Engine, staleness_ms: int = DB_FOLLOWER_READ_STALENESS_MS):
+    """Make every connection of read_engine read-only and allowed to read from followers."""
+    @event.listens_for(read_engine, "connect")
+    def _set_follower_reads(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET default_transaction_read_only = true")
+        cursor.execute("SET yb_read_from_followers = true")
+        cursor.execute(f"SET yb_follower_read_staleness_ms = {int(staleness_ms)}")
+        cursor.close()
+        # Commit so the settings survive the rollback SQLAlchemy does on checkin
+        dbapi_connection.commit()
+
+
+def create_read_engine(host: str) -> Engine:
+    url = f"postgresql://{DB_USER}:{DB_PASSWORD}@{host}:{DB_PORT}/{DB_NAME}"
+    read_engine = create_pooled_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        role="read",
+        pool_recycle=3600,
+    )
+    if DB_FOLLOWER_READS:
+        enable_follower_reads(read_engine)
+    instrument_engine(read_engine)
+    record_statements(read_engine)
+    return read_engine
+
+
+class ReadWriteRouter:
+    """Sends writes to the primary engine and spreads reads over read engines.
+
+    Read engines are picked round-robin. One whose connection fails is
+    skipped for `retry_after` seconds; if none are healthy, reads fall back
+    to the primary.
+    """
+
+    def __init__(self, primary: Engine, readers: Optional[List[Engine]] = None,
+                 retry_after: float = DB_HOST_RETRY_SECONDS):
+        self.primary = primary
+        self.readers = list(readers or [primary])
+        self.retry_after = retry_after
+        self._down_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def reader(self) -> Engine:
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.readers)):
+                candidate = self.readers[self._next % len(self.readers)]
+                self._next += 1
+                if self._down_until.get(candidate, 0) <= now:
+                    return candidate
+        return self.primary
+
+    def mark_failed(self, read_engine: Engine):
+        if read_engine is self.primary:
+            return
+        logger.warning("Read host %s failed, skipping it for %ss", read_engine.url.host, self.retry_after)
+        with self._lock:
+            self._down_until[read_engine] = time.monotonic() + self.retry_after
+
+
+# Reads from DB_HOST share the primary's pool unless follower reads need their own
+# read-only connections; app.server then counts that second pool in the budget
+read_engines = [
+    engine if host == DB_HOST and not DB_FOLLOWER_READS else create_read_engine(host)
+    for host in DB_READ_HOSTS
+]
+router = ReadWriteRouter(engine, read_engines)
 
 # Create a SessionLocal class
 # Each instance of this class will be a database session
@@ -35,6 +128,10 @@ async def init_db():
     try:
         # Create all tables if they don't exist
         Base.metadata.create_all(bind=engine)
+        # create_all skips existing tables, so add indexes declared after they were created
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
         logger.info("Database tables created successfully")
         
         # Add some sample data if database is empty
@@ -82,17 +179,50 @@ async def init_db():
             ]
             db.add_all(sample_products)
             db.commit()
-            logger.info(f"Added {len(sample_products)} sample products")
+            logger.info("Added %s sample products", len(sample_products))
         
         db.close()
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database: %s", e)
         raise
 
 def get_db():
-    """Dependency for getting the database session."""
-    db = SessionLocal()
+    """Dependency for getting the database session (primary, for writes)."""
+    db = SessionLocal(bind=router.primary)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def connect_reader() -> Tuple[Session, Engine]:
+    """A session already connected to a read host, and that host's engine.
+
+    A read host that cannot be reached is skipped and the read retried
+    once on the next healthy one, then on the primary, so the request
+    that finds a host down does not fail because of it.
+    """
+    read_engine = router.reader()
+    for fallback in (router.reader, lambda: router.primary):
+        db = SessionLocal(bind=read_engine)
+        try:
+            db.connection()
+            return db, read_engine
+        except OperationalError:
+            db.close()
+            if read_engine is router.primary:
+                raise
+            router.mark_failed(read_engine)
+            read_engine = fallback()
+    # Connection errors on the primary surface as they do for writes
+    return SessionLocal(bind=read_engine), read_engine
+
+def get_read_db():
+    """Dependency for getting a read-only database session from a read host."""
+    db, read_engine = connect_reader()
     try:
         yield db
+    except OperationalError:
+        router.mark_failed(read_engine)
+        raise
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
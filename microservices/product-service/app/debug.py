@@ -0,0 +1,182 @@
+"""Authenticated debug endpoints for profiling a live worker.
+
+Everything here is disabled (404) unless DEBUG_TOKEN is set, and every
+call must send the same value in the X-Debug-Token header. Profiles cover
+the worker process that served the request; with several gunicorn workers
+repeat the call to sample the others.
+
+- GET /debug/profile?seconds=N samples the whole process for N seconds
+  and returns collapsed stacks (feed to flamegraph.pl or speedscope).
+- Sending "X-Profile: 1" with any request profiles only that request;
+  the response carries an X-Profile-Id to fetch from
+  GET /debug/profile/requests/{profile_id}.
+- With PROFILE_CONTINUOUS_HZ > 0 a low-rate sampler runs all the time and
+  GET /debug/profile/top returns the hottest frames of the rolling window.
+- GET /debug/sql lists the heaviest SQL fingerprints (see app/sqlstats.py);
+  DELETE /debug/sql resets them.
+- GET /debug/pool shows the DB connection pools: size, usage, checkout
+  wait and hold times, and the last sizing recommendation (app/pool.py).
+"""
+import asyncio
+import hmac
+import os
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from app import pool, sqlstats
+from app.profiling import (
+    PROFILE_CONTINUOUS_HZ, PROFILE_INTERVAL_MS,
+    ContinuousProfiler, StackSampler, profile_process, profile_task,
+)
+
+logger = logging.getLogger(__name__)
+
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+# Per-request profiles kept for retrieval; the oldest are dropped first
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "50"))
+
+_request_profiles = OrderedDict()
+continuous_profiler: Optional[ContinuousProfiler] = None
+
+
+def debug_token_valid(token: Optional[str]) -> bool:
+    return bool(DEBUG_TOKEN) and token is not None and hmac.compare_digest(token, DEBUG_TOKEN)
+
+
+async def verify_debug_token(x_debug_token: Optional[str] = Header(None)):
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not debug_token_valid(x_debug_token):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+def _loop_sampler() -> StackSampler:
+    # Must be called on the event loop thread
+    return StackSampler(asyncio.get_running_loop(), threading.get_ident())
+
+
+def _store_profile(profile_id: str, collapsed: str):
+    _request_profiles[profile_id] = collapsed
+    while len(_request_profiles) > PROFILE_MAX_STORED:
+        _request_profiles.popitem(last=False)
+
+
+def _collapsed_response(collapsed: str, name: str) -> PlainTextResponse:
+    return PlainTextResponse(
+        collapsed, headers={"Content-Disposition": f'attachment; filename="{name}.collapsed"'}
+    )
+
+
+debug_router = APIRouter(dependencies=[Depends(verify_debug_token)])
+
+
+@debug_router.get("/profile")
+async def profile(
+    seconds: float = Query(10, ge=0.1, le=60),
+    interval_ms: float = Query(PROFILE_INTERVAL_MS, ge=1, le=1000),
+):
+    """Sample every thread and task of this worker for `seconds`."""
+    running = profile_process(_loop_sampler(), interval_ms / 1000)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        running.stop()
+    logger.info("Captured %s-second profile (%s samples)", seconds, running.samples)
+    return _collapsed_response(running.collapsed(), f"profile-{os.getpid()}")
+
+
+@debug_router.get("/profile/top")
+async def profile_top(limit: int = Query(20, ge=1, le=500), seconds: Optional[int] = Query(None, ge=1)):
+    if continuous_profiler is None:
+        raise HTTPException(status_code=404, detail="Continuous profiling is disabled")
+    return continuous_profiler.top(limit, seconds)
+
+
+@debug_router.get("/profile/requests/{profile_id}")
+async def request_profile(profile_id: str):
+    collapsed = _request_profiles.get(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return _collapsed_response(collapsed, f"request-{profile_id}")
+
+
+@debug_router.get("/sql")
+async def sql_stats(
+    limit: int = Query(20, ge=1, le=500),
+    order_by: str = Query("total", regex="^(total|count|mean|p95|max)$"),
+):
+    return {"slow_query_ms": sqlstats.SQL_SLOW_QUERY_MS, "statements": sqlstats.stats.top(limit, order_by)}
+
+
+@debug_router.delete("/sql")
+async def reset_sql_stats():
+    sqlstats.stats.reset()
+    return {"reset": True}
+
+
+@debug_router.get("/pool")
+async def pool_stats():
+    return {
+        "connection_budget": pool.replica_budget(),
+        "cluster_connection_budget": pool.DB_CLUSTER_CONNECTION_BUDGET,
+        "max_replicas": pool.DB_MAX_REPLICAS,
+        "pre_ping": pool.DB_POOL_PRE_PING,
+        "pools": pool.pool_status(),
+    }
+
+
+class RequestProfilingMiddleware:
+    """Profiles single requests that opt in with an X-Profile header.
+
+    Must be registered inside any BaseHTTPMiddleware (i.e. added before
+    the @app.middleware functions) so the endpoint runs in the task being
+    sampled. Sync endpoints show up as the task awaiting the threadpool.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not DEBUG_TOKEN:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-debug-token")
+        if b"x-profile" not in headers or not debug_token_valid(token.decode("latin-1") if token else None):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+        running = profile_task(_loop_sampler(), asyncio.current_task())
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            running.stop()
+            _store_profile(profile_id, running.collapsed())
+
+
+def start_continuous_profiler():
+    """Start the rolling-window sampler if PROFILE_CONTINUOUS_HZ is set; call on the event loop."""
+    global continuous_profiler
+    if PROFILE_CONTINUOUS_HZ > 0 and continuous_profiler is None:
+        continuous_profiler = ContinuousProfiler(_loop_sampler(), PROFILE_CONTINUOUS_HZ).start()
+        logger.info("Continuous profiling at %s Hz", PROFILE_CONTINUOUS_HZ)
+
+
+def stop_continuous_profiler():
+    global continuous_profiler
+    if continuous_profiler is not None:
+        continuous_profiler.stop()
+        continuous_profiler = None
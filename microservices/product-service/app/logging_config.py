@@ -0,0 +1,163 @@
+"""Non-blocking JSON logging.
+
+Request handlers only enqueue log records; a QueueListener thread does the
+formatting and the stdout write. Messages use %-style arguments so the
+formatting cost is paid in the listener thread, which means arguments
+should be plain values (ids, names, counts), not live ORM objects.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Records waiting for the listener thread; beyond this they are dropped and counted
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Per call site, INFO/DEBUG records beyond LOG_SAMPLE_BURST per second are sampled 1 in LOG_SAMPLE_EVERY
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "20"))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Thin out high-volume INFO/DEBUG records per call site.
+
+    The first `burst` records from a call site in each one-second window are
+    kept; after that only every `every`-th one is. WARNING and above always
+    pass, and so do trace spans (records with a `span` extra), since a trace
+    missing some of its spans is misleading.
+    """
+
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = max(1, every)
+        self.sampled_out = 0
+        self._second = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or hasattr(record, "span"):
+            return True
+        key = (record.name, record.msg)
+        second = int(record.created)
+        with self._lock:
+            if second != self._second:
+                # New window: dropping old counts also keeps the dict bounded
+                self._second, self._counts = second, {}
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+        if count <= self.burst or (count - self.burst) % self.every == 0:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave msg/args untouched so formatting happens in the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class OverflowReportingHandler(logging.StreamHandler):
+    """Stream handler that reports records dropped by the queue handler."""
+
+    def __init__(self, queue_handler: BoundedQueueHandler):
+        super().__init__()
+        self.queue_handler = queue_handler
+        self.reported = 0
+
+    def emit(self, record: logging.LogRecord):
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported:
+            notice = logging.LogRecord(
+                "app.logging", logging.WARNING, __file__, 0,
+                "Log queue overflowed, dropped %d records", (dropped - self.reported,), None,
+            )
+            self.reported = dropped
+            super().emit(notice)
+        super().emit(record)
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    """Route all logging through a bounded queue drained by a background thread."""
+    global _listener
+    if _listener is not None:
+        return
+
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+    stream_handler = OverflowReportingHandler(queue_handler)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> dict:
+    """Counters for the queue handler installed by configure_logging."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            sampler = next((f for f in handler.filters if isinstance(f, SamplingFilter)), None)
+            return {
+                "queued": handler.queue.qsize(),
+                "dropped": handler.dropped,
+                "sampled_out": sampler.sampled_out if sampler else 0,
+            }
+    return {"queued": 0, "dropped": 0, "sampled_out": 0}
@@ -1,23 +1,29 @@
+import asyncio
 import os
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import httpx
+from fastapi.responses import JSONResponse, PlainTextResponse
 import logging
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 import uvicorn
-from app.models import Product, ProductCreate, ProductUpdate, ProductModel
-from app.database import init_db, get_db, SessionLocal
+from app.models import Product, ProductCreate, ProductUpdate, ProductModel, ProductBatch, ProductBatchRequest
+from app.database import init_db, connect_reader, get_db, get_read_db, SessionLocal, router
+from app import conditional, fieldsets
+from app.logging_config import configure_logging
+from app import tracing
+from app.policy import OPA_URL, check_policy
+from app.ratelimit import rate_limit
+from app import clients, debug, pool, rpc, sqlstats, warmup
 from sqlalchemy.orm import Session
 import time
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# Configure logging (JSON lines written by a background thread, see app/logging_config.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Product Service API", version="0.1.0")
+# Rate limiting runs before any route dependency, so shed requests skip OPA and the DB
+app = FastAPI(title="Product Service API", version="0.1.0", dependencies=[Depends(rate_limit)])
 
 # CORS Middleware
 app.add_middleware(
@@ -28,10 +34,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# OPA endpoint
-OPA_URL = os.getenv("OPA_URL", "http://opa.default.svc.cluster.local:8181/v1/data/productservice/allow")
+# Opt-in per-request profiling; must sit inside the timing middleware below
+# so the endpoint runs in the task it samples
+app.add_middleware(debug.RequestProfilingMiddleware)
+
 # Order service endpoint
 ORDER_SERVICE_URL = os.getenv("ORDER_SERVICE_URL", "http://order-service.default.svc.cluster.local:8000")
+# Maximum number of IDs accepted by a single multi-get request
+PRODUCT_BATCH_MAX_SIZE = int(os.getenv("PRODUCT_BATCH_MAX_SIZE", "100"))
+# Sharded-inventory mode: hot products can split their stock over several rows
+STOCK_SHARDING = os.getenv("STOCK_SHARDING", "false").lower() == "true"
+# Default number of shards used when a product is switched to sharded stock
+STOCK_SHARDS = int(os.getenv("STOCK_SHARDS", "8"))
+# Fields that can be requested with ?fields=
+PRODUCT_FIELDS = list(Product.__fields__)
 
 # Middleware for request timing (useful for monitoring)
 @app.middleware("http")
@@ -42,78 +58,217 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
-# Dependency to check OPA policies
-async def check_policy(request: Request):
-    # Skip OPA check during healthcheck
-    if request.url.path == "/health":
-        return True
-        
-    # Prepare input for OPA
-    headers = dict(request.headers)
-    method = request.method
-    path = request.url.path
-    
-    input_data = {
-        "input": {
-            "method": method,
-            "path": path,
-            "headers": headers,
-        }
-    }
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(OPA_URL, json=input_data)
-            if response.status_code != 200:
-                logger.error(f"OPA service error: {response.text}")
-                raise HTTPException(status_code=403, detail="Policy check failed")
-            
-            result = response.json()
-            if not result.get("result", False):
-                raise HTTPException(status_code=403, detail="Request denied by policy")
-                
-    except httpx.RequestError as e:
-        logger.error(f"Error connecting to OPA: {e}")
-        # In case OPA is unreachable, we could define a fallback policy
-        # For now, we'll allow the request to proceed to avoid blocking legitimate traffic
-        logger.warning("OPA unreachable, applying fallback policy (allow request)")
-        return True
-        
-    return True
+# Root span per request; registered after the timing middleware so it wraps it
+app.add_middleware(tracing.TracingMiddleware)
+tracing.instrument_serialization()
 
 # Database initialization
 @app.on_event("startup")
 async def startup_event():
     await init_db()
     logger.info("Database initialized")
+    debug.start_continuous_profiler()
+    # Health-checks idle DB connections and logs sizing advice under pressure (app/pool.py)
+    app.state.pool_manager = asyncio.create_task(pool.run_pool_manager())
+    if warmup.WARMUP_ENABLED:
+        # Awaited: the worker only accepts connections after startup, so none reach it cold
+        await start_warmup()
+    if rpc.RPC_PORT:
+        # Binary stock/multi-get interface for order-service, next to the REST API (app/rpc.py);
+        # refuses to start without SERVICE_AUTH_TOKEN
+        app.state.rpc = await rpc.RpcServer(
+            write_session=lambda: SessionLocal(bind=router.primary),
+            read_session=lambda: connect_reader()[0],
+            stock_sharding=STOCK_SHARDING,
+            batch_max_size=PRODUCT_BATCH_MAX_SIZE,
+        ).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    task = getattr(app.state, "pool_manager", None)
+    if task is not None:
+        task.cancel()
+    rpc_server = getattr(app.state, "rpc", None)
+    if rpc_server is not None:
+        await rpc_server.stop()
+    debug.stop_continuous_profiler()
+    await clients.close_client()
+
+async def start_warmup():
+    from app import routes
+    queries = {
+        "products": lambda db: routes.get_products(db),
+        "product_page_keys": lambda db: routes.get_product_page_keys(db),
+        "products_by_ids": lambda db: routes.get_products_by_ids(db, [1])[0],
+    }
+    if STOCK_SHARDING:
+        queries["stock_shards"] = lambda db: routes.apply_sharded_stock(db, routes.get_products(db, 0, 10))
+    await warmup.warm_up(
+        engines=[router.primary, *router.readers],
+        session_factory=SessionLocal,
+        queries=queries,
+        response_types={"products": List[Product], "products_by_ids": List[Product]},
+        urls=[warmup.health_url(OPA_URL)],
+    )
+
+def parse_product_ids(ids: str) -> List[int]:
+    """Parse a comma-separated list of product IDs, enforcing the batch cap."""
+    try:
+        product_ids = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    check_batch_size(product_ids)
+    return product_ids
+
+def check_batch_size(product_ids: List[int]):
+    if len(product_ids) > PRODUCT_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many product IDs requested. Requested: {len(product_ids)}, Maximum: {PRODUCT_BATCH_MAX_SIZE}"
+        )
 
 # Routes
 @app.get("/health")
 def health_check():
     return {"status": "healthy", "service": "product-service"}
 
+# Readiness probe: workers only serve once warmed up (app/warmup.py); 503 if this one is not
+@app.get("/ready")
+def readiness_check():
+    if not warmup.state.ready:
+        return JSONResponse(status_code=503, content={"status": "warming up", "service": "product-service"})
+    return {
+        "status": "ready",
+        "service": "product-service",
+        "warmup_seconds": warmup.state.seconds,
+        "warmup_failures": warmup.state.failures,
+    }
+
+# Prometheus scrape target (see kubernetes/monitoring/service-monitors.yaml); per worker process
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(sqlstats.stats.prometheus() + pool.prometheus(), media_type="text/plain; version=0.0.4")
+
 # Implement route functions directly instead of importing
 
+def sharded_stock_totals(db: Session, product_ids: List[int], field_list: Optional[List[str]]) -> Dict[int, int]:
+    """Shard totals of sharded products among product_ids, if the response includes stock"""
+    if not STOCK_SHARDING or (field_list is not None and "stock" not in field_list):
+        return {}
+    from app.routes import get_sharded_stock_totals
+    return get_sharded_stock_totals(db, product_ids)
+
+def stock_validators(validators: Tuple[str, Optional[datetime]], totals: Dict[int, int]):
+    """Fold sharded stock totals into (ETag, Last-Modified).
+
+    Reservations on sharded stock update shard rows, not products.updated_at,
+    so the ETag also covers the totals, and Last-Modified is dropped since it
+    would not move when stock does.
+    """
+    etag, last_modified = validators
+    if not totals:
+        return etag, last_modified
+    return conditional.make_etag(etag, sorted(totals.items())), None
+
 @app.get("/products", response_model=List[Product])
 async def get_products(
+    request: Request,
+    response: Response,
     skip: int = 0, 
     limit: int = 100,
-    db: Session = Depends(get_db),
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     _: bool = Depends(check_policy)
 ):
-    """Get all products with pagination"""
-    return db.query(ProductModel).offset(skip).limit(limit).all()
+    """Get all products with pagination, or specific products with ?ids=1,2,3.
+
+    ?fields=id,name,price returns (and loads) only those fields.
+    """
+    from app import routes
+    product_ids = parse_product_ids(ids) if ids is not None else None
+    field_list = fieldsets.parse_fields(fields, PRODUCT_FIELDS)
+    salt = ("ids", ids) if product_ids is not None else ("page", skip, limit)
+    salt += fieldsets.fields_salt(field_list)
+
+    # Answer conditional requests from (id, updated_at) alone before loading full rows
+    if conditional.is_conditional(request):
+        if product_ids is not None:
+            keys = routes.get_product_keys_by_ids(db, product_ids)
+        else:
+            keys = routes.get_product_page_keys(db, skip, limit)
+        etag, last_modified = stock_validators(
+            conditional.page_validators(keys, *salt),
+            sharded_stock_totals(db, [key[0] for key in keys], field_list),
+        )
+        if conditional.is_not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+    if product_ids is not None:
+        products, missing = routes.get_products_by_ids(db, product_ids, field_list)
+        if missing:
+            response.headers["X-Missing-Ids"] = ",".join(str(pid) for pid in missing)
+    else:
+        products = routes.get_products(db, skip, limit, field_list)
+    totals = sharded_stock_totals(db, [p.id for p in products], field_list)
+    routes.apply_sharded_stock(db, products, totals)
+    etag, last_modified = stock_validators(
+        conditional.page_validators(((p.id, p.updated_at) for p in products), *salt), totals
+    )
+    conditional.set_validators(response, etag, last_modified)
+    if field_list is not None:
+        return fieldsets.sparse_response([fieldsets.sparse(p, field_list) for p in products], response)
+    return products
+
+@app.post("/products/batch", response_model=ProductBatch)
+async def get_products_batch(
+    batch: ProductBatchRequest,
+    response: Response,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    _: bool = Depends(check_policy)
+):
+    """Get many products by ID in one query, reporting IDs that do not exist"""
+    check_batch_size(batch.ids)
+    field_list = fieldsets.parse_fields(fields, PRODUCT_FIELDS)
+    from app.routes import get_products_by_ids
+    products, missing = get_products_by_ids(db, batch.ids, field_list)
+    if field_list is not None:
+        return fieldsets.sparse_response(
+            {"products": [fieldsets.sparse(p, field_list) for p in products], "missing": missing}, response
+        )
+    return {"products": products, "missing": missing}
 
 @app.get("/products/{product_id}", response_model=Product)
 async def get_product(
     product_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     _: bool = Depends(check_policy)
 ):
-    """Get a specific product by ID"""
-    product = db.query(ProductModel).filter(ProductModel.id == product_id).first()
-    if product is None:
-        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+    """Get a specific product by ID; ?fields= limits the fields returned"""
+    from app import routes
+    field_list = fieldsets.parse_fields(fields, PRODUCT_FIELDS)
+    salt = fieldsets.fields_salt(field_list)
+    if conditional.is_conditional(request):
+        etag, last_modified = stock_validators(
+            conditional.resource_validators(*routes.get_product_key(db, product_id), *salt),
+            sharded_stock_totals(db, [product_id], field_list),
+        )
+        if conditional.is_not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified)
+
+    product = routes.get_product(db, product_id, field_list)
+    totals = sharded_stock_totals(db, [product.id], field_list)
+    routes.apply_sharded_stock(db, [product], totals)
+    etag, last_modified = stock_validators(
+        conditional.resource_validators(product.id, product.updated_at, *salt), totals
+    )
+    conditional.set_validators(response, etag, last_modified)
+    if field_list is not None:
+        return fieldsets.sparse_response(fieldsets.sparse(product, field_list), response)
     return product
 
 @app.post("/products", response_model=Product, status_code=201)
@@ -133,7 +288,7 @@ async def create_product(
     db.add(db_product)
     db.commit()
     db.refresh(db_product)
-    logger.info(f"Created new product: {db_product.name} (ID: {db_product.id})")
+    logger.info("Created new product: %s (ID: %s)", db_product.name, db_product.id)
     return db_product
 
 @app.put("/products/{product_id}", response_model=Product)
@@ -143,17 +298,11 @@ async def update_product(
     db: Session = Depends(get_db),
     _: bool = Depends(check_policy)
 ):
-    """Update an existing product"""
-    db_product = get_product(db, product_id)
-    
-    # Update only provided fields
-    update_data = product_update.dict(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_product, key, value)
-        
-    db.commit()
-    db.refresh(db_product)
-    logger.info(f"Updated product: {db_product.name} (ID: {db_product.id})")
+    """Update an existing product; stock cannot be set once it is sharded (409)"""
+    from app import routes
+    db_product = routes.update_product(db, product_id, product_update, STOCK_SHARDING)
+    if STOCK_SHARDING:
+        routes.apply_sharded_stock(db, [db_product])
     return db_product
 
 @app.delete("/products/{product_id}", response_model=dict)
@@ -166,19 +315,33 @@ async def delete_product(
     db_product = get_product(db, product_id)
     db.delete(db_product)
     db.commit()
-    logger.info(f"Deleted product ID: {product_id}")
+    logger.info("Deleted product ID: %s", product_id)
     return {"success": True, "message": f"Product {product_id} deleted"}
 
 @app.get("/products/{product_id}/stock")
 async def check_product_stock(
     product_id: int,
+    db: Session = Depends(get_read_db),
+    _: bool = Depends(check_policy)
+):
+    from app.routes import get_stock_level
+    stock = get_stock_level(db, product_id, STOCK_SHARDING)
+    return {"product_id": product_id, "in_stock": stock > 0, "stock": stock}
+
+@app.post("/products/{product_id}/stock/shards")
+async def shard_product_stock(
+    product_id: int,
+    shards: int = STOCK_SHARDS,
     db: Session = Depends(get_db),
     _: bool = Depends(check_policy)
 ):
-    product = db.query(ProductModel).filter(ProductModel.id == product_id).first()
-    if product is None:
-        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
-    return {"product_id": product_id, "in_stock": product.stock > 0, "stock": product.stock}
+    """Switch a product to sharded stock, spreading its stock over `shards` rows"""
+    if not STOCK_SHARDING:
+        raise HTTPException(status_code=400, detail="Sharded inventory is disabled (set STOCK_SHARDING=true)")
+    if shards < 1:
+        raise HTTPException(status_code=400, detail="shards must be at least 1")
+    from app.routes import shard_product_stock as shard_product_stock_route
+    return shard_product_stock_route(db, product_id, shards)
 
 @app.post("/products/{product_id}/reserve")
 async def reserve_product(
@@ -188,27 +351,24 @@ async def reserve_product(
     _: bool = Depends(check_policy)
 ):
     """Reserve products by reducing stock"""
-    product = db.query(ProductModel).filter(ProductModel.id == product_id).first()
-    if product is None:
-        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
-    
-    if product.stock < quantity:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Not enough stock available. Requested: {quantity}, Available: {product.stock}"
-        )
-    
-    product.stock -= quantity
-    db.commit()
-    db.refresh(product)
-    logger.info(f"Reserved {quantity} units of product ID: {product_id}")
-    
-    return {
-        "success": True,
-        "product_id": product_id,
-        "reserved_quantity": quantity,
-        "remaining_stock": product.stock
-    }
+    from app.routes import reserve_stock
+    return reserve_stock(db, product_id, quantity, STOCK_SHARDING)
+
+@app.post("/products/{product_id}/release")
+async def release_product(
+    product_id: int,
+    quantity: int,
+    db: Session = Depends(get_db),
+    _: bool = Depends(check_policy)
+):
+    """Return previously reserved stock (e.g. when an order could not be placed)"""
+    if quantity < 1:
+        raise HTTPException(status_code=400, detail="quantity must be at least 1")
+    from app.routes import release_stock
+    return release_stock(db, product_id, quantity, STOCK_SHARDING)
+
+app.include_router(debug.debug_router, prefix="/debug", tags=["debug"])
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Development server only; production runs `python -m app.server`
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, Field, validator
 from datetime import datetime
-from typing import Optional
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean
+from typing import List, Optional
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -20,6 +20,23 @@ class ProductModel(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Category listings page through a category in id order
+        Index("ix_products_category_id", "category", "id"),
+    )
+
+class ProductStockShardModel(Base):
+    """One sub-counter of a product's stock in sharded-inventory mode.
+
+    A sharded product's stock is the sum of its shards; reservations update
+    a single shard row so concurrent reservations rarely touch the same row.
+    """
+    __tablename__ = "product_stock_shards"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    stock = Column(Integer, nullable=False, default=0)
+
 # Pydantic models for API
 class ProductBase(BaseModel):
     name: str
@@ -70,4 +87,11 @@ class Product(ProductBase):
     updated_at: datetime
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class ProductBatchRequest(BaseModel):
+    ids: List[int] = Field(..., min_items=1)
+
+class ProductBatch(BaseModel):
+    products: List[Product]
+    missing: List[int]
@@ -0,0 +1,54 @@
+"""OPA authorization, shared by the main app and the snapshot app (app/snapshot_main.py)."""
+import os
+import logging
+
+import httpx
+from fastapi import HTTPException, Request
+
+from app import clients, tracing
+
+logger = logging.getLogger(__name__)
+
+# OPA endpoint
+OPA_URL = os.getenv("OPA_URL", "http://opa.default.svc.cluster.local:8181/v1/data/productservice/allow")
+
+# Dependency to check OPA policies
+async def check_policy(request: Request):
+    # Skip OPA check during healthcheck
+    if request.url.path == "/health":
+        return True
+        
+    # Prepare input for OPA
+    headers = dict(request.headers)
+    method = request.method
+    path = request.url.path
+    
+    input_data = {
+        "input": {
+            "method": method,
+            "path": path,
+            "headers": headers,
+        }
+    }
+    
+    try:
+        # Shared client: keeps the connection to OPA open between requests
+        client = clients.get_client()
+        with tracing.span("opa.check", path=path):
+            response = await client.post(OPA_URL, json=input_data, headers=tracing.inject_headers())
+        if response.status_code != 200:
+            logger.error("OPA service error: %s", response.text)
+            raise HTTPException(status_code=403, detail="Policy check failed")
+        
+        result = response.json()
+        if not result.get("result", False):
+            raise HTTPException(status_code=403, detail="Request denied by policy")
+            
+    except httpx.RequestError as e:
+        logger.error("Error connecting to OPA: %s", e)
+        # In case OPA is unreachable, we could define a fallback policy
+        # For now, we'll allow the request to proceed to avoid blocking legitimate traffic
+        logger.warning("OPA unreachable, applying fallback policy (allow request)")
+        return True
+        
+    return True
@@ -0,0 +1,200 @@
+"""Sampling profiler that understands asyncio.
+
+A background thread periodically captures stacks and counts them in
+collapsed-stack form ("outer;inner;leaf <count>"), which flamegraph.pl,
+speedscope and similar tools read directly.
+
+Plain thread stacks only show the coroutine that is running at that
+moment. Time spent awaiting (on OPA, product-service or a DB driver) would
+be invisible, so each suspended task is also sampled by walking its
+coroutine await chain; those stacks end in an "[awaiting]" frame.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, List, Optional
+
+# Default sampling interval for on-demand profiles
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Continuous low-rate sampling (0 disables) and how much of it is kept
+PROFILE_CONTINUOUS_HZ = float(os.getenv("PROFILE_CONTINUOUS_HZ", "0"))
+PROFILE_WINDOW_SECONDS = int(os.getenv("PROFILE_WINDOW_SECONDS", "300"))
+
+AWAITING = "[awaiting]"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _frame_stack(frame) -> List[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _coroutine_stack(task: asyncio.Task) -> List[str]:
+    """Outermost-first stack of a suspended task, following cr_await."""
+    stack = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if stack:
+        stack.append(AWAITING)
+    return stack
+
+
+class StackSampler:
+    """Captures one collapsed stack per thread and per suspended asyncio task."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, loop_thread_id: int):
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+
+    def thread_stacks(self) -> List[str]:
+        """Stacks of every thread except the calling (profiler) thread."""
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            root = "event-loop" if thread_id == self.loop_thread_id else f"thread:{names.get(thread_id, thread_id)}"
+            stacks.append(";".join([root] + _frame_stack(frame)))
+        return stacks
+
+    def task_stacks(self, only: Optional[asyncio.Task] = None) -> List[str]:
+        try:
+            tasks = [only] if only is not None else list(asyncio.all_tasks(self.loop))
+        except RuntimeError:
+            # The task set changed while we were copying it from another thread
+            return []
+        # The running task is on the loop thread's stack already
+        running = asyncio.current_task(self.loop)
+        stacks = []
+        for task in tasks:
+            if task is running or task.done():
+                continue
+            stack = _coroutine_stack(task)
+            if stack:
+                stacks.append(";".join([f"task:{task.get_name()}"] + stack))
+        return stacks
+
+    def task_running(self, task: asyncio.Task) -> Optional[str]:
+        """Stack of `task` if it is the one executing on the loop thread right now."""
+        if asyncio.current_task(self.loop) is not task:
+            return None
+        frame = sys._current_frames().get(self.loop_thread_id)
+        return ";".join([f"task:{task.get_name()}"] + _frame_stack(frame)) if frame is not None else None
+
+
+class Profile:
+    """Samples in a background thread until stopped; the result is a collapsed-stack Counter."""
+
+    def __init__(self, sample: Callable[[], List[str]], interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.sample = sample
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.counts.update(self.sample())
+            self.samples += 1
+            self._stop.wait(self.interval)
+
+    def start(self) -> "Profile":
+        self._thread.start()
+        return self
+
+    def stop(self) -> "Profile":
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+def profile_process(sampler: StackSampler, interval: float = PROFILE_INTERVAL_MS / 1000) -> Profile:
+    """Profile every thread and every suspended task of the process."""
+    return Profile(lambda: sampler.thread_stacks() + sampler.task_stacks(), interval).start()
+
+
+def profile_task(sampler: StackSampler, task: asyncio.Task, interval: float = PROFILE_INTERVAL_MS / 1000) -> Profile:
+    """Profile a single request task, whether it is running or awaiting."""
+    def sample():
+        running = sampler.task_running(task)
+        if running is not None:
+            return [running]
+        return sampler.task_stacks(only=task)
+
+    return Profile(sample, interval).start()
+
+
+class ContinuousProfiler:
+    """Low-rate sampling that keeps per-second frame counts for a rolling window."""
+
+    def __init__(self, sampler: StackSampler, hz: float = PROFILE_CONTINUOUS_HZ,
+                 window_seconds: int = PROFILE_WINDOW_SECONDS):
+        self.sampler = sampler
+        self.interval = 1 / hz
+        self.buckets = deque(maxlen=window_seconds)
+        # Held while the sampler thread updates buckets and while top() copies them
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="continuous-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            stacks = self.sampler.thread_stacks() + self.sampler.task_stacks()
+            second = int(time.time())
+            with self._lock:
+                if not self.buckets or self.buckets[-1][0] != second:
+                    self.buckets.append((second, Counter(), Counter()))
+                _, self_counts, total_counts = self.buckets[-1]
+                for stack in stacks:
+                    frames = stack.split(";")[1:]
+                    if not frames:
+                        continue
+                    self_counts[frames[-1]] += 1
+                    total_counts.update(set(frames))
+            self._stop.wait(self.interval)
+
+    def start(self) -> "ContinuousProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, limit: int = 20, seconds: Optional[int] = None) -> dict:
+        """Most frequent frames in the window: `self` counts the leaf frame, `total` any frame on the stack."""
+        cutoff = time.time() - seconds if seconds else 0
+        with self._lock:
+            # Copy under the lock: the current second's Counters are still being updated
+            buckets = [(second, leaf.copy(), total.copy()) for second, leaf, total in self.buckets if second >= cutoff]
+            window_seconds = len(self.buckets)
+        self_counts, total_counts = Counter(), Counter()
+        for _, leaf, total in buckets:
+            self_counts.update(leaf)
+            total_counts.update(total)
+        return {
+            "window_seconds": window_seconds,
+            "self": [{"frame": f, "samples": n} for f, n in self_counts.most_common(limit)],
+            "total": [{"frame": f, "samples": n} for f, n in total_counts.most_common(limit)],
+        }
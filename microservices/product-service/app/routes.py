@@ -1,27 +1,78 @@
+import random
+from sqlalchemy import func, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import HTTPException
-from typing import List, Optional
+from typing import Dict, List, Optional
 import logging
-from app.models import ProductModel, ProductCreate, ProductUpdate
+from app.models import ProductModel, ProductStockShardModel, ProductCreate, ProductUpdate
+from app.fieldsets import query_options
 
 logger = logging.getLogger(__name__)
 
-def get_products(db: Session, skip: int = 0, limit: int = 100):
-    """Get all products with pagination"""
-    return db.query(ProductModel).offset(skip).limit(limit).all()
+def get_products(db: Session, skip: int = 0, limit: int = 100, fields: Optional[List[str]] = None):
+    """Get all products with pagination, loading only `fields` if given"""
+    return db.query(ProductModel).options(*query_options(ProductModel, fields)).order_by(
+        ProductModel.id
+    ).offset(skip).limit(limit).all()
+
+def get_product_page_keys(db: Session, skip: int = 0, limit: int = 100):
+    """Get (id, updated_at) for a page of products without loading full rows"""
+    return db.query(ProductModel.id, ProductModel.updated_at).order_by(
+        ProductModel.id
+    ).offset(skip).limit(limit).all()
+
+def get_product_keys_by_ids(db: Session, product_ids: List[int]):
+    """Get (id, updated_at) for the given products, in request order"""
+    ordered_ids = list(dict.fromkeys(product_ids))
+    if not ordered_ids:
+        return []
+    rows = dict(db.query(ProductModel.id, ProductModel.updated_at).filter(
+        ProductModel.id.in_(ordered_ids)
+    ).all())
+    return [(pid, rows[pid]) for pid in ordered_ids if pid in rows]
+
+def get_product_key(db: Session, product_id: int):
+    """Get (id, updated_at) for a product without loading the full row"""
+    key = db.query(ProductModel.id, ProductModel.updated_at).filter(
+        ProductModel.id == product_id
+    ).first()
+    if key is None:
+        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+    return key
 
-def get_product(db: Session, product_id: int):
-    """Get a specific product by ID"""
-    product = db.query(ProductModel).filter(ProductModel.id == product_id).first()
+def get_product(db: Session, product_id: int, fields: Optional[List[str]] = None, for_update: bool = False):
+    """Get a specific product by ID, loading only `fields` if given (and locking its row if for_update)"""
+    query = db.query(ProductModel).options(*query_options(ProductModel, fields)).filter(
+        ProductModel.id == product_id
+    )
+    product = (query.with_for_update() if for_update else query).first()
     if product is None:
         raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
     return product
 
+def get_products_by_ids(db: Session, product_ids: List[int], fields: Optional[List[str]] = None):
+    """Get several products in one query, preserving the requested order.
+
+    Returns a tuple of (products, missing_ids). Duplicate IDs are collapsed
+    to their first occurrence.
+    """
+    ordered_ids = list(dict.fromkeys(product_ids))
+    if not ordered_ids:
+        return [], []
+    rows = db.query(ProductModel).options(*query_options(ProductModel, fields)).filter(
+        ProductModel.id.in_(ordered_ids)
+    ).all()
+    by_id = {product.id: product for product in rows}
+    products = [by_id[pid] for pid in ordered_ids if pid in by_id]
+    missing = [pid for pid in ordered_ids if pid not in by_id]
+    return products, missing
+
 def get_products_by_category(db: Session, category: str, skip: int = 0, limit: int = 100):
     """Get products filtered by category"""
     return db.query(ProductModel).filter(
         ProductModel.category == category
-    ).offset(skip).limit(limit).all()
+    ).order_by(ProductModel.id).offset(skip).limit(limit).all()
 
 def create_product(db: Session, product: ProductCreate):
     """Create a new product"""
@@ -35,21 +86,27 @@ def create_product(db: Session, product: ProductCreate):
     db.add(db_product)
     db.commit()
     db.refresh(db_product)
-    logger.info(f"Created new product: {db_product.name} (ID: {db_product.id})")
+    logger.info("Created new product: %s (ID: %s)", db_product.name, db_product.id)
     return db_product
 
-def update_product(db: Session, product_id: int, product_update: ProductUpdate):
+def update_product(db: Session, product_id: int, product_update: ProductUpdate, sharding: bool = False):
     """Update an existing product"""
     db_product = get_product(db, product_id)
     
     
     update_data = product_update.dict(exclude_unset=True)
+    # products.stock is no longer read once stock is sharded; writing it would be silently lost
+    if sharding and "stock" in update_data and get_stock_shards(db, product_id):
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stock of product {product_id} is sharded; change it with reserve and release"
+        )
     for key, value in update_data.items():
         setattr(db_product, key, value)
         
     db.commit()
     db.refresh(db_product)
-    logger.info(f"Updated product: {db_product.name} (ID: {db_product.id})")
+    logger.info("Updated product: %s (ID: %s)", db_product.name, db_product.id)
     return db_product
 
 def delete_product(db: Session, product_id: int):
@@ -57,7 +114,7 @@ def delete_product(db: Session, product_id: int):
     db_product = get_product(db, product_id)
     db.delete(db_product)
     db.commit()
-    logger.info(f"Deleted product ID: {product_id}")
+    logger.info("Deleted product ID: %s", product_id)
     return {"success": True, "message": f"Product {product_id} deleted"}
 
 def reserve_product(db: Session, product_id: int, quantity: int):
@@ -73,11 +130,191 @@ def reserve_product(db: Session, product_id: int, quantity: int):
     product.stock -= quantity
     db.commit()
     db.refresh(product)
-    logger.info(f"Reserved {quantity} units of product ID: {product_id}")
+    logger.info("Reserved %s units of product ID: %s", quantity, product_id)
     
     return {
         "success": True,
         "product_id": product_id,
         "reserved_quantity": quantity,
         "remaining_stock": product.stock
-    }
\ No newline at end of file
+    }
+
+def release_product(db: Session, product_id: int, quantity: int):
+    """Return reserved stock to a product, e.g. for an order that was not placed"""
+    stock = db.execute(
+        update(ProductModel)
+        .where(ProductModel.id == product_id)
+        .values(stock=ProductModel.stock + quantity)
+        .returning(ProductModel.stock)
+    ).scalar()
+    if stock is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+    db.commit()
+    return _release_result(product_id, quantity, stock)
+
+def _lock_unsharded(db: Session, product_id: int):
+    """Lock the product row, which shard_product_stock also locks, and return its shards.
+
+    Once this returns no shards, the product cannot be sharded until the
+    caller commits, so a change to products.stock is not lost to sharding.
+    """
+    get_product(db, product_id, for_update=True)
+    return get_stock_shards(db, product_id)
+
+def reserve_stock(db: Session, product_id: int, quantity: int, sharding: bool = False):
+    """Reserve stock, taking it from the shards if the product's stock is sharded"""
+    if sharding:
+        shards = get_stock_shards(db, product_id) or _lock_unsharded(db, product_id)
+        if shards:
+            return reserve_sharded_stock(db, product_id, quantity, shards)
+    return reserve_product(db, product_id, quantity)
+
+def release_stock(db: Session, product_id: int, quantity: int, sharding: bool = False):
+    """Return reserved stock, to a shard if the product's stock is sharded"""
+    if sharding:
+        shards = get_stock_shards(db, product_id) or _lock_unsharded(db, product_id)
+        if shards:
+            return release_sharded_stock(db, product_id, quantity, shards)
+    return release_product(db, product_id, quantity)
+
+def get_stock_level(db: Session, product_id: int, sharding: bool = False) -> int:
+    """Current stock of a product, summed over its shards if sharded"""
+    stock = get_product(db, product_id).stock
+    if sharding:
+        shards = get_stock_shards(db, product_id)
+        if shards:
+            stock = sum(shard_stock for _, shard_stock in shards)
+    return stock
+
+def get_stock_shards(db: Session, product_id: int, for_update: bool = False):
+    """Get (shard, stock) rows for a product; empty if its stock is not sharded"""
+    query = db.query(ProductStockShardModel.shard, ProductStockShardModel.stock).filter(
+        ProductStockShardModel.product_id == product_id
+    ).order_by(ProductStockShardModel.shard)
+    return (query.with_for_update() if for_update else query).all()
+
+def get_sharded_stock_totals(db: Session, product_ids: List[int]) -> Dict[int, int]:
+    """Stock totals of the sharded products among product_ids (others are left out)"""
+    if not product_ids:
+        return {}
+    return {product_id: int(total) for product_id, total in db.query(
+        ProductStockShardModel.product_id, func.sum(ProductStockShardModel.stock)
+    ).filter(
+        ProductStockShardModel.product_id.in_(product_ids)
+    ).group_by(ProductStockShardModel.product_id).all()}
+
+def apply_sharded_stock(db: Session, products: List[ProductModel], totals: Optional[Dict[int, int]] = None):
+    """Replace products' stock with their shard totals, for sharded products"""
+    if not products:
+        return products
+    if totals is None:
+        totals = get_sharded_stock_totals(db, [p.id for p in products])
+    for product in products:
+        if product.id in totals:
+            # Not a change to persist: products.stock is unused once sharded
+            set_committed_value(product, "stock", totals[product.id])
+    return products
+
+def shard_product_stock(db: Session, product_id: int, shards: int):
+    """Spread a product's stock over `shards` sub-counters (or re-spread existing shards).
+
+    The product row and its shard rows are locked before the total is read:
+    reservations and releases either commit before it (and are counted) or
+    wait for the new shards.
+    """
+    product = get_product(db, product_id, for_update=True)
+    existing = get_stock_shards(db, product_id, for_update=True)
+    total = sum(stock for _, stock in existing) if existing else product.stock
+
+    db.query(ProductStockShardModel).filter(
+        ProductStockShardModel.product_id == product_id
+    ).delete(synchronize_session=False)
+    base, remainder = divmod(total, shards)
+    db.add_all([
+        ProductStockShardModel(product_id=product_id, shard=i, stock=base + (1 if i < remainder else 0))
+        for i in range(shards)
+    ])
+    product.stock = 0
+    db.commit()
+    logger.info("Sharded stock of product ID: %s into %s shards (total %s)", product_id, shards, total)
+    return {"product_id": product_id, "shards": shards, "stock": total}
+
+def reserve_sharded_stock(db: Session, product_id: int, quantity: int, shards):
+    """Reserve stock from a sharded product.
+
+    `shards` is a (shard, stock) snapshot from get_stock_shards. Shards that
+    appear to hold enough stock are tried in random order, each with a
+    conditional UPDATE that only succeeds if the shard still has enough. If
+    no single shard can cover the quantity, all shards are locked in shard
+    order and the quantity is taken from several of them.
+    """
+    candidates = [shard for shard, stock in shards if stock >= quantity]
+    random.shuffle(candidates)
+    for shard in candidates:
+        result = db.execute(
+            update(ProductStockShardModel)
+            .where(
+                ProductStockShardModel.product_id == product_id,
+                ProductStockShardModel.shard == shard,
+                ProductStockShardModel.stock >= quantity,
+            )
+            .values(stock=ProductStockShardModel.stock - quantity)
+        )
+        if result.rowcount == 1:
+            db.commit()
+            return _reservation_result(product_id, quantity, sum(stock for _, stock in shards) - quantity)
+
+    # Fall back to taking from several shards at once
+    rows = db.query(ProductStockShardModel).filter(
+        ProductStockShardModel.product_id == product_id
+    ).order_by(ProductStockShardModel.shard).with_for_update().all()
+    available = sum(row.stock for row in rows)
+    if available < quantity:
+        db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Not enough stock available. Requested: {quantity}, Available: {available}"
+        )
+    needed = quantity
+    for row in sorted(rows, key=lambda r: r.stock, reverse=True):
+        taken = min(row.stock, needed)
+        row.stock -= taken
+        needed -= taken
+        if needed == 0:
+            break
+    db.commit()
+    return _reservation_result(product_id, quantity, available - quantity)
+
+def release_sharded_stock(db: Session, product_id: int, quantity: int, shards):
+    """Return reserved stock to one randomly chosen shard of a sharded product"""
+    shard = random.choice([shard for shard, _ in shards])
+    result = db.execute(
+        update(ProductStockShardModel)
+        .where(ProductStockShardModel.product_id == product_id, ProductStockShardModel.shard == shard)
+        .values(stock=ProductStockShardModel.stock + quantity)
+    )
+    if result.rowcount == 0:
+        # Re-sharded into fewer shards since `shards` was read; release into the new ones
+        db.rollback()
+        return release_stock(db, product_id, quantity, sharding=True)
+    db.commit()
+    return _release_result(product_id, quantity, sum(stock for _, stock in shards) + quantity)
+
+def _reservation_result(product_id: int, quantity: int, remaining: int):
+    logger.info("Reserved %s units of product ID: %s", quantity, product_id)
+    return {
+        "success": True,
+        "product_id": product_id,
+        "reserved_quantity": quantity,
+        "remaining_stock": remaining
+    }
+
+def _release_result(product_id: int, quantity: int, stock: int):
+    logger.info("Released %s units of product ID: %s", quantity, product_id)
+    return {
+        "success": True,
+        "product_id": product_id,
+        "released_quantity": quantity,
+        "stock": stock
+    }
@@ -0,0 +1,265 @@
+"""Binary RPC for internal callers, served next to the REST API.
+
+order-service reserves, releases and checks stock for every order line.
+Over REST each call is a separate HTTP request with JSON bodies and a
+query string. This interface serves the same operations over one
+persistent TCP connection per caller. Requests carry an ID, so many can be
+in flight on a connection at once and answers may come back in any order.
+
+Every frame starts with a little-endian header:
+
+    request   u32 length | u32 request id | u8 method   | payload
+    response  u32 length | u32 request id | u16 status | payload
+
+`length` counts the bytes after the length field. `status` is the HTTP
+status the REST endpoint would have answered; an error payload holds the
+detail message as UTF-8.
+
+    method        request payload              response payload
+    AUTH     (0)  service token (UTF-8)         empty
+    RESERVE  (1)  u64 product id, i32 quantity  i64 remaining stock
+    RELEASE  (2)  u64 product id, i32 quantity  i64 stock after release
+    STOCK    (3)  u64 product id                i64 stock
+    MULTI_GET(4)  u16 count, count x u64 ids    u16 found, found x product,
+                                                u16 missing, missing x u64
+
+A product is PRODUCT followed by name, description and category, each a
+u16 byte length and UTF-8 text (NULL_STRING for a missing description).
+Timestamps are microseconds since the epoch, UTC. Product IDs are stored as
+bigint, so IDs above MAX_PRODUCT_ID are answered with 400.
+
+The server is off unless RPC_PORT is set. There is no OPA check or rate
+limiting, so a connection must first prove it belongs to an internal
+service: its first frame is AUTH with SERVICE_AUTH_TOKEN (the secret the
+REST API accepts as X-Service-Token) as payload, answered with status
+200, or 401 and a closed connection. The port is also only reachable
+from order-service (kubernetes/microservices/product-service/rpc-network-policy.yaml).
+"""
+import asyncio
+import hmac
+import os
+import logging
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import routes
+from app.models import ProductModel
+
+logger = logging.getLogger(__name__)
+
+# Port of the RPC listener (0, the default, disables it); every worker binds it with SO_REUSEPORT
+RPC_PORT = int(os.getenv("RPC_PORT", "0"))
+RPC_HOST = os.getenv("RPC_HOST", "0.0.0.0")
+# Shared secret a connection must present before any other request
+SERVICE_AUTH_TOKEN = os.getenv("SERVICE_AUTH_TOKEN", "")
+# Requests handled at once per connection; further frames wait to be read
+RPC_MAX_IN_FLIGHT = int(os.getenv("RPC_MAX_IN_FLIGHT", "64"))
+# Larger frames close the connection
+RPC_MAX_FRAME_BYTES = int(os.getenv("RPC_MAX_FRAME_BYTES", str(1024 * 1024)))
+
+AUTH, RESERVE, RELEASE, STOCK, MULTI_GET = 0, 1, 2, 3, 4
+
+REQUEST_HEADER = struct.Struct("<IIB")
+RESPONSE_HEADER = struct.Struct("<IIH")
+STOCK_CHANGE = struct.Struct("<Qi")
+PRODUCT_ID = struct.Struct("<Q")
+STOCK_LEVEL = struct.Struct("<q")
+COUNT = struct.Struct("<H")
+# id, price, stock, is_active, created_at, updated_at
+PRODUCT = struct.Struct("<Qdq?qq")
+STRING_LENGTH = struct.Struct("<H")
+NULL_STRING = 0xFFFF
+# Largest products.id (a PostgreSQL bigint); larger u64 IDs would fail in the database
+MAX_PRODUCT_ID = 2 ** 63 - 1
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _micros(value: Optional[datetime]) -> int:
+    if value is None:
+        return 0
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    # Stored as naive UTC (datetime.utcnow)
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def _string(value: Optional[str]) -> bytes:
+    if value is None:
+        return STRING_LENGTH.pack(NULL_STRING)
+    data = value.encode()[:NULL_STRING - 1]
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def _check_product_ids(product_ids) -> None:
+    for product_id in product_ids:
+        if product_id > MAX_PRODUCT_ID:
+            raise HTTPException(status_code=400, detail=f"Invalid product ID {product_id}")
+
+
+def encode_product(product: ProductModel) -> bytes:
+    return b"".join((
+        PRODUCT.pack(product.id, product.price, product.stock, bool(product.is_active),
+                     _micros(product.created_at), _micros(product.updated_at)),
+        _string(product.name), _string(product.description), _string(product.category),
+    ))
+
+
+def encode_products(products: List[ProductModel], missing: List[int]) -> bytes:
+    return b"".join((
+        COUNT.pack(len(products)),
+        *(encode_product(product) for product in products),
+        COUNT.pack(len(missing)),
+        struct.pack(f"<{len(missing)}Q", *missing),
+    ))
+
+
+class RpcServer:
+    """Answers RPC frames with the same route functions the REST endpoints use.
+
+    `write_session` and `read_session` return new sessions on the primary
+    and on a read host. Handlers run in the threadpool, like sync endpoints.
+    `token` is the shared secret connections must send in their AUTH frame.
+    """
+
+    def __init__(self, write_session: Callable[[], Session], read_session: Callable[[], Session],
+                 stock_sharding: bool = False, batch_max_size: int = 100,
+                 max_in_flight: int = RPC_MAX_IN_FLIGHT, token: str = SERVICE_AUTH_TOKEN):
+        self.token = token
+        self.write_session = write_session
+        self.read_session = read_session
+        self.stock_sharding = stock_sharding
+        self.batch_max_size = batch_max_size
+        self.max_in_flight = max_in_flight
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.methods = {
+            RESERVE: self.reserve,
+            RELEASE: self.release,
+            STOCK: self.stock,
+            MULTI_GET: self.multi_get,
+        }
+
+    async def start(self, host: str = RPC_HOST, port: int = RPC_PORT) -> "RpcServer":
+        if not self.token:
+            raise RuntimeError("The RPC server needs SERVICE_AUTH_TOKEN to authenticate callers")
+        # Every gunicorn worker listens on the same port; the kernel spreads connections
+        self.server = await asyncio.start_server(self.handle_connection, host, port, reuse_port=True)
+        logger.info("RPC server listening on %s:%s", host, port)
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        limiter = asyncio.Semaphore(self.max_in_flight)
+        drain_lock = asyncio.Lock()
+        # The loop only keeps weak references to tasks
+        tasks = set()
+        authenticated = False
+        try:
+            while True:
+                length, request_id, method = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+                if length > RPC_MAX_FRAME_BYTES or length < REQUEST_HEADER.size - 4:
+                    logger.warning("Closing RPC connection after a %s byte frame", length)
+                    break
+                payload = await reader.readexactly(length - (REQUEST_HEADER.size - 4))
+                if not authenticated:
+                    authenticated = method == AUTH and hmac.compare_digest(payload, self.token.encode())
+                    body = b"" if authenticated else b"Service token required"
+                    writer.write(RESPONSE_HEADER.pack(len(body) + RESPONSE_HEADER.size - 4, request_id,
+                                                      200 if authenticated else 401) + body)
+                    await writer.drain()
+                    if not authenticated:
+                        logger.warning("Closing RPC connection from %s: no valid service token",
+                                       writer.get_extra_info("peername"))
+                        break
+                    continue
+                await limiter.acquire()
+                task = asyncio.create_task(self.respond(writer, drain_lock, limiter, request_id, method, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, drain_lock: asyncio.Lock, limiter: asyncio.Semaphore,
+                      request_id: int, method: int, payload: bytes):
+        try:
+            status, body = 200, await run_in_threadpool(self.dispatch, method, payload)
+        except HTTPException as e:
+            status, body = e.status_code, str(e.detail).encode()
+        except Exception:
+            logger.exception("RPC method %s failed", method)
+            status, body = 500, b"Internal server error"
+        finally:
+            limiter.release()
+        if writer.is_closing():
+            return
+        writer.write(RESPONSE_HEADER.pack(len(body) + RESPONSE_HEADER.size - 4, request_id, status) + body)
+        async with drain_lock:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def dispatch(self, method: int, payload: bytes) -> bytes:
+        handler = self.methods.get(method)
+        if handler is None:
+            raise HTTPException(status_code=400, detail=f"Unknown RPC method {method}")
+        try:
+            return handler(payload)
+        except struct.error:
+            raise HTTPException(status_code=400, detail="Malformed RPC payload")
+
+    def reserve(self, payload: bytes) -> bytes:
+        product_id, quantity = STOCK_CHANGE.unpack(payload)
+        _check_product_ids([product_id])
+        if quantity < 1:
+            raise HTTPException(status_code=400, detail="quantity must be at least 1")
+        with self.write_session() as db:
+            result = routes.reserve_stock(db, product_id, quantity, self.stock_sharding)
+        return STOCK_LEVEL.pack(result["remaining_stock"])
+
+    def release(self, payload: bytes) -> bytes:
+        product_id, quantity = STOCK_CHANGE.unpack(payload)
+        _check_product_ids([product_id])
+        if quantity < 1:
+            raise HTTPException(status_code=400, detail="quantity must be at least 1")
+        with self.write_session() as db:
+            result = routes.release_stock(db, product_id, quantity, self.stock_sharding)
+        return STOCK_LEVEL.pack(result["stock"])
+
+    def stock(self, payload: bytes) -> bytes:
+        product_id, = PRODUCT_ID.unpack(payload)
+        _check_product_ids([product_id])
+        with self.read_session() as db:
+            return STOCK_LEVEL.pack(routes.get_stock_level(db, product_id, self.stock_sharding))
+
+    def multi_get(self, payload: bytes) -> bytes:
+        count, = COUNT.unpack_from(payload)
+        if count > self.batch_max_size:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many product IDs requested. Requested: {count}, Maximum: {self.batch_max_size}"
+            )
+        product_ids = struct.unpack_from(f"<{count}Q", payload, COUNT.size)
+        _check_product_ids(product_ids)
+        with self.read_session() as db:
+            products, missing = routes.get_products_by_ids(db, list(product_ids))
+            if self.stock_sharding:
+                routes.apply_sharded_stock(db, products)
+            return encode_products(products, missing)
@@ -0,0 +1,221 @@
+"""Catalog snapshots: a read-only copy of the product catalog in one file.
+
+A snapshot holds every product already serialized as JSON, so it can be
+served straight from a memory-mapped file with no database and no
+per-request serialization (see app/snapshot_main.py).
+
+File layout (little-endian, sections 8-byte aligned):
+
+    header   magic "PRODSNAP", format version, product count, snapshot
+             version, creation time, offsets of the sections below
+    data     b"[" p1 b"," p2 b"," ... pn b"]", each p the product's JSON
+    ids      count x u64, product IDs in ascending order
+    offsets  (count + 1) x u64, offsets[i] is where p(i+1) starts in data
+
+Because the products are stored as one JSON array, a page of consecutive
+products is a single slice of the data section between "[" and "]".
+
+Export with
+
+    python -m app.snapshot export --output /data/catalog.snap
+
+which reads the database configured by DB_* and publishes atomically: the
+file is written next to the target and renamed over it, so readers see
+either the old snapshot or the new one, never a partial file.
+"""
+import argparse
+import bisect
+import mmap
+import os
+import logging
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from typing import List, Optional, Union
+
+from sqlalchemy.orm import Session
+
+from app.models import Product, ProductModel
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PRODSNAP"
+FORMAT_VERSION = 1
+# magic, format version, flags, count, snapshot version, created_at, data/ids/offsets offsets
+HEADER = struct.Struct("<8sHHIQdQQQ")
+EXPORT_BATCH_SIZE = 1000
+
+Buffer = Union[bytes, memoryview]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _pad(f) -> int:
+    """Pad the file to the next 8-byte boundary and return the position."""
+    position = f.tell()
+    padding = -position % 8
+    f.write(b"\0" * padding)
+    return position + padding
+
+
+def export_snapshot(db: Session, path: str, version: Optional[int] = None) -> dict:
+    """Write every product to a new snapshot at `path`, replacing any previous one atomically."""
+    from app.routes import apply_sharded_stock
+
+    version = int(time.time() * 1000) if version is None else version
+    ids, offsets = array("Q"), array("Q")
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+            data_offset = f.tell()
+            f.write(b"[")
+            last_id = 0
+            while True:
+                # Keyset pagination keeps memory flat for large catalogs
+                batch = db.query(ProductModel).filter(ProductModel.id > last_id).order_by(
+                    ProductModel.id
+                ).limit(EXPORT_BATCH_SIZE).all()
+                if not batch:
+                    break
+                apply_sharded_stock(db, batch)
+                for product in batch:
+                    if ids:
+                        f.write(b",")
+                    ids.append(product.id)
+                    offsets.append(f.tell() - data_offset)
+                    f.write(Product.from_orm(product).json(separators=(",", ":")).encode())
+                last_id = batch[-1].id
+                db.expunge_all()
+            offsets.append(f.tell() - data_offset + 1)
+            f.write(b"]")
+
+            ids_offset = _pad(f)
+            f.write(ids.tobytes() if sys.byteorder == "little" else _swapped(ids))
+            offsets_offset = _pad(f)
+            f.write(offsets.tobytes() if sys.byteorder == "little" else _swapped(offsets))
+
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ids), version, time.time(),
+                                data_offset, ids_offset, offsets_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    logger.info("Exported snapshot version %s with %s products to %s", version, len(ids), path)
+    return {"path": path, "version": version, "products": len(ids)}
+
+
+def _swapped(values: array) -> bytes:
+    values = array(values.typecode, values)
+    values.byteswap()
+    return values.tobytes()
+
+
+class Snapshot:
+    """A snapshot file mapped read-only; lookups return slices of the mapping."""
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise SnapshotError("Snapshots can only be served on little-endian hosts")
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER.size:
+                raise SnapshotError(f"{path} is too small to be a snapshot")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.file_id = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        (magic, format_version, _, self.count, self.version, self.created_at,
+         data_offset, ids_offset, offsets_offset) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not a product snapshot")
+        if format_version != FORMAT_VERSION:
+            raise SnapshotError(f"{path} has format version {format_version}, expected {FORMAT_VERSION}")
+
+        # A truncated or corrupt file must fail here, not on a later lookup
+        size = stat.st_size
+        if not (HEADER.size <= data_offset <= ids_offset and ids_offset + 8 * self.count <= offsets_offset
+                and offsets_offset + 8 * (self.count + 1) <= size and ids_offset % 8 == offsets_offset % 8 == 0):
+            raise SnapshotError(f"{path} is truncated or corrupt: sections do not fit its {size} bytes")
+
+        view = memoryview(self._mmap)
+        self.ids = view[ids_offset:ids_offset + 8 * self.count].cast("Q")
+        self.offsets = view[offsets_offset:offsets_offset + 8 * (self.count + 1)].cast("Q")
+        self.data = view[data_offset:ids_offset]
+
+    def get(self, product_id: int) -> Optional[memoryview]:
+        """JSON of one product, or None if it is not in the snapshot."""
+        i = bisect.bisect_left(self.ids, product_id)
+        if i == self.count or self.ids[i] != product_id:
+            return None
+        # offsets[i + 1] - 1 drops the "," (or "]") after the product
+        return self.data[self.offsets[i]:self.offsets[i + 1] - 1]
+
+    def page(self, skip: int = 0, limit: int = 100) -> List[Buffer]:
+        """JSON array of products skip..skip+limit in id order, as buffers to send in sequence."""
+        start, end = min(max(skip, 0), self.count), min(max(skip, 0) + max(limit, 0), self.count)
+        if start == end:
+            return [b"[]"]
+        return [b"[", self.data[self.offsets[start]:self.offsets[end] - 1], b"]"]
+
+
+class SnapshotStore:
+    """Holds the current snapshot of a path and swaps in a new one when the file is replaced.
+
+    A replaced snapshot is not closed explicitly: responses may still be
+    sending slices of it, and the mapping is released once they are done.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.current: Optional[Snapshot] = None
+
+    def reload_if_changed(self) -> bool:
+        """Load the file at `path` if it differs from the current snapshot; True if swapped."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        file_id = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self.current is not None and self.current.file_id == file_id:
+            return False
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError, struct.error, SnapshotError) as e:
+            logger.error("Could not load snapshot %s, keeping the current one: %s", self.path, e)
+            return False
+        previous, self.current = self.current, snapshot
+        logger.info(
+            "Serving snapshot version %s (%s products)%s", snapshot.version, snapshot.count,
+            f", replacing version {previous.version}" if previous else "",
+        )
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Product catalog snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export the catalog from the database")
+    export.add_argument("--output", required=True)
+    export.add_argument("--version", type=int, help="Snapshot version (default: current time in ms)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        print(export_snapshot(db, args.output, args.version))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Read-only catalog served from a snapshot file (see app/snapshot.py).
+
+Serves GET /products and GET /products/{id} with the same JSON as the main
+API, but straight from a memory-mapped snapshot: no database and no
+serialization per request. Responses are sent as slices of the mapping,
+so the product bytes are never copied into Python objects. Requests go
+through the same rate limiter and OPA check as the main API, so an edge
+replica does not bypass authorization or throttling.
+
+    SNAPSHOT_PATH=/data/catalog.snap APP_MODULE=app.snapshot_main:app python -m app.server
+
+The file is checked every SNAPSHOT_POLL_SECONDS and swapped in when a new
+snapshot has been published to SNAPSHOT_PATH. /ready answers 503 until a
+snapshot has been loaded.
+"""
+import asyncio
+import os
+import logging
+import time
+from typing import List
+
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+
+from app import clients, conditional
+from app.logging_config import configure_logging
+from app.policy import check_policy
+from app.ratelimit import rate_limit
+from app.snapshot import Buffer, SnapshotStore
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Snapshot file written by `python -m app.snapshot export`
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "/data/catalog.snap")
+# How often to check SNAPSHOT_PATH for a newly published snapshot
+SNAPSHOT_POLL_SECONDS = float(os.getenv("SNAPSHOT_POLL_SECONDS", "5"))
+
+store = SnapshotStore(SNAPSHOT_PATH)
+
+# Rate limiting runs before any route dependency, as in the main app
+app = FastAPI(title="Product Service API (snapshot)", version="0.1.0", dependencies=[Depends(rate_limit)])
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+class ProcessTimeMiddleware:
+    """Sets X-Process-Time like the main app.
+
+    Plain ASGI because @app.middleware("http") re-streams the body and only
+    accepts bytes, not the memoryview slices sent here.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start_time = time.time()
+
+        async def send_with_time(message):
+            if message["type"] == "http.response.start":
+                process_time = str(time.time() - start_time).encode()
+                message["headers"] = [*message.get("headers", []), (b"x-process-time", process_time)]
+            await send(message)
+
+        await self.app(scope, receive, send_with_time)
+
+
+app.add_middleware(ProcessTimeMiddleware)
+
+
+class SliceResponse(Response):
+    """JSON response whose body is sent as a sequence of buffers without joining them."""
+    media_type = "application/json"
+
+    def __init__(self, parts: List[Buffer], status_code: int = 200, headers: dict = None):
+        self.parts = parts
+        super().__init__(status_code=status_code, headers=headers)
+        self.headers["content-length"] = str(sum(len(part) for part in parts))
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        for i, part in enumerate(self.parts):
+            await send({"type": "http.response.body", "body": part, "more_body": i < len(self.parts) - 1})
+
+
+async def poll_snapshot():
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        try:
+            store.reload_if_changed()
+        except Exception:
+            logger.exception("Snapshot reload failed")
+
+
+@app.on_event("startup")
+async def startup_event():
+    store.reload_if_changed()
+    app.state.poll = asyncio.create_task(poll_snapshot())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.poll.cancel()
+    await clients.close_client()
+
+
+def current_snapshot():
+    snapshot = store.current
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="No catalog snapshot loaded")
+    return snapshot
+
+def slice_response(request: Request, parts: List[Buffer], version: int, *salt) -> Response:
+    # A snapshot never changes once published, so its version identifies the content
+    etag = conditional.make_etag("snapshot", version, *salt)
+    headers = {"X-Snapshot-Version": str(version)}
+    if conditional.is_not_modified(request, etag, None):
+        response = conditional.not_modified_response(etag, None)
+        response.headers.update(headers)
+        return response
+    response = SliceResponse(parts, headers=headers)
+    conditional.set_validators(response, etag, None)
+    return response
+
+
+@app.get("/health")
+def health_check():
+    return {"status": "healthy", "service": "product-service"}
+
+@app.get("/ready")
+def readiness_check():
+    snapshot = store.current
+    if snapshot is None:
+        return JSONResponse(status_code=503, content={"status": "no snapshot", "service": "product-service"})
+    return {
+        "status": "ready",
+        "service": "product-service",
+        "snapshot_version": snapshot.version,
+        "snapshot_products": snapshot.count,
+    }
+
+@app.get("/products")
+async def get_products(request: Request, skip: int = 0, limit: int = 100, _: bool = Depends(check_policy)):
+    """Get all products with pagination, in id order"""
+    snapshot = current_snapshot()
+    return slice_response(request, snapshot.page(skip, limit), snapshot.version, "page", skip, limit)
+
+@app.get("/products/{product_id}")
+async def get_product(product_id: int, request: Request, _: bool = Depends(check_policy)):
+    """Get a specific product by ID"""
+    snapshot = current_snapshot()
+    product = snapshot.get(product_id)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return slice_response(request, [product], snapshot.version, product_id)
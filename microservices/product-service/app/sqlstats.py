@@ -0,0 +1,192 @@
+"""Per-statement SQL timing, aggregated by query fingerprint.
+
+Every statement run through an instrumented engine is timed and folded
+into a fingerprint: literals and bind placeholders become "?", and IN
+lists of any length collapse to "(?+)", so one query shape is one entry
+whatever its parameters. Each fingerprint keeps its count, total and max
+time, rows and errors, plus recent durations for a p95.
+
+Statements slower than SQL_SLOW_QUERY_MS are logged with the shape of
+their bind parameters (types and lengths, never values).
+
+The aggregates are per worker process. They are served as JSON at
+/debug/sql and in Prometheus text format at /metrics, where every series
+carries a `worker` label (the process ID): a scrape reaches whichever
+worker accepts it, and without the label the counters of different
+workers would look like one counter that keeps resetting. Sum over
+`worker` for pod totals.
+"""
+import os
+import logging
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+SQL_STATS_ENABLED = os.getenv("SQL_STATS_ENABLED", "true").lower() == "true"
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "200"))
+# Distinct fingerprints kept; the one with the least total time is dropped first
+SQL_STATS_MAX_FINGERPRINTS = int(os.getenv("SQL_STATS_MAX_FINGERPRINTS", "500"))
+# Recent durations kept per fingerprint for the p95
+SQL_STATS_SAMPLES = int(os.getenv("SQL_STATS_SAMPLES", "256"))
+# Fingerprints exported to Prometheus, by total time (bounds label cardinality)
+SQL_METRICS_TOP = int(os.getenv("SQL_METRICS_TOP", "50"))
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\$\d+|\?")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(statement: str) -> str:
+    """Normalize a statement so executions that differ only in values share a key."""
+    normalized = _STRING.sub("?", statement)
+    normalized = _PLACEHOLDER.sub("?", normalized)
+    normalized = _NUMBER.sub("?", normalized)
+    normalized = _WHITESPACE.sub(" ", normalized).strip()
+    return _LIST.sub("(?+)", normalized)
+
+
+def _value_shape(value) -> str:
+    if isinstance(value, (str, bytes, list, tuple)):
+        return f"{type(value).__name__}({len(value)})"
+    return type(value).__name__
+
+
+def parameter_shape(parameters, executemany: bool = False):
+    """Describe bind parameters by type and size without exposing values."""
+    if executemany:
+        rows = list(parameters)
+        return {"rows": len(rows), "each": parameter_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: _value_shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_value_shape(value) for value in parameters]
+    return _value_shape(parameters)
+
+
+class StatementStats:
+    __slots__ = ("count", "total", "max", "rows", "errors", "recent")
+
+    def __init__(self, samples: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.errors = 0
+        self.recent = deque(maxlen=samples)
+
+    def p95(self) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class SqlStats:
+    def __init__(self, max_fingerprints: int = SQL_STATS_MAX_FINGERPRINTS, samples: int = SQL_STATS_SAMPLES):
+        self.max_fingerprints = max_fingerprints
+        self.samples = samples
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, duration: float, rows: int = -1, error: bool = False):
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    del self._stats[min(self._stats, key=lambda k: self._stats[k].total)]
+                entry = self._stats[key] = StatementStats(self.samples)
+            entry.count += 1
+            entry.total += duration
+            if duration > entry.max:
+                entry.max = duration
+            if rows > 0:
+                entry.rows += rows
+            if error:
+                entry.errors += 1
+            entry.recent.append(duration)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def top(self, limit: int = 20, order_by: str = "total") -> list:
+        """The `limit` heaviest fingerprints by total, count, mean, p95 or max time."""
+        with self._lock:
+            rows = [{
+                "fingerprint": key,
+                "count": s.count,
+                "total_ms": s.total * 1000,
+                "mean_ms": s.total / s.count * 1000,
+                "p95_ms": s.p95() * 1000,
+                "max_ms": s.max * 1000,
+                "rows": s.rows,
+                "errors": s.errors,
+            } for key, s in self._stats.items()]
+        sort_key = "count" if order_by == "count" else f"{order_by}_ms"
+        rows.sort(key=lambda r: r[sort_key], reverse=True)
+        return rows[:limit]
+
+    def prometheus(self, limit: int = SQL_METRICS_TOP) -> str:
+        """Aggregates of the top fingerprints in Prometheus text exposition format."""
+        metrics = [
+            ("sql_statements_total", "counter", "Statements executed", lambda r: r["count"]),
+            ("sql_statement_seconds_total", "counter", "Time spent executing statements",
+             lambda r: r["total_ms"] / 1000),
+            ("sql_statement_p95_seconds", "gauge", "p95 of recent executions", lambda r: r["p95_ms"] / 1000),
+            ("sql_statement_rows_total", "counter", "Rows returned or affected", lambda r: r["rows"]),
+            ("sql_statement_errors_total", "counter", "Statements that raised", lambda r: r["errors"]),
+        ]
+        top = self.top(limit)
+        worker = os.getpid()
+        lines = []
+        for name, kind, help_text, value in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for row in top:
+                query = row["fingerprint"][:200].replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'{name}{{worker="{worker}",query="{query}"}} {value(row)}')
+        return "\n".join(lines) + "\n"
+
+
+stats = SqlStats()
+
+
+def record_statements(engine, slow_query_ms: float = SQL_SLOW_QUERY_MS):
+    """Time every statement executed through the engine into `stats`."""
+    if not SQL_STATS_ENABLED:
+        return
+    from sqlalchemy import event
+
+    slow_seconds = slow_query_ms / 1000
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sqlstats_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("sqlstats_started")
+        if not started:
+            return
+        duration = time.perf_counter() - started.pop()
+        key = fingerprint(statement)
+        stats.record(key, duration, cursor.rowcount)
+        if duration >= slow_seconds:
+            logger.warning(
+                "Slow query %.1fms: %s params=%s",
+                duration * 1000, key, parameter_shape(parameters, executemany),
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        started = conn.info.get("sqlstats_started") if conn is not None else None
+        if started and exception_context.statement is not None:
+            stats.record(fingerprint(exception_context.statement), time.perf_counter() - started.pop(), error=True)
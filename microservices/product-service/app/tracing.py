@@ -0,0 +1,309 @@
+"""Lightweight request tracing with W3C `traceparent` propagation.
+
+A trace is started for every HTTP request by TracingMiddleware. Whether it
+is recorded is decided up front (head-based sampling): an incoming
+`traceparent` keeps the caller's decision, otherwise TRACE_SAMPLE_RATE
+applies. Unsampled requests only time the root span, and child spans are
+a shared no-op object; if such a request still exceeds
+TRACE_SLOW_THRESHOLD_MS its root span is exported anyway so slow requests
+are never invisible.
+
+Spans are handed to a pluggable exporter when the root span ends.
+"""
+import contextvars
+import importlib
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_THRESHOLD_MS = float(os.getenv("TRACE_SLOW_THRESHOLD_MS", "500"))
+# "log", "none" or "package.module:ExporterClass"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "log")
+# Longest SQL statement text recorded on a db span
+MAX_STATEMENT_LENGTH = 500
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start", "end", "error", "_token")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Optional[dict] = None):
+        self.trace = trace
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self._token = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = repr(error)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+        _current_span.reset(self._token)
+        self.trace.spans.append(self)
+        return False
+
+
+class _NoopSpan:
+    """Returned instead of a Span when the current request is not sampled."""
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+
+
+class SpanExporter:
+    """Receives the finished spans of a trace once its root span ends."""
+
+    def export(self, spans: List[Span]):
+        raise NotImplementedError
+
+
+class LoggingExporter(SpanExporter):
+    """Writes one JSON log line per span.
+
+    The span goes in the record's `span` field, serialized by the log
+    listener thread (app/logging_config.py), and is never sampled out, so
+    a sampled trace keeps all of its spans.
+    """
+
+    def export(self, spans: List[Span]):
+        for finished in spans:
+            logger.info("span", extra={"span": finished.to_dict()})
+
+
+class NoopExporter(SpanExporter):
+    def export(self, spans: List[Span]):
+        pass
+
+
+class InMemoryExporter(SpanExporter):
+    """Keeps exported spans in a list; intended for tests."""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+    def find(self, name: str) -> List[Span]:
+        return [s for s in self.spans if s.name == name]
+
+    def clear(self):
+        self.spans.clear()
+
+
+_exporter = None
+
+
+def get_exporter() -> SpanExporter:
+    global _exporter
+    if _exporter is None:
+        if TRACE_EXPORTER == "log":
+            _exporter = LoggingExporter()
+        elif TRACE_EXPORTER == "none":
+            _exporter = NoopExporter()
+        else:
+            module_name, _, attr = TRACE_EXPORTER.partition(":")
+            _exporter = getattr(importlib.import_module(module_name), attr)()
+    return _exporter
+
+
+def set_exporter(exporter: SpanExporter):
+    global _exporter
+    _exporter = exporter
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def span(name: str, **attributes):
+    """Start a child span of the current span, for use as a context manager.
+
+    Returns a shared no-op object when there is no sampled trace in progress.
+    """
+    parent = _current_span.get()
+    if parent is None or not parent.trace.sampled:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def parse_traceparent(value: Optional[str]):
+    """Return (trace_id, parent_span_id, sampled) from a traceparent header, or None."""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def inject_headers(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Add a traceparent header for the current span to outbound request headers."""
+    headers = dict(headers or {})
+    current = _current_span.get()
+    if current is not None:
+        flags = "01" if current.trace.sampled else "00"
+        headers["traceparent"] = f"00-{current.trace_id}-{current.span_id}-{flags}"
+    return headers
+
+
+class TracingMiddleware:
+    """ASGI middleware that opens the root span of every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = parse_traceparent(_header(scope, b"traceparent"))
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+            sampled = random.random() < TRACE_SAMPLE_RATE
+
+        trace = Trace(trace_id, sampled)
+        root = Span(trace, f"{scope['method']} {scope['path']}", parent_id)
+        status = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        error = None
+        with root:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except Exception as exc:
+                error = exc
+                raise
+            finally:
+                route = scope.get("route")
+                if route is not None and hasattr(route, "path"):
+                    root.name = f"{scope['method']} {route.path}"
+                root.set_attribute("http.status_code", status.get("code", 500 if error else None))
+                root.set_attribute("http.target", scope["path"])
+
+        if sampled:
+            get_exporter().export(trace.spans)
+        elif root.duration_ms >= TRACE_SLOW_THRESHOLD_MS:
+            root.set_attribute("sampled_by", "latency")
+            get_exporter().export([root])
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def instrument_engine(engine):
+    """Record a span for every SQL statement executed through the engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_span = span("db.query", statement=statement[:MAX_STATEMENT_LENGTH])
+        if db_span is not NOOP_SPAN:
+            db_span.__enter__()
+            conn.info.setdefault("trace_spans", []).append(db_span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            db_span = spans.pop()
+            db_span.set_attribute("rows", cursor.rowcount)
+            db_span.__exit__(None, None, None)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        spans = conn.info.get("trace_spans") if conn is not None else None
+        if spans:
+            error = exception_context.original_exception
+            spans.pop().__exit__(type(error), error, None)
+
+
+def instrument_serialization():
+    """Record a span around FastAPI's response_model validation and encoding."""
+    import fastapi.routing
+
+    original = fastapi.routing.serialize_response
+    if getattr(original, "_traced", False):
+        return
+
+    async def serialize_response(*args, **kwargs):
+        with span("serialize_response"):
+            return await original(*args, **kwargs)
+
+    serialize_response._traced = True
+    fastapi.routing.serialize_response = serialize_response
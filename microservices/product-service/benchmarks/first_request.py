@@ -0,0 +1,79 @@
+"""First-request latency of a fresh worker, with and without warm-up.
+
+Starts the service in a new process, waits until it would receive
+traffic (/health for a cold start, /ready with warm-up), then times the
+first few requests to a hot endpoint. Each mode is repeated on a new
+process and the median of every request position is printed.
+
+    DB_HOST=localhost python -m benchmarks.first_request --runs 5
+
+The service reads its usual environment (DB_*, OPA_URL, ...), so point it
+at a database first; an unreachable OPA only adds its connect timeout.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(url: str, status: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url).status_code == status:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{url} did not return {status} within {timeout}s")
+
+
+def first_requests(warm: bool, path: str, requests: int, timeout: float):
+    port = free_port()
+    env = dict(os.environ, WARMUP_ENABLED="true" if warm else "false")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_until(base + ("/ready" if warm else "/health"), 200, timeout)
+        timings = []
+        with httpx.Client(base_url=base) as client:
+            for _ in range(requests):
+                start = time.perf_counter()
+                client.get(path).raise_for_status()
+                timings.append(time.perf_counter() - start)
+        return timings
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First-request latency with and without warm-up")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--path", default="/products?limit=20")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    for warm in (False, True):
+        runs = [first_requests(warm, args.path, args.requests, args.timeout) for _ in range(args.runs)]
+        medians = [statistics.median(run[i] for run in runs) * 1000 for i in range(args.requests)]
+        print(f"{'warm' if warm else 'cold'}: " + "  ".join(f"#{i + 1} {ms:7.1f}ms" for i, ms in enumerate(medians)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,717 @@
+import asyncio
+import json
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import List
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.main import app, check_policy
+from app import clients, database, debug, pool, profiling, ratelimit, routes, rpc, server, sqlstats, warmup
+from app.database import get_db, get_read_db, ReadWriteRouter
+from app.models import Base, Product, ProductModel
+
+engine = create_engine(
+    "sqlite://",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+sqlstats.record_statements(engine)
+
+# Scratch PostgreSQL or YugabyteDB database for tests that need real row locks; its tables are dropped
+POSTGRES_TEST_URL = os.getenv("POSTGRES_TEST_URL", "")
+
+
+def override_get_db():
+    db = TestingSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Fresh buckets per test so request counts do not carry over
+    monkeypatch.setattr(ratelimit, "limiter", ratelimit.RateLimiter(ratelimit.InProcessBackend()))
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add_all([
+        ProductModel(name=f"Product {i}", description="Test product", price=10.0 * i, stock=10, category="Test")
+        for i in range(1, 6)
+    ])
+    db.commit()
+    db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[check_policy] = lambda: True
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    Base.metadata.drop_all(bind=engine)
+
+
+def test_get_products_by_ids_preserves_order(client):
+    response = client.get("/products", params={"ids": "3,1,99,3"})
+    assert response.status_code == 200
+    assert [p["id"] for p in response.json()] == [3, 1]
+    assert response.headers["X-Missing-Ids"] == "99"
+
+
+def test_batch_reports_missing_ids(client):
+    response = client.post("/products/batch", json={"ids": [5, 42, 2]})
+    assert response.status_code == 200
+    body = response.json()
+    assert [p["id"] for p in body["products"]] == [5, 2]
+    assert body["missing"] == [42]
+
+
+def test_batch_size_is_capped(client, monkeypatch):
+    monkeypatch.setattr("app.main.PRODUCT_BATCH_MAX_SIZE", 2)
+    assert client.post("/products/batch", json={"ids": [1, 2, 3]}).status_code == 400
+    assert client.get("/products", params={"ids": "1,2,3"}).status_code == 400
+
+
+def test_get_product_sets_validators_and_honors_if_none_match(client):
+    response = client.get("/products/1")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+
+    response = client.get("/products/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+
+def test_get_product_honors_if_modified_since(client):
+    last_modified = client.get("/products/2").headers["Last-Modified"]
+    response = client.get("/products/2", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = client.get("/products/2", headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+    assert response.status_code == 200
+
+
+def test_product_page_etag_changes_with_page(client):
+    first = client.get("/products", params={"limit": 2})
+    etag = first.headers["ETag"]
+    assert client.get("/products", params={"limit": 2}, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/products", params={"limit": 3}, headers={"If-None-Match": etag}).status_code == 200
+    assert client.get("/products/404", headers={"If-None-Match": etag}).status_code == 404
+
+
+def _stand_in(path, name):
+    """A file-backed SQLite database standing in for one YugabyteDB host."""
+    stand_in = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=stand_in)
+    if name is not None:
+        db = sessionmaker(bind=stand_in)()
+        db.add(ProductModel(name=name, price=5.0, stock=10, category="Test"))
+        db.commit()
+        db.close()
+    return stand_in
+
+
+@pytest.fixture
+def routed_client(monkeypatch):
+    """Build a client whose sessions come from the given router instead of overrides."""
+    def install(router):
+        monkeypatch.setattr(database, "router", router)
+        return TestClient(app, raise_server_exceptions=False)
+
+    app.dependency_overrides[check_policy] = lambda: True
+    yield install
+    app.dependency_overrides.clear()
+
+
+def test_reads_go_to_read_engine_and_writes_to_primary(tmp_path, routed_client):
+    primary = _stand_in(tmp_path / "primary.db", "primary copy")
+    replica = _stand_in(tmp_path / "replica.db", "replica copy")
+    client = routed_client(ReadWriteRouter(primary, [replica]))
+
+    assert client.get("/products/1").json()["name"] == "replica copy"
+    assert client.get("/products", params={"ids": "1"}).json()[0]["name"] == "replica copy"
+
+    response = client.post("/products/1/reserve", params={"quantity": 4})
+    assert response.status_code == 200
+    assert response.json()["remaining_stock"] == 6
+    with primary.connect() as conn:
+        assert conn.exec_driver_sql("SELECT stock FROM products WHERE id = 1").scalar() == 6
+    with replica.connect() as conn:
+        assert conn.exec_driver_sql("SELECT stock FROM products WHERE id = 1").scalar() == 10
+
+
+def test_failed_read_host_is_skipped(tmp_path, routed_client):
+    primary = _stand_in(tmp_path / "primary.db", "primary copy")
+    healthy = _stand_in(tmp_path / "healthy.db", "healthy replica")
+    unreachable = create_engine(f"sqlite:///{tmp_path / 'missing' / 'down.db'}")
+    router = ReadWriteRouter(primary, [unreachable, healthy], retry_after=60)
+    client = routed_client(router)
+
+    # The request that finds the host down is retried on the next one
+    assert client.get("/products/1").json()["name"] == "healthy replica"
+    names = {client.get("/products/1").json()["name"] for _ in range(4)}
+    assert names == {"healthy replica"}
+
+    router.mark_failed(healthy)
+    assert client.get("/products/1").json()["name"] == "primary copy"
+
+
+def test_read_falls_back_to_primary_when_every_read_host_is_down(tmp_path, routed_client):
+    primary = _stand_in(tmp_path / "primary.db", "primary copy")
+    down = [create_engine(f"sqlite:///{tmp_path / 'missing' / f'down{i}.db'}") for i in range(2)]
+    router = ReadWriteRouter(primary, down, retry_after=60)
+    client = routed_client(router)
+
+    assert client.get("/products/1").json()["name"] == "primary copy"
+    assert router.reader() is primary
+
+
+def test_rate_limit_returns_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "limiter", ratelimit.RateLimiter(ratelimit.InProcessBackend(), rate=0.5, burst=2))
+    assert client.get("/products/1").status_code == 200
+    assert client.get("/products/1").status_code == 200
+    response = client.get("/products/1")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+    # Buckets are per caller and per route template; an unverified service ID does not change the caller
+    assert client.get("/products/1", headers={"X-Service-Id": "order-service"}).status_code == 429
+    assert client.get("/products/1", headers={"X-Real-IP": "10.0.0.9"}).status_code == 429
+    assert client.get("/products/2/stock").status_code == 200
+    assert client.get("/products/2").status_code == 429
+    assert client.get("/health").status_code == 200
+
+
+def test_rate_limit_exempts_authenticated_services(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "limiter", ratelimit.RateLimiter(ratelimit.InProcessBackend(), rate=0.5, burst=1))
+    monkeypatch.setattr(ratelimit, "SERVICE_AUTH_TOKEN", "s3cret")
+    assert client.get("/products/1").status_code == 200
+    assert client.get("/products/1", headers={"X-Service-Id": "order-service", "X-Service-Token": "wrong"}).status_code == 429
+    for _ in range(3):
+        response = client.get("/products/1", headers={"X-Service-Id": "order-service", "X-Service-Token": "s3cret"})
+        assert response.status_code == 200
+
+    # Behind the Nginx sidecar each client gets its own bucket
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", {"testclient"})
+    assert client.get("/products/1", headers={"X-Real-IP": "10.0.0.9"}).status_code == 200
+    assert client.get("/products/1", headers={"X-Real-IP": "10.0.0.9"}).status_code == 429
+
+
+def test_in_process_backend_evicts_least_recently_used():
+    import asyncio
+    backend = ratelimit.InProcessBackend(max_keys=2)
+    for key in ("a", "b", "c"):
+        asyncio.run(backend.acquire(key, rate=1, burst=1))
+    assert list(backend._buckets) == ["b", "c"]
+
+
+def test_sharded_stock_reserve_and_check(client, monkeypatch):
+    monkeypatch.setattr("app.main.STOCK_SHARDING", True)
+    response = client.post("/products/1/stock/shards", params={"shards": 4})
+    assert response.json() == {"product_id": 1, "shards": 4, "stock": 10}
+
+    # Single-shard reservations, then one that needs stock from several shards
+    assert client.post("/products/1/reserve", params={"quantity": 2}).status_code == 200
+    assert client.post("/products/1/reserve", params={"quantity": 1}).status_code == 200
+    response = client.post("/products/1/reserve", params={"quantity": 6})
+    assert response.status_code == 200
+    assert response.json()["remaining_stock"] == 1
+
+    assert client.get("/products/1/stock").json() == {"product_id": 1, "in_stock": True, "stock": 1}
+    assert client.get("/products/1").json()["stock"] == 1
+    assert client.post("/products/1/reserve", params={"quantity": 2}).status_code == 400
+
+
+def test_sharded_stock_changes_revalidate_product_reads(client, monkeypatch):
+    monkeypatch.setattr("app.main.STOCK_SHARDING", True)
+    client.post("/products/1/stock/shards", params={"shards": 2})
+    response = client.get("/products/1")
+    etag = response.headers["ETag"]
+    page_etag = client.get("/products", params={"limit": 2}).headers["ETag"]
+    # updated_at does not move on sharded reservations, so it cannot validate
+    assert "Last-Modified" not in response.headers
+    assert client.get("/products/1", headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.post("/products/1/reserve", params={"quantity": 3}).status_code == 200
+    response = client.get("/products/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()["stock"] == 7
+    assert client.get("/products", params={"limit": 2}, headers={"If-None-Match": page_etag}).status_code == 200
+
+
+def test_update_rejects_stock_of_sharded_product(client, monkeypatch):
+    monkeypatch.setattr("app.main.STOCK_SHARDING", True)
+    client.post("/products/1/stock/shards", params={"shards": 2})
+    response = client.put("/products/1", json={"stock": 50})
+    assert response.status_code == 409
+    response = client.put("/products/1", json={"price": 12.5})
+    assert response.status_code == 200 and response.json()["price"] == 12.5 and response.json()["stock"] == 10
+    assert client.put("/products/2", json={"stock": 50}).json()["stock"] == 50
+
+
+def test_release_returns_reserved_stock(client, monkeypatch):
+    assert client.post("/products/2/reserve", params={"quantity": 4}).json()["remaining_stock"] == 6
+    response = client.post("/products/2/release", params={"quantity": 4})
+    assert response.json() == {"success": True, "product_id": 2, "released_quantity": 4, "stock": 10}
+    assert client.post("/products/99/release", params={"quantity": 1}).status_code == 404
+    assert client.post("/products/2/release", params={"quantity": 0}).status_code == 400
+
+    monkeypatch.setattr("app.main.STOCK_SHARDING", True)
+    client.post("/products/2/stock/shards", params={"shards": 3})
+    assert client.post("/products/2/release", params={"quantity": 5}).json()["stock"] == 15
+    assert client.get("/products/2/stock").json()["stock"] == 15
+
+
+def test_release_after_resharding_into_fewer_shards(client):
+    db = TestingSessionLocal()
+    routes.shard_product_stock(db, 3, 4)
+    stale = routes.get_stock_shards(db, 3)
+    routes.shard_product_stock(db, 3, 1)
+    # Shards 1-3 no longer exist; the release must not vanish with them
+    for _ in range(8):
+        routes.release_sharded_stock(db, 3, 1, stale)
+    assert routes.get_stock_level(db, 3, sharding=True) == 18
+    db.close()
+
+
+@pytest.mark.skipif(not POSTGRES_TEST_URL, reason="SQLite has no row locks; set POSTGRES_TEST_URL to run")
+def test_reservation_during_resharding_keeps_the_total():
+    pg = create_engine(POSTGRES_TEST_URL)
+    Base.metadata.drop_all(bind=pg)
+    Base.metadata.create_all(bind=pg)
+    Session = sessionmaker(bind=pg)
+    with Session() as db:
+        db.add(ProductModel(id=1, name="Contended", price=1.0, stock=100, category="Test"))
+        db.commit()
+
+    def reserve():
+        with Session() as db:
+            routes.reserve_stock(db, 1, 10, sharding=True)
+
+    resharding = threading.get_ident()
+    reserver = threading.Thread(target=reserve)
+
+    def reserve_while_locked(conn, cursor, statement, parameters, context, executemany):
+        # Once the reshard holds its locks, a reservation starts and has to wait for it
+        if threading.get_ident() == resharding and "product_stock_shards" in statement and "FOR UPDATE" in statement:
+            reserver.start()
+            time.sleep(0.5)
+
+    event.listen(pg, "after_cursor_execute", reserve_while_locked)
+    try:
+        with Session() as db:
+            routes.shard_product_stock(db, 1, 4)
+    finally:
+        event.remove(pg, "after_cursor_execute", reserve_while_locked)
+    reserver.join(10)
+    with Session() as db:
+        assert routes.get_stock_level(db, 1, sharding=True) == 90
+        assert db.get(ProductModel, 1).stock == 0
+    Base.metadata.drop_all(bind=pg)
+
+
+def test_stock_sharding_is_opt_in(client):
+    assert client.post("/products/1/stock/shards").status_code == 400
+
+
+def test_debug_endpoints_require_token(client, monkeypatch):
+    assert client.get("/debug/profile", params={"seconds": 0.1}).status_code == 404
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    assert client.get("/debug/profile", params={"seconds": 0.1}).status_code == 403
+    response = client.get("/debug/profile", params={"seconds": 0.1}, headers={"X-Debug-Token": "wrong"})
+    assert response.status_code == 403
+
+
+def test_profile_returns_collapsed_stacks(client, monkeypatch):
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    response = client.get("/debug/profile", params={"seconds": 0.2}, headers={"X-Debug-Token": "secret"})
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    # The profile endpoint itself is suspended in asyncio.sleep while sampled
+    assert any(line.startswith("task:") and "profile (debug.py" in line for line in lines)
+
+
+def test_per_request_profile(client, monkeypatch):
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    assert "X-Profile-Id" not in client.get("/products/1", headers={"X-Profile": "1"}).headers
+
+    response = client.get("/products/1", headers={"X-Profile": "1", "X-Debug-Token": "secret"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    profile = client.get(f"/debug/profile/requests/{profile_id}", headers={"X-Debug-Token": "secret"})
+    assert profile.status_code == 200
+    assert profile.headers["Content-Disposition"] == f'attachment; filename="request-{profile_id}.collapsed"'
+
+
+def test_continuous_profile_top_while_sampling():
+    class ManyStacks:
+        # New frames every sample, so the current second's Counters keep growing
+        calls = 0
+
+        def thread_stacks(self):
+            self.calls += 1
+            return [f"thread:main;handler;leaf{self.calls}_{i}" for i in range(50)]
+
+        def task_stacks(self):
+            return []
+
+    profiler = profiling.ContinuousProfiler(ManyStacks(), hz=10000).start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            top = profiler.top(limit=1)
+    finally:
+        profiler.stop()
+    assert top["total"][0]["frame"] == "handler"
+
+
+def test_fingerprint_collapses_values_and_in_lists():
+    a = sqlstats.fingerprint("SELECT * FROM products WHERE id IN (%(id_1)s, %(id_2)s) AND name = 'x'")
+    b = sqlstats.fingerprint("SELECT * FROM products\nWHERE id IN (%(id_1)s) AND name = 'it''s'")
+    assert a == b == "SELECT * FROM products WHERE id IN (?+) AND name = ?"
+
+
+def test_sql_stats_endpoint_and_metrics(client, monkeypatch):
+    sqlstats.stats.reset()
+    for _ in range(3):
+        client.get("/products/1")
+    monkeypatch.setattr(debug, "DEBUG_TOKEN", "secret")
+    body = client.get("/debug/sql", params={"order_by": "count"}, headers={"X-Debug-Token": "secret"}).json()
+    lookup = next(s for s in body["statements"] if "WHERE products.id = ?" in s["fingerprint"])
+    assert lookup["count"] == 3
+    assert lookup["p95_ms"] <= lookup["max_ms"]
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    assert f'sql_statements_total{{worker="{os.getpid()}",query="SELECT products.id' in metrics.text
+
+
+def test_slow_queries_log_parameter_shapes(caplog):
+    slow_engine = create_engine("sqlite://")
+    sqlstats.record_statements(slow_engine, slow_query_ms=0)
+    with caplog.at_level("WARNING", logger="app.sqlstats"), slow_engine.connect() as conn:
+        conn.exec_driver_sql("SELECT ? || ?", ("secret-value", 7))
+    message = next(r.getMessage() for r in caplog.records if r.name == "app.sqlstats")
+    assert "params=['str(12)', 'int']" in message
+    assert "secret-value" not in message
+
+
+def test_sparse_fieldsets_select_only_requested_columns(client):
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        response = client.get("/products", params={"fields": "name,price", "limit": 2})
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert response.status_code == 200
+    assert response.json() == [{"name": "Product 1", "price": 10.0}, {"name": "Product 2", "price": 20.0}]
+    assert len(statements) == 1
+    assert "description" not in statements[0] and "products.name" in statements[0]
+
+    full = client.get("/products", params={"limit": 2})
+    assert full.headers["ETag"] != response.headers["ETag"]
+    assert client.get("/products/3", params={"fields": "id,stock"}).json() == {"id": 3, "stock": 10}
+    body = client.post("/products/batch", params={"fields": "id"}, json={"ids": [2, 9]}).json()
+    assert body == {"products": [{"id": 2}], "missing": [9]}
+
+
+def test_unknown_fields_are_rejected(client):
+    response = client.get("/products", params={"fields": "name,secret"})
+    assert response.status_code == 400
+    assert "secret" in response.json()["detail"]
+
+
+def test_warm_up_opens_pool_connections_and_gates_readiness(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(warmup, "state", warmup.WarmupState(enabled=True))
+    assert client.get("/ready").status_code == 503
+    assert client.get("/health").status_code == 200
+
+    warmed = []
+    monkeypatch.setattr(clients, "_client", httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: warmed.append(str(request.url)) or httpx.Response(200))
+    ))
+    pooled = create_engine(f"sqlite:///{tmp_path / 'warm.db'}", pool_size=3,
+                           connect_args={"check_same_thread": False})
+    asyncio.run(warmup.warm_up(
+        engines=[pooled],
+        session_factory=TestingSessionLocal,
+        queries={"products": lambda db: routes.get_products(db)},
+        response_types={"products": List[Product]},
+        urls=[warmup.health_url("http://opa:8181/v1/data/productservice/allow")],
+    ))
+    assert pooled.pool.checkedin() == 3
+    assert warmed == ["http://opa:8181/health"]
+    body = client.get("/ready").json()
+    assert body["status"] == "ready" and body["warmup_failures"] == []
+
+
+def test_snapshot_serves_the_same_json_as_the_api(client, tmp_path):
+    from app import snapshot
+    path = str(tmp_path / "catalog.snap")
+    db = TestingSessionLocal()
+    try:
+        assert snapshot.export_snapshot(db, path, version=1)["products"] == 5
+    finally:
+        db.close()
+
+    snap = snapshot.Snapshot(path)
+    assert snap.version == 1 and list(snap.ids) == [1, 2, 3, 4, 5]
+    assert json.loads(bytes(snap.get(3))) == client.get("/products/3").json()
+    assert snap.get(42) is None
+    page = b"".join(bytes(part) for part in snap.page(1, 2))
+    assert json.loads(page) == client.get("/products", params={"skip": 1, "limit": 2}).json()
+    assert snap.page(10, 5) == [b"[]"]
+
+
+def test_snapshot_store_swaps_in_a_new_snapshot(client, tmp_path, monkeypatch):
+    from app import snapshot, snapshot_main
+    path = str(tmp_path / "catalog.snap")
+    db = TestingSessionLocal()
+    snapshot.export_snapshot(db, path, version=1)
+
+    store = snapshot.SnapshotStore(path)
+    monkeypatch.setattr(snapshot_main, "store", store)
+    monkeypatch.setitem(snapshot_main.app.dependency_overrides, check_policy, lambda: True)
+    snap_client = TestClient(snapshot_main.app)
+    assert snap_client.get("/ready").status_code == 503
+    assert store.reload_if_changed() and not store.reload_if_changed()
+
+    response = snap_client.get("/products/2")
+    assert response.json()["name"] == "Product 2"
+    assert response.headers["X-Snapshot-Version"] == "1"
+    assert snap_client.get("/products/2", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert snap_client.get("/products/9").status_code == 404
+    assert [p["id"] for p in snap_client.get("/products", params={"limit": 3}).json()] == [1, 2, 3]
+
+    old = store.current
+    db.get(ProductModel, 2).name = "Renamed"
+    db.commit()
+    snapshot.export_snapshot(db, path, version=2)
+    db.close()
+    assert store.reload_if_changed()
+    assert snap_client.get("/products/2").json()["name"] == "Renamed"
+    # Slices of the replaced snapshot stay readable
+    assert json.loads(bytes(old.get(2)))["name"] == "Product 2"
+
+    with open(path, "wb") as f:
+        f.write(b"not a snapshot")
+    assert not store.reload_if_changed()
+    assert store.current.version == 2
+
+    # A truncated snapshot is refused when loaded, not when a lookup reaches the missing bytes
+    snapshot.export_snapshot(TestingSessionLocal(), path, version=3)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 16)
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.Snapshot(path)
+    assert not store.reload_if_changed()
+    assert store.current.version == 2
+
+
+def test_snapshot_app_enforces_policy_and_rate_limit(client, tmp_path, monkeypatch):
+    from app import snapshot, snapshot_main
+    path = str(tmp_path / "catalog.snap")
+    snapshot.export_snapshot(TestingSessionLocal(), path, version=1)
+    store = snapshot.SnapshotStore(path)
+    store.reload_if_changed()
+    monkeypatch.setattr(snapshot_main, "store", store)
+    snap_client = TestClient(snapshot_main.app)
+
+    async def deny():
+        raise HTTPException(status_code=403, detail="Request denied by policy")
+
+    monkeypatch.setitem(snapshot_main.app.dependency_overrides, check_policy, deny)
+    assert snap_client.get("/products/1").status_code == 403
+    assert snap_client.get("/products").status_code == 403
+
+    monkeypatch.setitem(snapshot_main.app.dependency_overrides, check_policy, lambda: True)
+    monkeypatch.setattr(ratelimit, "limiter", ratelimit.RateLimiter(ratelimit.InProcessBackend(), rate=0.5, burst=1))
+    assert snap_client.get("/products/1").status_code == 200
+    assert snap_client.get("/products/1").status_code == 429
+
+
+def test_pool_records_checkouts_and_recommends_under_pressure(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool, "engines", [])
+    monkeypatch.setattr(pool, "DB_POOL_PRESSURE_CHECKS", 2)
+    pooled = pool.create_pooled_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=1,
+                                       pool_timeout=0.01)
+    held = [pooled.connect(), pooled.connect()]
+    for check in range(2):
+        with pytest.raises(exc.TimeoutError):
+            pooled.connect()
+        advice = pool.evaluate_pressure(pooled)
+    for connection in held:
+        connection.close()
+
+    assert advice is not None and "exhausted" in advice and "peak 2/2" in advice
+    status = pool.pool_status()[0]
+    assert (status["checkouts"], status["overflow_checkouts"], status["timeouts"]) == (2, 1, 2)
+    assert status["checked_in"] == 1 and status["held_seconds_total"] > 0
+    assert status["last_recommendation"] == advice
+    assert f'db_pool_timeouts_total{{worker="{os.getpid()}",pool="primary",host="' in pool.prometheus()
+
+
+def test_pool_series_are_unique_for_primary_and_read_on_one_host(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool, "engines", [])
+    url = f"sqlite:///{tmp_path / 'pool.db'}"
+    pool.create_pooled_engine(url, pool_size=1, max_overflow=0)
+    pool.create_pooled_engine(url, pool_size=1, max_overflow=0, role="read")
+    series = [line.rsplit(" ", 1)[0] for line in pool.prometheus().splitlines() if not line.startswith("#")]
+    assert len(series) == len(set(series))
+    assert [p["pool"] for p in pool.pool_status()] == ["primary", "read"]
+
+
+def test_pool_health_check_replaces_dead_idle_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool, "engines", [])
+    pooled = pool.create_pooled_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=2, max_overflow=0)
+    connections = [pooled.connect(), pooled.connect()]
+    for connection in connections:
+        connection.close()
+
+    pings = []
+    def ping(dbapi_connection):
+        pings.append(dbapi_connection)
+        if len(pings) == 1:
+            raise RuntimeError("server closed the connection")
+        return True
+    monkeypatch.setattr(pooled.dialect, "do_ping", ping)
+    assert pool.check_idle_connections(pooled) == 2
+    assert pings == []  # used moments ago, so not pinged
+    # The walk itself is not a checkout or a hold
+    assert pooled.pool.metrics.checkouts == 2 and len(pooled.pool.metrics._held) == 2
+
+    now = time.monotonic()
+    monkeypatch.setattr(pool.time, "monotonic", lambda: now + pool.DB_POOL_CHECK_SECONDS)
+    assert pool.check_idle_connections(pooled) == 2
+    # The dead one was replaced by a fresh connection, which needs no ping
+    assert len(pings) == 2 and pooled.pool.metrics.invalidated == 1
+    assert pooled.pool.checkedin() == 2
+
+
+def test_pool_sizes_fit_the_cluster_budget():
+    assert pool.replica_budget(per_replica=15, cluster=0, max_replicas=5) == 15
+    assert pool.replica_budget(per_replica=15, cluster=40, max_replicas=5) == 8
+    assert pool.pool_sizes(4, budget=8) == (1, 1)
+    assert pool.pool_sizes(1, budget=15) == (5, 10)
+    # A primary and a follower-read pool per worker share the host's budget
+    assert pool.pool_sizes(2, budget=15, pools=2) == (1, 2)
+
+
+def test_pool_sizes_never_exceed_the_budget():
+    assert pool.max_workers(budget=8) == 8
+    assert pool.max_workers(budget=8, pools=2) == 4
+    assert pool.pool_sizes(8, budget=8) == (1, 0)
+    with pytest.raises(ValueError):
+        pool.pool_sizes(9, budget=8)
+    with pytest.raises(ValueError):
+        pool.pool_sizes(5, budget=8, pools=2)
+
+
+def test_explicit_pool_sizes_must_fit_the_budget(monkeypatch):
+    monkeypatch.delenv("DB_POOL_SIZE", raising=False)
+    monkeypatch.delenv("DB_MAX_OVERFLOW", raising=False)
+    assert server.configured_pool_sizes(2, budget=15) == (3, 4)
+    monkeypatch.setenv("DB_POOL_SIZE", "2")
+    assert server.configured_pool_sizes(2, budget=15) == (2, 4)
+    monkeypatch.setenv("DB_POOL_SIZE", "10")
+    with pytest.raises(ValueError):
+        server.configured_pool_sizes(2, budget=15)
+
+
+def test_rpc_server_answers_pipelined_requests_by_id(client):
+    async def exchange(frames):
+        # One request at a time: the test database is a single SQLite connection shared by all threads.
+        # Answers still carry the request ID they belong to.
+        server = await rpc.RpcServer(TestingSessionLocal, TestingSessionLocal, batch_max_size=10,
+                                     max_in_flight=1, token="s3cret").start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        try:
+            writer.write(rpc.REQUEST_HEADER.pack(5 + 6, 0, rpc.AUTH) + b"s3cret")
+            assert rpc.RESPONSE_HEADER.unpack(await reader.readexactly(10)) == (6, 0, 200)
+            # All requests go out before any answer is read
+            for request_id, (method, payload) in enumerate(frames, 1):
+                writer.write(rpc.REQUEST_HEADER.pack(len(payload) + 5, request_id, method) + payload)
+            answers = {}
+            for _ in frames:
+                length, request_id, status = rpc.RESPONSE_HEADER.unpack(await reader.readexactly(10))
+                answers[request_id] = (status, await reader.readexactly(length - 6))
+            return answers
+        finally:
+            writer.close()
+            await server.stop()
+
+    answers = asyncio.run(exchange([
+        (rpc.RESERVE, rpc.STOCK_CHANGE.pack(1, 3)),
+        (rpc.RESERVE, rpc.STOCK_CHANGE.pack(2, 999)),
+        (rpc.RELEASE, rpc.STOCK_CHANGE.pack(99, 1)),
+        (rpc.MULTI_GET, rpc.COUNT.pack(3) + struct.pack("<3Q", 3, 42, 1)),
+        (rpc.STOCK, rpc.PRODUCT_ID.pack(4)),
+        (9, b""),
+        (rpc.STOCK, b"\x01"),
+    ]))
+    assert answers[1] == (200, rpc.STOCK_LEVEL.pack(7))
+    assert answers[2] == (400, b"Not enough stock available. Requested: 999, Available: 10")
+    assert answers[3] == (404, b"Product with ID 99 not found")
+    assert answers[5] == (200, rpc.STOCK_LEVEL.pack(10))
+    assert answers[6][0] == 400 and answers[7] == (400, b"Malformed RPC payload")
+
+    status, body = answers[4]
+    product = client.get("/products/3").json()
+    assert status == 200 and body.startswith(rpc.COUNT.pack(2) + rpc.PRODUCT.pack(
+        3, product["price"], product["stock"], True,
+        *(rpc._micros(datetime.fromisoformat(product[key])) for key in ("created_at", "updated_at")),
+    ) + rpc.STRING_LENGTH.pack(9) + b"Product 3")
+    assert body.endswith(rpc.COUNT.pack(1) + rpc.PRODUCT_ID.pack(42))
+    assert client.get("/products/1/stock").json()["stock"] == 7
+
+
+def test_rpc_server_requires_the_service_token(client):
+    async def first_answer(method, payload):
+        server = await rpc.RpcServer(TestingSessionLocal, TestingSessionLocal, token="s3cret").start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        try:
+            writer.write(rpc.REQUEST_HEADER.pack(len(payload) + 5, 1, method) + payload)
+            length, _, status = rpc.RESPONSE_HEADER.unpack(await reader.readexactly(10))
+            await reader.readexactly(length - 6)
+            # The server hangs up after refusing
+            return status, await reader.read()
+        finally:
+            writer.close()
+            await server.stop()
+
+    assert asyncio.run(first_answer(rpc.RESERVE, rpc.STOCK_CHANGE.pack(1, 3))) == (401, b"")
+    assert asyncio.run(first_answer(rpc.AUTH, b"guess")) == (401, b"")
+    assert client.get("/products/1/stock").json()["stock"] == 10
+    with pytest.raises(RuntimeError):
+        asyncio.run(rpc.RpcServer(TestingSessionLocal, TestingSessionLocal, token="").start("127.0.0.1", 0))
+
+
+def test_rpc_rejects_product_ids_beyond_bigint(client):
+    server = rpc.RpcServer(TestingSessionLocal, TestingSessionLocal, token="s3cret")
+    for method, payload in [
+        (rpc.STOCK, rpc.PRODUCT_ID.pack(2 ** 63)),
+        (rpc.RESERVE, rpc.STOCK_CHANGE.pack(2 ** 64 - 1, 1)),
+        (rpc.MULTI_GET, rpc.COUNT.pack(2) + struct.pack("<2Q", 1, 2 ** 63)),
+    ]:
+        with pytest.raises(HTTPException) as raised:
+            server.dispatch(method, payload)
+        assert raised.value.status_code == 400
+    assert server.dispatch(rpc.STOCK, rpc.PRODUCT_ID.pack(1)) == rpc.STOCK_LEVEL.pack(10)